@@ -0,0 +1,134 @@
+"""Benchmark cold-start import time of the helper modules
+
+Imports each module in a fresh Python process, several times, and reports
+the median time the import took and which heavy dependencies it loaded.
+With --baseline, the same imports are timed on the modules as they were at
+an earlier git revision, to show the difference.
+
+Usage:
+    python bench_import_time.py [--runs 10] [--baseline HEAD~1]
+        [--output results.json]
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# What short-lived scripts import
+IMPORTS = [
+    "from helper_functions import tree",
+    "from helper_functions import convert_to_utc_and_format",
+    "import helper_functions",
+    "import data_summaries",
+    "import pipeline"
+]
+
+HEAVY_MODULES = ["pandas", "numpy", "matplotlib", "cryptease", "mano",
+                 "requests", "orjson", "pytz", "dateutil"]
+
+# Run in the child process: time the import, then list heavy modules loaded
+CHILD_SCRIPT = """
+import json, sys, time
+t_start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - t_start
+print(json.dumps({{"seconds": seconds, "loaded": [
+    name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def time_import(statement: str, module_dir: str, runs: int) -> dict:
+    """Median seconds to run an import statement in a fresh interpreter
+
+    Returns:
+        Dict with seconds and loaded, or None if the import fails (e.g. the
+        module doesn't exist at a baseline revision)
+    """
+    script = CHILD_SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [module_dir] + [p for p in [env.get("PYTHONPATH")] if p])
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    seconds = []
+    for _ in range(runs):
+        process = subprocess.run([sys.executable, "-c", script], env=env,
+                                 cwd=module_dir, capture_output=True,
+                                 text=True)
+        if process.returncode != 0:
+            error = (process.stderr.strip().splitlines() or ["failed"])[-1]
+            print(f"{statement} in {module_dir}: {error}", file=sys.stderr)
+            return None
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        seconds.append(result["seconds"])
+    return {"seconds": statistics.median(seconds), "loaded": result["loaded"]}
+
+
+def format_ms(seconds: float) -> str:
+    """Milliseconds for the table; "n/a" for an import that failed"""
+    return "n/a" if seconds is None else f"{seconds * 1000:.0f}"
+
+
+def export_revision(ref: str, target_dir: str) -> str:
+    """Write this folder as it was at a git revision into target_dir;
+    returns the exported module folder"""
+    top_level, prefix = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel", "--show-prefix"],
+        cwd=MODULE_DIR, check=True, capture_output=True, text=True
+    ).stdout.splitlines()
+    archive = subprocess.run(["git", "archive", ref, prefix], cwd=top_level,
+                             check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target_dir)
+    return os.path.join(target_dir, prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--baseline",
+                        help="git revision to compare against, e.g. HEAD~1")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        baseline_dir = None
+        if args.baseline:
+            baseline_dir = export_revision(args.baseline, workdir)
+        results = []
+        for statement in IMPORTS:
+            current = time_import(statement, MODULE_DIR, args.runs) or {}
+            result = {"import": statement,
+                      "seconds": current.get("seconds"),
+                      "loaded": current.get("loaded")}
+            if baseline_dir is not None:
+                baseline = time_import(statement, baseline_dir,
+                                       args.runs) or {}
+                result["baseline_seconds"] = baseline.get("seconds")
+                result["baseline_loaded"] = baseline.get("loaded")
+            results.append(result)
+
+    print(f"{'import':55} {'ms':>7} {'baseline':>9}  heavy modules loaded")
+    for result in results:
+        baseline = ""
+        if "baseline_seconds" in result:
+            baseline = format_ms(result["baseline_seconds"])
+        loaded = ("n/a" if result["loaded"] is None
+                  else ", ".join(result["loaded"]) or "-")
+        print(f"{result['import']:55} {format_ms(result['seconds']):>7} "
+              f"{baseline:>9}  {loaded}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark disk footprint and scan throughput of compressed raw storage
+
+Writes a synthetic download folder of hourly sensor files, then for the
+plain layout and each available compression (see raw_storage.py) measures
+the bytes on disk, the time to convert the folder, and the time to read
+every file back into dataframes and to run the SurveyQC scan.
+
+Usage:
+    python bench_raw_storage.py [--participants 3] [--days 7]
+        [--rows-per-file 3600] [--output results.json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import synthetic_data
+import raw_storage
+import survey_qc
+
+
+def disk_bytes(root: str) -> int:
+    """Bytes allocated on disk (not apparent sizes) under root"""
+    return sum(os.stat(os.path.join(folder, filename)).st_blocks * 512
+               for folder, _, filenames in os.walk(root)
+               for filename in filenames)
+
+
+def scan(root: str) -> tuple:
+    """Read every raw sensor file; returns (rows, seconds)"""
+    t_start = time.perf_counter()
+    rows = 0
+    for folder, _, _ in os.walk(root):
+        if os.path.basename(folder) in ("accelerometer", "gps"):
+            for path in raw_storage.list_raw_files(folder):
+                rows += len(raw_storage.read_raw_csv(path))
+    return rows, time.perf_counter() - t_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--participants", type=int, default=3)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--rows-per-file", type=int, default=3600)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    compressions = ["gzip"] + (["zstd"] if raw_storage.ZSTD_AVAILABLE else [])
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        plain_dir = os.path.join(workdir, "plain")
+        synthetic_data.make_raw_download_tree(
+            plain_dir, args.participants, args.days,
+            streams=["accelerometer", "gps", "survey_timings",
+                     "survey_answers"],
+            rows_per_file=args.rows_per_file
+        )
+        for compression in [None] + compressions:
+            root = plain_dir
+            convert_seconds = 0.0
+            if compression is not None:
+                root = os.path.join(workdir, compression)
+                shutil.copytree(plain_dir, root)
+                t_start = time.perf_counter()
+                raw_storage.compress_tree(root, compression)
+                convert_seconds = time.perf_counter() - t_start
+            rows, scan_seconds = scan(root)
+            t_start = time.perf_counter()
+            survey_qc.identify_unmatched_files(root, max_workers=1)
+            qc_seconds = time.perf_counter() - t_start
+            results.append({
+                "layout": compression or "plain",
+                "disk_bytes": disk_bytes(root),
+                "convert_seconds": convert_seconds,
+                "rows": rows,
+                "scan_seconds": scan_seconds,
+                "scan_rows_per_second": rows / scan_seconds,
+                "survey_qc_seconds": qc_seconds
+            })
+
+    plain_bytes = results[0]["disk_bytes"]
+    print(f"{'layout':8} {'disk MB':>9} {'ratio':>6} {'convert s':>10} "
+          f"{'scan s':>8} {'rows/s':>11} {'QC s':>7}")
+    for result in results:
+        print(f"{result['layout']:8} {result['disk_bytes'] / 1e6:9.1f} "
+              f"{plain_bytes / result['disk_bytes']:6.1f} "
+              f"{result['convert_seconds']:10.2f} "
+              f"{result['scan_seconds']:8.2f} "
+              f"{result['scan_rows_per_second']:11.0f} "
+              f"{result['survey_qc_seconds']:7.2f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark memory use of normalized data volume summaries
+
+Builds an hourly summaries table, writes it to csv, and compares the memory
+taken by the table as data_volume_plots used to prepare it (read_csv, dates
+as datetime.date objects, float byte counts) with the table after
+normalize_summaries. Also times plotting one stream from the normalized
+table.
+
+Usage:
+    python bench_summary_memory.py [--num-rows 5000000] [--streams gps accelerometer]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use("Agg")  # never open windows while benchmarking
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import synthetic_data
+from data_summaries import normalize_summaries, plot_heatmap
+
+
+def legacy_preprocess(summaries_df: pd.DataFrame) -> pd.DataFrame:
+    """The preprocessing data_volume_plots did before normalize_summaries"""
+    summaries_df = summaries_df.fillna(0)
+    dates = pd.to_datetime(summaries_df["date"], format="ISO8601")
+    summaries_df["date"] = dates.dt.date
+    summaries_df = summaries_df.loc[dates > pd.Timestamp("2008-01-01")].copy()
+    summaries_df["min_date"] = summaries_df.groupby("participant_id")[
+        "date"
+    ].transform("min")
+    summaries_df["days_since_start"] = (
+        pd.to_datetime(summaries_df["date"])
+        - pd.to_datetime(summaries_df["min_date"])
+    ).dt.days
+    summaries_df["any_survey_submission"] = (
+        summaries_df["beiwe_survey_answers_bytes"]
+        + summaries_df["beiwe_audio_recordings_bytes"]
+    ) > 0
+    return summaries_df
+
+
+def megabytes(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-rows", type=int, default=5000000)
+    parser.add_argument("--streams", nargs="+",
+                        default=["gps", "accelerometer"])
+    parser.add_argument("--num-days", type=int, default=365)
+    args = parser.parse_args()
+
+    # Participants enroll in the first half of the window, so each has about
+    # three quarters of the window's hours on average
+    hours_per_participant = args.num_days * 24 * 3 / 4
+    num_participants = max(int(args.num_rows / hours_per_participant), 1)
+    streams = list(dict.fromkeys(args.streams + ["survey_answers",
+                                                 "audio_recordings"]))
+    summaries_df = synthetic_data.make_summary_table(
+        num_participants, args.num_days, streams=streams,
+        time_granularity="hourly"
+    )
+    print(f"{summaries_df.shape[0]} rows, {num_participants} participants, "
+          f"{len(streams)} streams")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        summaries_path = os.path.join(workdir, "data_volume.csv")
+        summaries_df.to_csv(summaries_path, index=False)
+        del summaries_df
+        raw_df = pd.read_csv(summaries_path)
+        print(f"read_csv:            {megabytes(raw_df):9.1f} MB")
+
+        t_start = time.perf_counter()
+        legacy_df = legacy_preprocess(raw_df)
+        legacy_seconds = time.perf_counter() - t_start
+        legacy_mb = megabytes(legacy_df)
+        print(f"legacy preprocessing: {legacy_mb:8.1f} MB "
+              f"({legacy_seconds:.2f} s)")
+        del legacy_df
+
+        t_start = time.perf_counter()
+        normalized_df = normalize_summaries(raw_df)
+        normalize_seconds = time.perf_counter() - t_start
+        normalized_mb = megabytes(normalized_df)
+        print(f"normalize_summaries:  {normalized_mb:8.1f} MB "
+              f"({normalize_seconds:.2f} s)")
+        print(f"reduction:            {legacy_mb / normalized_mb:8.1f}x")
+        print(normalized_df.dtypes.to_string())
+        del raw_df
+
+        t_start = time.perf_counter()
+        plot_heatmap(normalized_df, args.streams[0],
+                     os.path.join(workdir, "plots"), True, True, True, False,
+                     1000, False)
+        print(f"plot_heatmap({args.streams[0]}): "
+              f"{time.perf_counter() - t_start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Benchmark vectorized UTC conversion against per-row conversion
+
+Usage:
+    python bench_utc_conversion.py [--num-rows 1000000] [--timezone America/New_York]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helper_functions import convert_to_utc, convert_to_utc_and_format
+
+
+def make_local_times(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    """Random local dates and times spread over several years"""
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp("2018-01-01") + pd.to_timedelta(
+        rng.integers(0, 365 * 5, num_rows), unit="D"
+    )
+    seconds = rng.integers(0, 24 * 60 * 60, num_rows)
+    return pd.DataFrame({
+        "date": dates.strftime("%Y-%m-%d"),
+        "time": _format_seconds(seconds)
+    })
+
+
+def _format_seconds(seconds: np.ndarray) -> np.ndarray:
+    hours, remainder = np.divmod(seconds, 3600)
+    minutes, secs = np.divmod(remainder, 60)
+    return np.char.add(np.char.add(np.char.add(
+        np.char.zfill(hours.astype(str), 2), ":"),
+        np.char.add(np.char.zfill(minutes.astype(str), 2), ":")),
+        np.char.zfill(secs.astype(str), 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-rows", type=int, default=1000000)
+    parser.add_argument("--timezone", default="America/New_York")
+    args = parser.parse_args()
+
+    local_df = make_local_times(args.num_rows)
+
+    t_start = time.perf_counter()
+    per_row = [convert_to_utc_and_format(d, t, args.timezone)
+               for d, t in zip(local_df["date"], local_df["time"])]
+    per_row_seconds = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    vectorized = convert_to_utc(local_df["date"], local_df["time"], args.timezone,
+                                ambiguous="latest", nonexistent="shift_forward")
+    vectorized_seconds = time.perf_counter() - t_start
+
+    # pytz and pandas shift times in the spring-forward gap differently, so a
+    # handful of rows are expected to differ.
+    num_different = int((vectorized.to_numpy() != np.array(per_row)).sum())
+    print(f"rows: {args.num_rows}")
+    print(f"per-row convert_to_utc_and_format: {per_row_seconds:.3f} s")
+    print(f"vectorized convert_to_utc:         {vectorized_seconds:.3f} s")
+    print(f"speedup: {per_row_seconds / vectorized_seconds:.1f}x")
+    print(f"rows that differ (nonexistent local times): {num_different}")
+
+
+if __name__ == "__main__":
+    main()
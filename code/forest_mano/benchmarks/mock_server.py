@@ -0,0 +1,402 @@
+"""Local stand-in for a Beiwe server, for offline load and retry testing
+
+Implements the endpoints used by mano, helper_functions, data_summaries and
+the notebooks:
+
+    POST /get-studies/v1                          mano.studies
+    POST /get-users/v1                            mano.users
+    POST /get-data/v1                             mano.sync.download (zip archive)
+    POST /get-summary-statistics/v1               call_api
+    POST /get-participant-table-data/v1           get_participant_table_data
+    POST /get-study-settings/v1                   fetch_json (study settings)
+    POST /get-interventions/v1                    fetch_json (interventions)
+    GET  /api/v0/studies/<id>/summary-statistics/<daily|hourly>
+                                                  get_data_summaries
+    GET  /_stats                                  request counters (not Beiwe)
+
+Latency, payload size and injected failures (429, 503 and archives cut off
+mid-stream) are configurable, and every request is counted so throughput and
+retry behavior can be benchmarked reproducibly.
+
+Usage:
+    python mock_server.py --port 8765 --latency 0.2 --error-rate-429 0.05
+
+    or, from Python:
+    with MockBeiweServer(latency=0.1, truncate_rate=0.2) as server:
+        keyring = server.keyring()
+        helper_functions.download_data(keyring, server.study_id, "raw_data")
+"""
+
+import argparse
+from collections import Counter
+import io
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import zipfile
+
+import synthetic_data
+
+
+DEFAULT_STUDY_SETTINGS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "config",
+    "default_passive.json"
+)
+
+PARTICIPANT_TABLE_COLUMNS = ["Created On", "Patient ID", "Status", "OS Type",
+                             "First Registration Date", "Last Registration",
+                             "Last Upload"]
+
+PARTICIPANT_STATUSES = ["Active (just now)", "Active (last week)", "Inactive",
+                        "Not Registered", "Permanently Retired"]
+
+RAW_STREAMS = ["accelerometer", "gps", "gyro", "calls", "texts",
+               "power_state", "survey_timings", "survey_answers"]
+
+
+class MockBeiweServer:
+    """A threaded HTTP server that imitates a Beiwe deployment
+
+    Args:
+        host: Interface to bind
+        port: Port to bind; 0 picks a free port
+        study_id: The one study this server knows about
+        num_participants: Number of participants in the study
+        num_days: Days of data per participant
+        files_per_stream: Hourly files per stream in each download archive
+        bytes_per_file: Approximate size of each raw file in an archive
+        latency: Seconds to wait before answering each request
+        latency_jitter: Extra uniformly random delay, in seconds
+        bytes_per_second: Throttle for response bodies; None is unlimited
+        error_rate_429: Probability a request is answered with 429
+        error_rate_503: Probability a request is answered with 503
+        truncate_rate: Probability a download archive is cut off partway
+            through, which requests reports as a ChunkedEncodingError
+        study_settings_path: Study configuration JSON returned by the study
+            settings endpoint
+        seed: Random seed for data and failure injection
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 study_id: str = "a" * 24, num_participants: int = 20,
+                 num_days: int = 30, files_per_stream: int = 24,
+                 bytes_per_file: int = 20000, latency: float = 0.0,
+                 latency_jitter: float = 0.0, bytes_per_second: float = None,
+                 error_rate_429: float = 0.0, error_rate_503: float = 0.0,
+                 truncate_rate: float = 0.0,
+                 study_settings_path: str = DEFAULT_STUDY_SETTINGS,
+                 seed: int = 0):
+        self.study_id = study_id
+        self.num_days = num_days
+        self.files_per_stream = files_per_stream
+        self.bytes_per_file = bytes_per_file
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.bytes_per_second = bytes_per_second
+        self.error_rate_429 = error_rate_429
+        self.error_rate_503 = error_rate_503
+        self.truncate_rate = truncate_rate
+        self.study_settings_path = study_settings_path
+        self.participant_ids = synthetic_data.make_beiwe_ids(num_participants, seed)
+        self.summaries_df = synthetic_data.make_summary_table(
+            num_participants, num_days, study_id=study_id, seed=seed
+        )
+        self.request_counts = Counter()
+        self.status_counts = Counter()
+        self.bytes_sent = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        handler = type("Handler", (_MockBeiweHandler,), {"mock": self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def keyring(self) -> dict:
+        """A keyring that points mano and the helpers at this server"""
+        return {"URL": self.url, "USERNAME": "mock", "PASSWORD": "mock",
+                "ACCESS_KEY": "mock_access_key", "SECRET_KEY": "mock_secret_key",
+                "TABLEAU_ACCESS_KEY": "mock_tableau_access_key",
+                "TABLEAU_SECRET_KEY": "mock_tableau_secret_key"}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": dict(self.request_counts),
+                    "statuses": {str(k): v for k, v in self.status_counts.items()},
+                    "bytes_sent": self.bytes_sent}
+
+    def reset_stats(self):
+        with self._lock:
+            self.request_counts.clear()
+            self.status_counts.clear()
+            self.bytes_sent = 0
+
+    def roll(self, probability: float) -> bool:
+        with self._lock:
+            return self._random.random() < probability
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def participant_table(self) -> list:
+        """Rows of the participant table, one dict per participant"""
+        rng = random.Random(len(self.participant_ids))
+        rows = []
+        for participant_id in self.participant_ids:
+            status = rng.choice(PARTICIPANT_STATUSES)
+            registered = status != "Not Registered"
+            dates = self.summaries_df.loc[
+                self.summaries_df["participant_id"] == participant_id, "date"
+            ]
+            first_date = dates.min() if registered else None
+            rows.append({
+                "Created On": "2023-01-01",
+                "Patient ID": participant_id,
+                "Status": status,
+                "OS Type": rng.choice(["ANDROID", "IOS"]) if registered else "",
+                "First Registration Date": first_date,
+                "Last Registration": first_date,
+                "Last Upload": dates.max() + "T12:00:00" if registered else None
+            })
+        return rows
+
+    def download_archive(self, user_ids: list, data_streams: list) -> bytes:
+        """Zip archive shaped like /get-data/v1 output"""
+        rng = random.Random(",".join(user_ids + data_streams))
+        buffer = io.BytesIO()
+        registry = dict()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+            for user_id in user_ids:
+                for stream in data_streams or RAW_STREAMS:
+                    header = synthetic_data.RAW_HEADERS.get(
+                        stream, "timestamp,UTC time,value")
+                    for hour in range(self.files_per_stream):
+                        filename = (f"{user_id}/{stream}/2023-01-01 "
+                                    f"{hour:02d}_00_00+00_00.csv")
+                        # random digits compress about as well as sensor data
+                        num_rows = max(self.bytes_per_file // 40, 1)
+                        body = "\n".join(
+                            f"{1672531200000 + hour * 3600000 + i * 1000},"
+                            f"{rng.random():.12f},{rng.random():.12f}"
+                            for i in range(num_rows)
+                        )
+                        zf.writestr(filename, header + "\n" + body + "\n")
+                        registry[filename] = "mock"
+            zf.writestr("registry", json.dumps(registry))
+        return buffer.getvalue()
+
+
+class _MockBeiweHandler(BaseHTTPRequestHandler):
+    mock = None  # set on the subclass created by MockBeiweServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # keep benchmark output quiet
+        pass
+
+    def _read_form(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode() if length else ""
+        return {key: values if key in ("user_ids", "data_streams") else values[0]
+                for key, values in parse_qs(body).items()}
+
+    def _send(self, status: int, body: bytes = b"",
+              content_type: str = "application/json", truncate: bool = False):
+        with self.mock._lock:
+            self.mock.status_counts[status] += 1
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if truncate:
+            # Chunked encoding lets the client notice the stream was cut off
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk_size = 64 * 1024
+        end = len(body) // 2 if truncate else len(body)
+        for start in range(0, end, chunk_size):
+            chunk = body[start:min(start + chunk_size, end)]
+            if truncate:
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            else:
+                self.wfile.write(chunk)
+            with self.mock._lock:
+                self.mock.bytes_sent += len(chunk)
+            if self.mock.bytes_per_second:
+                time.sleep(len(chunk) / self.mock.bytes_per_second)
+        if truncate:
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj, default=str).encode())
+
+    def _preamble(self, path: str) -> bool:
+        """Count the request, wait, and maybe inject an error. Returns False
+        if a response was already sent."""
+        with self.mock._lock:
+            self.mock.request_counts[path] += 1
+        delay = self.mock.latency
+        if self.mock.latency_jitter:
+            delay += self.mock._random.uniform(0, self.mock.latency_jitter)
+        if delay:
+            time.sleep(delay)
+        if self.mock.roll(self.mock.error_rate_429):
+            self._send(429, b'{"errors": "rate limited"}')
+            return False
+        if self.mock.roll(self.mock.error_rate_503):
+            self._send(503, b'{"errors": "service unavailable"}')
+            return False
+        return True
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip("/")
+        if path == "/_stats":
+            self._send_json(self.mock.stats())
+            return
+        if not self._preamble(path):
+            return
+        parts = path.strip("/").split("/")
+        if (len(parts) == 6 and parts[:3] == ["api", "v0", "studies"]
+                and parts[4] == "summary-statistics"):
+            if not self.headers.get("X-Access-Key-Id"):
+                self._send(403, b'{"errors": "missing credentials"}')
+                return
+            if parts[3] != self.mock.study_id:
+                self._send_json({"errors": ["Study not found"]})
+                return
+            self._send_json(self._filter_summaries(parse_qs(parsed.query)))
+            return
+        self._send(404, b'{"errors": "not found"}')
+
+    def _filter_summaries(self, query: dict) -> list:
+        summaries_df = self.mock.summaries_df
+        if "participant_ids" in query:
+            ids = query["participant_ids"][0].split(",")
+            summaries_df = summaries_df.loc[summaries_df["participant_id"].isin(ids)]
+        if "start_date" in query:
+            summaries_df = summaries_df.loc[summaries_df["date"] >= query["start_date"][0]]
+        if "end_date" in query:
+            summaries_df = summaries_df.loc[summaries_df["date"] <= query["end_date"][0]]
+        if "fields" in query:
+            fields = query["fields"][0].split(",")
+            summaries_df = summaries_df[["participant_id", "study_id", "date"]
+                                        + [f for f in fields if f in summaries_df]]
+        if "limit" in query:
+            summaries_df = summaries_df.head(int(query["limit"][0]))
+        return summaries_df.to_dict(orient="records")
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        form = self._read_form()
+        if not self._preamble(path):
+            return
+        if not form.get("access_key") or not form.get("secret_key"):
+            self._send(400, b'{"errors": "missing access_key or secret_key"}')
+            return
+        if path == "/get-studies/v1":
+            self._send_json({self.mock.study_id: "Mock Study"})
+            return
+        if form.get("study_id") != self.mock.study_id:
+            self._send(404, b'{"errors": "study not found"}')
+            return
+        if path == "/get-users/v1":
+            self._send_json(self.mock.participant_ids)
+        elif path == "/get-data/v1":
+            user_ids = [u for u in form.get("user_ids", [])
+                        if u in self.mock.participant_ids]
+            if not user_ids:
+                self._send(404, b"")
+                return
+            archive = self.mock.download_archive(user_ids,
+                                                 form.get("data_streams", []))
+            self._send(200, archive, "application/zip",
+                       truncate=self.mock.roll(self.mock.truncate_rate))
+        elif path == "/get-summary-statistics/v1":
+            self._send_json(self.mock.summaries_df.to_dict(orient="records"))
+        elif path == "/get-participant-table-data/v1":
+            rows = self.mock.participant_table()
+            if form.get("data_format", "csv") == "csv":
+                lines = [",".join(PARTICIPANT_TABLE_COLUMNS)] + [
+                    ",".join("" if row[c] is None else str(row[c])
+                             for c in PARTICIPANT_TABLE_COLUMNS) for row in rows
+                ]
+                self._send(200, ("\n".join(lines) + "\n").encode(), "text/csv")
+            else:
+                self._send_json(rows)
+        elif path == "/get-study-settings/v1":
+            with open(self.mock.study_settings_path, "rb") as f:
+                self._send(200, f.read())
+        elif path == "/get-interventions/v1":
+            self._send_json({
+                row["Patient ID"]: {"Mock Intervention": {
+                    "Enrollment date": row["First Registration Date"]}}
+                for row in self.mock.participant_table()
+                if row["First Registration Date"] is not None
+            })
+        else:
+            self._send(404, b'{"errors": "not found"}')
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Run a mock Beiwe server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--participants", type=int, default=20)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--files-per-stream", type=int, default=24)
+    parser.add_argument("--bytes-per-file", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--bytes-per-second", type=float, default=None)
+    parser.add_argument("--error-rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate-503", type=float, default=0.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    server = MockBeiweServer(
+        args.host, args.port, num_participants=args.participants,
+        num_days=args.days, files_per_stream=args.files_per_stream,
+        bytes_per_file=args.bytes_per_file, latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        bytes_per_second=args.bytes_per_second,
+        error_rate_429=args.error_rate_429, error_rate_503=args.error_rate_503,
+        truncate_rate=args.truncate_rate, seed=args.seed
+    )
+    print(f"Mock Beiwe server for study {server.study_id} at {server.url}")
+    print("Request counts at " + server.url + "/_stats; Ctrl-C to stop")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(json.dumps(server.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Benchmark suite for the data processing helpers
+
+Generates synthetic data (see synthetic_data.py), times each benchmark, and
+measures its peak Python memory with tracemalloc. Results are saved as JSON
+so runs can be compared over time.
+
+Usage:
+    python run_benchmarks.py [--size small|medium|large] [--output results.json]
+                             [--only plot_heatmap ...] [--compare old_results.json]
+"""
+
+import argparse
+from datetime import datetime, timezone
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use("Agg")  # never open windows while benchmarking
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import synthetic_data
+
+
+SIZES = {
+    "small": {"num_participants": 50, "num_days": 90, "raw_participants": 3,
+              "raw_days": 3, "forest_participants": 50},
+    "medium": {"num_participants": 300, "num_days": 365, "raw_participants": 10,
+               "raw_days": 7, "forest_participants": 300},
+    "large": {"num_participants": 1000, "num_days": 730, "raw_participants": 30,
+              "raw_days": 14, "forest_participants": 1000}
+}
+
+BENCHMARKS = dict()
+
+
+def benchmark(func):
+    """Register a benchmark. It receives (size, workdir) and returns a
+    zero-argument callable that runs the timed work."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+@benchmark
+def ensure_time_coverage(size: dict, workdir: str):
+    import data_summaries
+    summaries_df = synthetic_data.make_summary_table(
+        size["num_participants"], size["num_days"], streams=["gps"],
+        fraction_1969=0
+    )
+    summaries_df["date"] = pd.to_datetime(summaries_df["date"]).dt.date
+    summaries_df = summaries_df.loc[summaries_df["beiwe_gps_bytes"] > 0]
+    return lambda: data_summaries.ensure_time_coverage(summaries_df, "date")
+
+
+@benchmark
+def data_volume_plots(size: dict, workdir: str):
+    import data_summaries
+    summaries_path = os.path.join(workdir, "data_volume.csv")
+    synthetic_data.make_summary_table(
+        size["num_participants"], size["num_days"]
+    ).to_csv(summaries_path, index=False)
+    output_dir = os.path.join(workdir, "plots")
+    return lambda: data_summaries.data_volume_plots(
+        summaries_path, output_dir, display_plots=False,
+        data_streams_to_plot=["gps", "accelerometer"], overlay_surveys=True,
+        include_y_labels=False
+    )
+
+
+@benchmark
+def plot_heatmap(size: dict, workdir: str):
+    import data_summaries
+    summaries_df = synthetic_data.make_summary_table(
+        size["num_participants"], size["num_days"],
+        streams=["gps", "survey_answers", "audio_recordings"], fraction_1969=0
+    )
+    # same preprocessing as data_volume_plots
+    summaries_df = data_summaries.normalize_summaries(summaries_df)
+    output_dir = os.path.join(workdir, "heatmaps")
+    return lambda: data_summaries.plot_heatmap(
+        summaries_df, "gps", output_dir, True, True, True, False, 1000, False
+    )
+
+
+@benchmark
+def concatenate_folder(size: dict, workdir: str):
+    import helper_functions
+    from pathlib import Path
+    forest_dir = os.path.join(workdir, "gps_output")
+    synthetic_data.make_forest_output_folder(
+        forest_dir, size["forest_participants"], size["num_days"]
+    )
+    return lambda: helper_functions.concatenate_folder(Path(forest_dir),
+                                                       "gps_summaries.csv")
+
+
+@benchmark
+def survey_qc(size: dict, workdir: str):
+    import survey_qc
+    raw_dir = os.path.join(workdir, "raw_data")
+    synthetic_data.make_raw_download_tree(
+        raw_dir, size["raw_participants"], size["raw_days"],
+        streams=["survey_timings", "survey_answers"],
+        survey_ids=["survey" + str(i) for i in range(3)]
+    )
+    return lambda: survey_qc.identify_unmatched_files(raw_dir, max_workers=1)
+
+
+@benchmark
+def compressed_raw_scan(size: dict, workdir: str):
+    import raw_storage
+    raw_dir = os.path.join(workdir, "raw_data")
+    synthetic_data.make_raw_download_tree(
+        raw_dir, size["raw_participants"], size["raw_days"],
+        streams=["accelerometer", "gps"]
+    )
+    raw_storage.compress_tree(raw_dir, "gzip")
+    paths = [path for folder, _, _ in os.walk(raw_dir)
+             for path in raw_storage.list_raw_files(folder)]
+    return lambda: sum(len(raw_storage.read_raw_csv(path)) for path in paths)
+
+
+@benchmark
+def convert_to_utc(size: dict, workdir: str):
+    import helper_functions
+    num_rows = size["num_participants"] * size["num_days"]
+    dates = pd.Series(pd.date_range("2020-01-01", periods=num_rows,
+                                    freq="37min").strftime("%Y-%m-%d"))
+    return lambda: helper_functions.convert_to_utc(
+        dates, "23:59:00", "America/New_York", ambiguous="latest",
+        nonexistent="shift_forward"
+    )
+
+
+@benchmark
+def rolling_compliance(size: dict, workdir: str):
+    import compliance
+    summaries_df = synthetic_data.make_summary_table(
+        size["num_participants"], size["num_days"]
+    )
+    return lambda: compliance.rolling_compliance(summaries_df, window_days=7)
+
+
+def run_benchmark(name: str, size: dict, repeats: int) -> dict:
+    """Set up one benchmark in a scratch folder, time it and measure memory"""
+    workdir = tempfile.mkdtemp(prefix=f"beiwe_bench_{name}_")
+    try:
+        setup_start = time.perf_counter()
+        run = BENCHMARKS[name](size, workdir)
+        setup_seconds = time.perf_counter() - setup_start
+        timings = []
+        for _ in range(repeats):
+            gc.collect()
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        gc.collect()
+        tracemalloc.start()
+        run()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "setup_s": round(setup_seconds, 4),
+        "min_s": round(min(timings), 4),
+        "median_s": round(float(np.median(timings)), 4),
+        "timings_s": [round(t, 4) for t in timings],
+        "peak_traced_memory_bytes": peak_bytes
+    }
+
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BENCHMARK_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def compare_results(old: dict, new: dict):
+    """Print the change in median time and memory for shared benchmarks"""
+    print(f"{'benchmark':<24}{'old s':>10}{'new s':>10}{'ratio':>8}"
+          f"{'old MB':>10}{'new MB':>10}")
+    for name, new_result in new["results"].items():
+        old_result = old.get("results", {}).get(name)
+        if old_result is None or "error" in old_result or "error" in new_result:
+            continue
+        ratio = new_result["median_s"] / max(old_result["median_s"], 1e-9)
+        print(f"{name:<24}{old_result['median_s']:>10.3f}"
+              f"{new_result['median_s']:>10.3f}{ratio:>8.2f}"
+              f"{old_result['peak_traced_memory_bytes'] / 1e6:>10.1f}"
+              f"{new_result['peak_traced_memory_bytes'] / 1e6:>10.1f}")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Run the Beiwe helper benchmarks")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS),
+                        help="Run only these benchmarks")
+    parser.add_argument("--output", default=None,
+                        help="JSON file to write results to")
+    parser.add_argument("--compare", default=None,
+                        help="Earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    names = args.only or list(BENCHMARKS)
+    size = SIZES[args.size]
+    results = dict()
+    for name in names:
+        print(f"Running {name}...", flush=True)
+        try:
+            results[name] = run_benchmark(name, size, args.repeats)
+        except Exception as e:  # keep going so one failure doesn't hide the rest
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"  failed: {results[name]['error']}")
+            continue
+        print(f"  median {results[name]['median_s']:.3f} s, peak "
+              f"{results[name]['peak_traced_memory_bytes'] / 1e6:.1f} MB")
+
+    output = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "size": args.size,
+        "parameters": size,
+        "repeats": args.repeats,
+        "environment": environment_info(),
+        "results": results
+    }
+    output_path = args.output or os.path.join(
+        BENCHMARK_DIR, "results",
+        f"benchmarks_{args.size}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {output_path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
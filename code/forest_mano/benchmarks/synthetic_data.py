@@ -0,0 +1,254 @@
+"""Synthetic Beiwe data for benchmarks
+
+Generates data shaped like what the server and Forest produce, so benchmarks
+can run without study data:
+
+* Tableau summary tables (participants x days x streams), with missing days
+  and a few rows dated 1969 like the real endpoint returns
+* Raw download folders using Beiwe's layout and filename conventions
+  (participant/stream/YYYY-MM-DD HH_MM_SS+00_00.csv)
+* Forest output folders with one summary csv per participant
+"""
+
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+
+SUMMARY_STREAMS = [
+    "accelerometer", "ambient_audio", "app_log", "audio_recordings",
+    "bluetooth", "calls", "devicemotion", "gps", "gyro", "identifiers",
+    "ios_log", "magnetometer", "power_state", "proximity", "reachability",
+    "survey_answers", "survey_timings", "texts", "wifi"
+]
+
+# Typical bytes per day of each stream for a participant who collects data
+TYPICAL_DAILY_BYTES = {
+    "accelerometer": 40e6, "gyro": 40e6, "magnetometer": 20e6,
+    "devicemotion": 30e6, "gps": 2e6, "wifi": 1e6, "bluetooth": 5e5,
+    "ambient_audio": 5e6, "audio_recordings": 5e5, "power_state": 2e4,
+    "app_log": 5e4, "ios_log": 5e4, "calls": 2e3, "texts": 5e3,
+    "identifiers": 5e2, "proximity": 1e4, "reachability": 2e3,
+    "survey_answers": 2e3, "survey_timings": 5e3
+}
+
+RAW_HEADERS = {
+    "accelerometer": "timestamp,UTC time,accuracy,x,y,z",
+    "gyro": "timestamp,UTC time,x,y,z",
+    "gps": "timestamp,UTC time,latitude,longitude,altitude,accuracy",
+    "power_state": "timestamp,UTC time,event",
+    "calls": "timestamp,UTC time,hashed phone number,call type,duration in seconds",
+    "texts": "timestamp,UTC time,hashed phone number,sent vs received,message length,time sent",
+    "survey_timings": ("timestamp,UTC time,question id,survey id,question type,"
+                       "question text,question answer options,answer,event"),
+    "survey_answers": ("question id,question type,question text,"
+                       "question answer options,answer")
+}
+
+
+def make_beiwe_ids(num_participants: int, seed: int = 0) -> list:
+    """Random 8-character lowercase IDs like the ones Beiwe assigns"""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase + string.digits))
+    return ["".join(rng.choice(letters, 8)) for _ in range(num_participants)]
+
+
+def make_summary_table(num_participants: int = 100, num_days: int = 180,
+                       streams: list = None, sparsity: float = 0.3,
+                       fraction_1969: float = 0.001,
+                       time_granularity: str = "daily",
+                       start_date: str = "2023-01-01",
+                       study_id: str = "a" * 24, seed: int = 0) -> pd.DataFrame:
+    """Make a table shaped like get_data_summaries output
+
+    Participants enroll on a random day in the first half of the window and
+    have rows from then on; a fraction of their days (or hours) have no data.
+
+    Args:
+        num_participants: Number of participants
+        num_days: Length of the study window in days
+        streams: Streams to include as beiwe_<stream>_bytes columns. Defaults
+            to every stream.
+        sparsity: Fraction of rows with no data for a stream
+        fraction_1969: Fraction of rows whose date is replaced with 1969-12-31
+        time_granularity: "daily" or "hourly". Hourly tables have a date
+            column holding the start of each hour.
+        start_date: First date of the window
+        study_id: Value for the study_id column
+        seed: Random seed
+
+    Returns:
+        Dataframe with participant_id, study_id, date and byte columns
+    """
+    if streams is None:
+        streams = SUMMARY_STREAMS
+    rng = np.random.default_rng(seed)
+    periods_per_day = 24 if time_granularity == "hourly" else 1
+    num_periods = num_days * periods_per_day
+    enroll_periods = rng.integers(0, max(num_periods // 2, 1), num_participants)
+    periods_enrolled = num_periods - enroll_periods
+    participant_index = np.repeat(np.arange(num_participants), periods_enrolled)
+    period_index = (np.concatenate([np.arange(n) for n in periods_enrolled])
+                    + np.repeat(enroll_periods, periods_enrolled))
+    freq = "h" if time_granularity == "hourly" else "D"
+    dates = pd.date_range(start_date, periods=num_periods, freq=freq)[period_index]
+    if time_granularity == "hourly":
+        date_strings = dates.strftime("%Y-%m-%dT%H:%M:%S")
+    else:
+        date_strings = dates.strftime("%Y-%m-%d")
+    date_strings = np.asarray(date_strings, dtype=object)
+    is_1969 = rng.random(len(date_strings)) < fraction_1969
+    date_strings[is_1969] = "1969-12-31"
+
+    beiwe_ids = np.array(make_beiwe_ids(num_participants, seed))
+    summaries_df = pd.DataFrame({
+        "participant_id": beiwe_ids[participant_index],
+        "study_id": study_id,
+        "date": date_strings
+    })
+    for stream in streams:
+        typical = TYPICAL_DAILY_BYTES.get(stream, 1e4) / periods_per_day
+        volume = rng.gamma(2.0, typical / 2.0, len(summaries_df)).round()
+        volume[rng.random(len(summaries_df)) < sparsity] = 0
+        summaries_df["beiwe_" + stream + "_bytes"] = volume
+    return summaries_df
+
+
+def _raw_rows(stream: str, hour_start: pd.Timestamp, num_rows: int,
+              rng: np.random.Generator) -> str:
+    """Body of one raw data file"""
+    offsets_ms = np.sort(rng.integers(0, 3600 * 1000, num_rows))
+    timestamps = int(hour_start.timestamp() * 1000) + offsets_ms
+    utc_times = (hour_start + pd.to_timedelta(offsets_ms, unit="ms")).strftime(
+        "%Y-%m-%dT%H:%M:%S.%f").str[:-3]
+    if stream == "gps":
+        columns = [timestamps, utc_times,
+                   (42.36 + rng.normal(0, 0.01, num_rows)).round(6),
+                   (-71.06 + rng.normal(0, 0.01, num_rows)).round(6),
+                   rng.normal(20, 5, num_rows).round(1),
+                   rng.uniform(5, 50, num_rows).round(1)]
+    elif stream in ("accelerometer", "gyro"):
+        axes = [rng.normal(0, 1, num_rows).round(5) for _ in range(3)]
+        if stream == "accelerometer":
+            columns = [timestamps, utc_times, ["unknown"] * num_rows] + axes
+        else:
+            columns = [timestamps, utc_times] + axes
+    else:
+        columns = [timestamps, utc_times] + [
+            ["x"] * num_rows
+            for _ in range(len(RAW_HEADERS.get(stream, "a,b,c").split(",")) - 2)
+        ]
+    return "\n".join(",".join(str(value) for value in row)
+                     for row in zip(*columns))
+
+
+def _survey_timings_rows(submitted: pd.Timestamp, survey_id: str,
+                         num_questions: int = 3) -> str:
+    """Body of one survey timings file ending in a submission event"""
+    rows = []
+    for i in range(num_questions + 1):
+        event_time = submitted - pd.Timedelta(seconds=20 * (num_questions - i))
+        timestamp = int(event_time.timestamp() * 1000)
+        utc_time = event_time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        if i < num_questions:
+            rows.append(f"{timestamp},{utc_time},q{i + 1},{survey_id},"
+                        f"radio_button,Question,[Yes; No],Yes,changed")
+        else:
+            rows.append(f"{timestamp},{utc_time},,{survey_id},,,,,submitted")
+    return "\n".join(rows)
+
+
+def make_raw_download_tree(root: str, num_participants: int = 5,
+                           num_days: int = 7,
+                           streams: list = None,
+                           hours_per_day: int = 24, rows_per_file: int = 100,
+                           survey_ids: list = None,
+                           start_date: str = "2023-01-01",
+                           seed: int = 0) -> list:
+    """Write a folder shaped like download_data output
+
+    Args:
+        root: Folder to write to
+        num_participants: Number of participant folders
+        num_days: Number of days of hourly files per stream
+        streams: Streams to write. Survey streams are written in one
+            subfolder per survey ID. Defaults to accelerometer, gps,
+            survey_timings and survey_answers.
+        hours_per_day: Number of hourly files per day for sensor streams
+        rows_per_file: Rows per sensor file
+        survey_ids: Survey IDs for survey streams; one submission per survey
+            per day. Defaults to one random survey.
+        start_date: First date of data
+        seed: Random seed
+
+    Returns:
+        List of participant IDs written
+    """
+    if streams is None:
+        streams = ["accelerometer", "gps", "survey_timings", "survey_answers"]
+    if survey_ids is None:
+        survey_ids = ["".join(make_beiwe_ids(3, seed + 1))]
+    rng = np.random.default_rng(seed)
+    beiwe_ids = make_beiwe_ids(num_participants, seed)
+    days = pd.date_range(start_date, periods=num_days, freq="D")
+    for beiwe_id in beiwe_ids:
+        # answers and timings share submission times so survey QC matches them
+        submissions = {
+            survey_id: [day + pd.Timedelta(seconds=int(second)) for day, second
+                        in zip(days, rng.integers(8 * 3600, 22 * 3600, num_days))]
+            for survey_id in survey_ids
+        }
+        for stream in streams:
+            if stream in ("survey_timings", "survey_answers"):
+                for survey_id in survey_ids:
+                    folder = os.path.join(root, beiwe_id, stream, survey_id)
+                    os.makedirs(folder, exist_ok=True)
+                    for submitted in submissions[survey_id]:
+                        filename = submitted.strftime("%Y-%m-%d %H_%M_%S") + "+00_00.csv"
+                        if stream == "survey_answers":
+                            body = "q1,radio_button,Question,[Yes; No],Yes"
+                        else:
+                            body = _survey_timings_rows(submitted, survey_id)
+                        with open(os.path.join(folder, filename), "w") as f:
+                            f.write(RAW_HEADERS[stream] + "\n" + body + "\n")
+                continue
+            folder = os.path.join(root, beiwe_id, stream)
+            os.makedirs(folder, exist_ok=True)
+            for day in days:
+                for hour in range(hours_per_day):
+                    hour_start = day + pd.Timedelta(hours=hour)
+                    filename = hour_start.strftime("%Y-%m-%d %H_%M_%S") + "+00_00.csv"
+                    body = _raw_rows(stream, hour_start, rows_per_file, rng)
+                    with open(os.path.join(folder, filename), "w") as f:
+                        f.write(RAW_HEADERS.get(stream, "timestamp,UTC time,value")
+                                + "\n" + body + "\n")
+    return beiwe_ids
+
+
+def make_forest_output_folder(root: str, num_participants: int = 100,
+                              num_days: int = 180, num_columns: int = 20,
+                              start_date: str = "2023-01-01",
+                              seed: int = 0) -> list:
+    """Write a folder of per-participant daily Forest summaries
+
+    The files look like jasmine's daily output (year, month, day, then
+    numeric summary columns) and are what concatenate_folder reads.
+
+    Returns:
+        List of participant IDs written
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+    beiwe_ids = make_beiwe_ids(num_participants, seed)
+    days = pd.date_range(start_date, periods=num_days, freq="D")
+    for beiwe_id in beiwe_ids:
+        summary_df = pd.DataFrame({"year": days.year, "month": days.month,
+                                   "day": days.day})
+        for i in range(num_columns):
+            values = rng.gamma(2.0, 10.0, num_days).round(3)
+            values[rng.random(num_days) < 0.2] = np.nan
+            summary_df[f"metric_{i}"] = values
+        summary_df.to_csv(os.path.join(root, beiwe_id + ".csv"), index=False)
+    return beiwe_ids
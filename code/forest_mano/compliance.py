@@ -0,0 +1,371 @@
+"""Passive data compliance over rolling windows
+
+For every participant and day, counts how many of the last N days had any
+data for each beiwe_*_bytes stream in a data volume summary table (the
+output of data_summaries.get_data_summaries), and flags participants whose
+coverage falls below a threshold. This is the importable version of the
+checks in Passive data checking.ipynb.
+
+The summaries are scattered into a dense participant x day x stream array
+once, and every window is then read off a cumulative sum along the day axis,
+so the cost does not depend on the window length. Tables from several
+studies can be checked together; participants are keyed by
+(study_id, participant_id).
+
+Example:
+    summaries_df = load_summaries(["study_a.csv", "study_b.csv"])
+    coverage_df = latest_compliance(summaries_df, window_days=7)
+    flagged_df = flag_low_compliance(coverage_df, {"gps": 0.5,
+                                                   "accelerometer": 0.5})
+"""
+
+import argparse
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+STREAM_COLUMN_PATTERN = re.compile(r"^beiwe_(.+)_bytes$")
+
+# Beiwe's summary endpoint returns a few rows dated 1969-12-31
+EARLIEST_VALID_DATE = pd.Timestamp("2010-01-01")
+
+
+def stream_columns(summaries_df: pd.DataFrame) -> dict:
+    """Map stream names to their beiwe_<stream>_bytes columns"""
+    streams = dict()
+    for column in summaries_df.columns:
+        match = STREAM_COLUMN_PATTERN.match(column)
+        if match:
+            streams[match.group(1)] = column
+    return streams
+
+
+def normalize_dates(dates: pd.Series) -> pd.Series:
+    """Parse summary dates to naive local calendar days
+
+    Dates may be plain "YYYY-MM-DD" strings, hourly timestamps, or
+    timezone-aware timestamps; in every case the local calendar day is the
+    first ten characters, which is much faster to parse than the full string.
+    Dates that can't be parsed, or that are before EARLIEST_VALID_DATE, become
+    NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        days = dates.dt.normalize()
+    else:
+        days = pd.to_datetime(dates.astype(str).str[:10], format="%Y-%m-%d",
+                              errors="coerce")
+    return days.where(days >= EARLIEST_VALID_DATE)
+
+
+def load_summaries(paths: list, study_ids: list = None,
+                   participant_ids: list = None) -> pd.DataFrame:
+    """Read and combine data volume summary csv files
+
+    Only the id, date and beiwe_*_bytes columns are kept. Byte columns are
+    read as float32 and invalid values become 0.
+
+    Args:
+        paths: Paths to csv files written by get_data_summaries. A single
+            path is also accepted.
+        study_ids: If given, keep only these studies
+        participant_ids: If given, keep only these participants
+
+    Returns:
+        Combined dataframe with a parsed date column
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    frames = []
+    for path in paths:
+        header = pd.read_csv(path, nrows=0).columns
+        byte_columns = [c for c in header if STREAM_COLUMN_PATTERN.match(c)]
+        usecols = [c for c in ["study_id", "participant_id", "date"]
+                   if c in header] + byte_columns
+        summaries_df = pd.read_csv(
+            path, usecols=usecols,
+            dtype={"study_id": str, "participant_id": str, "date": str}
+        )
+        for column in byte_columns:
+            summaries_df[column] = pd.to_numeric(
+                summaries_df[column], errors="coerce"
+            ).fillna(0).astype(np.float32)
+        frames.append(summaries_df)
+    summaries_df = pd.concat(frames, ignore_index=True)
+    if study_ids is not None:
+        summaries_df = summaries_df.loc[summaries_df["study_id"].isin(study_ids)]
+    if participant_ids is not None:
+        summaries_df = summaries_df.loc[
+            summaries_df["participant_id"].isin(participant_ids)
+        ]
+    summaries_df = summaries_df.assign(date=normalize_dates(summaries_df["date"]))
+    return summaries_df.dropna(subset=["date"]).reset_index(drop=True)
+
+
+def build_presence_matrix(summaries_df: pd.DataFrame, streams: list = None,
+                          start_date: str = None,
+                          end_date: str = None) -> tuple:
+    """Scatter a summary table into a participant x day x stream array
+
+    Rows for the same participant and day (for example hourly rows) are
+    summed before testing for data.
+
+    Args:
+        summaries_df: Data volume summaries with participant_id, date, and
+            beiwe_*_bytes columns, and optionally study_id
+        streams: Streams to include. Defaults to every beiwe_*_bytes column.
+        start_date: First day of the matrix. Defaults to the earliest date.
+        end_date: Last day of the matrix, inclusive. Defaults to the latest
+            date.
+
+    Returns:
+        (presence, participants, days, streams), where presence is a boolean
+        array of shape (participants, days, streams) that is True when the
+        stream had data that day, participants is a MultiIndex of
+        (study_id, participant_id), and days is a DatetimeIndex
+    """
+    columns = stream_columns(summaries_df)
+    if streams is None:
+        streams = list(columns)
+    missing = [s for s in streams if s not in columns]
+    if missing:
+        raise ValueError(f"No beiwe_<stream>_bytes column for {missing}")
+
+    days = normalize_dates(summaries_df["date"])
+    valid = days.notna().to_numpy()
+    first_day = pd.Timestamp(start_date) if start_date else days.min()
+    last_day = pd.Timestamp(end_date) if end_date else days.max()
+    day_index = pd.date_range(first_day, last_day, freq="D")
+
+    if "study_id" in summaries_df.columns:
+        study_ids = summaries_df["study_id"].astype(str)
+    else:
+        study_ids = pd.Series("", index=summaries_df.index)
+    groups = pd.DataFrame({
+        "study_id": study_ids,
+        "participant_id": summaries_df["participant_id"].astype(str)
+    }).groupby(["study_id", "participant_id"], sort=True)
+    participant_codes = groups.ngroup().to_numpy()
+    participants = groups.size().index
+
+    offsets = ((days - first_day) // pd.Timedelta(days=1)).to_numpy(
+        dtype=float, na_value=-1)
+    in_range = valid & (offsets >= 0) & (offsets < len(day_index))
+    rows = participant_codes[in_range]
+    cols = offsets[in_range].astype(np.int64)
+    volume = summaries_df[[columns[s] for s in streams]].to_numpy(
+        dtype=np.float64, na_value=0)[in_range]
+
+    # bincount on flat cell numbers is much faster than np.add.at
+    cells = rows * len(day_index) + cols
+    num_cells = len(participants) * len(day_index)
+    presence = np.empty((num_cells, len(streams)), dtype=bool)
+    for i in range(len(streams)):
+        presence[:, i] = np.bincount(cells, weights=volume[:, i],
+                                     minlength=num_cells) > 0
+    presence = presence.reshape(len(participants), len(day_index), len(streams))
+    return presence, participants, day_index, streams
+
+
+def rolling_coverage(presence: np.ndarray, window_days: int,
+                     enrollment_days: np.ndarray = None) -> np.ndarray:
+    """Fraction of the trailing window with data, for every day
+
+    Args:
+        presence: Boolean (participants, days, streams) array from
+            build_presence_matrix
+        window_days: Window length in days, including the current day
+        enrollment_days: Optional integer array with, for each participant,
+            the index of their first day in the study. Days before it are not
+            counted against them, so a participant who enrolled three days
+            ago is judged on three days, not the full window. Pass None to
+            always divide by the full window.
+
+    Returns:
+        Float32 array the shape of presence with coverage between 0 and 1.
+        Days before a participant's enrollment are NaN.
+    """
+    if window_days < 1:
+        raise ValueError("window_days must be at least 1")
+    num_days = presence.shape[1]
+    cumulative = np.zeros((presence.shape[0], num_days + 1, presence.shape[2]),
+                          dtype=np.int32)
+    np.cumsum(presence, axis=1, out=cumulative[:, 1:])
+    day = np.arange(num_days)
+    window_start = np.maximum(day + 1 - window_days, 0)
+    days_with_data = cumulative[:, day + 1] - cumulative[:, window_start]
+
+    if enrollment_days is None:
+        denominator = np.broadcast_to(
+            np.minimum(day + 1, window_days)[None, :], presence.shape[:2]
+        )
+    else:
+        enrollment_days = np.asarray(enrollment_days)[:, None]
+        denominator = np.minimum(day[None, :] - enrollment_days + 1, window_days)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coverage = days_with_data / denominator[:, :, None]
+    coverage[denominator < 1] = np.nan
+    return coverage.astype(np.float32)
+
+
+def first_data_days(presence: np.ndarray) -> np.ndarray:
+    """Index of each participant's first day with data in any stream, which
+    is used as their enrollment day. Participants without data get 0."""
+    any_stream = presence.any(axis=2)
+    return np.where(any_stream.any(axis=1), any_stream.argmax(axis=1), 0)
+
+
+def rolling_compliance(summaries_df: pd.DataFrame, window_days: int = 7,
+                       streams: list = None, start_date: str = None,
+                       end_date: str = None,
+                       from_first_data: bool = True) -> pd.DataFrame:
+    """Rolling coverage for every participant, day and stream
+
+    Args:
+        summaries_df: Data volume summaries for one or more studies
+        window_days: Window length in days, including the current day
+        streams: Streams to include. Defaults to every beiwe_*_bytes column.
+        start_date: First day to report. Data before it is not counted.
+        end_date: Last day to report, inclusive
+        from_first_data: If True, windows that start before a participant's
+            first day with data only count the days since then
+
+    Returns:
+        Dataframe indexed by (study_id, participant_id, date) with one
+        float32 coverage column per stream. Days before a participant's
+        first data are dropped when from_first_data is True.
+    """
+    presence, participants, days, streams = build_presence_matrix(
+        summaries_df, streams, start_date, end_date
+    )
+    enrollment_days = first_data_days(presence) if from_first_data else None
+    coverage = rolling_coverage(presence, window_days, enrollment_days)
+    index = pd.MultiIndex.from_arrays(
+        [participants.get_level_values(0).repeat(len(days)),
+         participants.get_level_values(1).repeat(len(days)),
+         np.tile(days, len(participants))],
+        names=["study_id", "participant_id", "date"]
+    )
+    coverage_df = pd.DataFrame(coverage.reshape(-1, len(streams)),
+                               index=index, columns=streams)
+    return coverage_df.dropna(how="all")
+
+
+def latest_compliance(summaries_df: pd.DataFrame, window_days: int = 7,
+                      streams: list = None, end_date: str = None,
+                      from_first_data: bool = True) -> pd.DataFrame:
+    """Coverage of the window ending on end_date for every participant
+
+    This is the check to run on a schedule. Only the days needed for the
+    window are scattered into the matrix.
+
+    Args:
+        summaries_df: Data volume summaries for one or more studies
+        window_days: Window length in days, including end_date
+        streams: Streams to include. Defaults to every beiwe_*_bytes column.
+        end_date: Last day of the window. Defaults to the latest date in the
+            table. To leave out a partial current day, pass yesterday's date.
+        from_first_data: If True, participants who first had data partway
+            through the window are judged only on the days since then.
+            Participants with no data in the window are always judged on the
+            full window.
+
+    Returns:
+        Dataframe indexed by (study_id, participant_id) with one coverage
+        column per stream and a days_in_window column
+    """
+    days = normalize_dates(summaries_df["date"])
+    end_day = pd.Timestamp(end_date) if end_date else days.max()
+    # Look back one extra window so first data days before the window are
+    # seen and don't count as enrollment
+    start_day = end_day - pd.Timedelta(days=2 * window_days - 1)
+    presence, participants, _, streams = build_presence_matrix(
+        summaries_df, streams, start_day, end_day
+    )
+    if from_first_data:
+        enrollment_days = first_data_days(presence)
+    else:
+        enrollment_days = None
+    window = presence[:, -window_days:]
+    if enrollment_days is not None:
+        enrollment_days = np.maximum(enrollment_days - window_days, 0)
+    days_with_data = window.sum(axis=1)
+    if enrollment_days is None:
+        days_in_window = np.full(len(participants), window_days)
+    else:
+        days_in_window = window_days - enrollment_days
+    coverage_df = pd.DataFrame(
+        (days_with_data / days_in_window[:, None]).astype(np.float32),
+        index=participants, columns=streams
+    )
+    coverage_df["days_in_window"] = days_in_window
+    return coverage_df
+
+
+def flag_low_compliance(coverage_df: pd.DataFrame, thresholds) -> pd.DataFrame:
+    """Find participants whose coverage is below a threshold
+
+    Args:
+        coverage_df: Output of latest_compliance or rolling_compliance
+        thresholds: A single minimum coverage applied to every stream, or a
+            dict mapping streams to their minimum coverage. With a dict, only
+            the streams it names are checked.
+
+    Returns:
+        Long dataframe with one row per participant (and date, for rolling
+        input) and stream below its threshold, with coverage and threshold
+        columns
+    """
+    if not isinstance(thresholds, dict):
+        thresholds = {stream: thresholds for stream in coverage_df.columns
+                      if stream != "days_in_window"}
+    missing = [s for s in thresholds if s not in coverage_df.columns]
+    if missing:
+        raise ValueError(f"No coverage column for {missing}")
+    streams = list(thresholds)
+    limits = np.array([thresholds[s] for s in streams], dtype=np.float32)
+    below = coverage_df[streams].to_numpy() < limits
+    row_idx, stream_idx = np.nonzero(below)
+    flagged_df = coverage_df.index[row_idx].to_frame(index=False)
+    flagged_df["stream"] = np.array(streams)[stream_idx]
+    flagged_df["coverage"] = coverage_df[streams].to_numpy()[row_idx, stream_idx]
+    flagged_df["threshold"] = limits[stream_idx]
+    return flagged_df
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Report participants with low passive data coverage"
+    )
+    parser.add_argument("summaries", nargs="+",
+                        help="Data volume csv files from get_data_summaries")
+    parser.add_argument("--window-days", type=int, default=7)
+    parser.add_argument("--end-date", default=None,
+                        help="Last day of the window (default: latest date)")
+    parser.add_argument("--streams", nargs="+", default=["accelerometer", "gps"])
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--output", default=None,
+                        help="CSV to write flagged participants to")
+    args = parser.parse_args(argv)
+
+    summaries_df = load_summaries(args.summaries)
+    coverage_df = latest_compliance(summaries_df, args.window_days,
+                                    args.streams, args.end_date)
+    flagged_df = flag_low_compliance(coverage_df, args.threshold)
+    if args.output:
+        flagged_df.to_csv(args.output, index=False)
+    logger.info("%d of %d participants below %.0f%% coverage",
+                flagged_df[["study_id", "participant_id"]].drop_duplicates().shape[0],
+                len(coverage_df), 100 * args.threshold)
+    print(flagged_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
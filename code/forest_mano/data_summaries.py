@@ -1,18 +1,20 @@
 """User-friendly functions for either using mano to download data or download
  Beiwe summary statistics from the Tableau endpoint"""
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from getpass import getpass
+import importlib.util
+import io
+import json
 import logging
-import requests
 import os
 import sys
-import cryptease
-import mano
-import pandas as pd
-import numpy as np
-import importlib
-import matplotlib.pyplot as plt
-from mano.sync import BACKFILL_START_DATE
+from instrumentation import stage_timer, timed
+from scheduler import INTERACTIVE, scheduler_slot
+
+# pandas, numpy, matplotlib, cryptease, mano and requests are imported where
+# they are used, so importing this module (e.g. only to read a keyring) stays
+# fast; see benchmarks/bench_import_time.py
 
 
 logger = logging.getLogger(__name__)
@@ -22,6 +24,20 @@ DATA_STREAMS_WITH_FOREST_TREES = [
     "survey_timings", "audio_recordings"
 ]
 
+# Time bins data volume plots can be drawn at. "column" names the x axis
+# when plotting by date and "study_column" when plotting by study time.
+TIME_BINS = {
+    "hour": {"width": timedelta(hours=1), "unit": "hour", "units": "hours",
+             "column": "hour", "study_column": "hours_since_start"},
+    "6h": {"width": timedelta(hours=6), "unit": "6-hour period",
+           "units": "6-hour periods", "column": "6h_period",
+           "study_column": "6h_periods_since_start"},
+    "day": {"width": timedelta(days=1), "unit": "day", "units": "days",
+            "column": "date", "study_column": "days_since_start"},
+    "week": {"width": timedelta(weeks=1), "unit": "week", "units": "weeks",
+             "column": "week", "study_column": "weeks_since_start"}
+}
+
 KEYRING_FIELDS = ["URL", "USERNAME", "PASSWORD", "ACCESS_KEY", "SECRET_KEY",
                   "TABLEAU_ACCESS_KEY", "TABLEAU_SECRET_KEY"]
 
@@ -73,6 +89,7 @@ def import_python_file(filepath:str) -> dict:
     module = importlib.util.module_from_spec(spec)
     sys.modules[spec.name] = module
     spec.loader.exec_module(module)
+    import mano
     kr = mano.keyring(None)
     for var in ['TABLEAU_ACCESS_KEY', 'TABLEAU_SECRET_KEY']:
         if var in os.environ.keys():
@@ -123,6 +140,7 @@ def write_keyring(
 """
     input_dict = validate_keyring(input_dict)
     if encrypt_file:
+        import cryptease
         json_obj_bytes = bytes(json.dumps(input_dict, indent=3), 'utf-8')
         if passphrase is None:
             passphrase = getpass("Enter password to encrypt " + filepath + ":")
@@ -153,6 +171,7 @@ def read_keyring(filepath: str,
             output_dict = json.load(f)
     except UnicodeDecodeError:  # the file must be decrypted
         logger.info("File is encrypted, reading with encryption...")
+        import cryptease
         if passphrase is None:
             passphrase = getpass("Enter password to decrypt " + filepath + ":")
         try:
@@ -179,8 +198,10 @@ def get_data_summaries(
         start_date: str = None,
         end_date: str = None,
         fields: list = None,
-        limit: int = None
-) -> pd.DataFrame:
+        limit: int = None,
+        registry=None,
+        scheduler=None
+) -> "pd.DataFrame":
     """
     Get Tableau data summaries from Beiwe website.
 
@@ -202,11 +223,19 @@ def get_data_summaries(
         end_date: The last date you want summaries for, in YYYY-MM-DD format. Enter None to pull all available summaries
         fields: The list of summary statistics you would like to pull. Enter None to pull all available summaries. A list of available summary statistics is at https://github.com/onnela-lab/beiwe-backend/wiki/Tableau-API. 
         limit: An integer corresponding to the number of rows you want to pull (for example, put 100 to pull the first 100 rows). Enter None to pull all available rows.
+        registry: A participant_registry.ParticipantRegistry. If given, rows
+            for retired and unregistered participants are dropped.
+        scheduler: A scheduler.RequestScheduler shared with other jobs using
+            the server. Summaries are fetched with interactive priority, so
+            they go ahead of bulk raw data downloads.
         
 
     Returns:
         Dataframe with Beiwe summary statistics pulled from the server
     """
+    import pandas as pd
+    import requests
+
     if keyring is None:
         if keyring_filepath is None:
             logger.error("Unable to get data summaries. "
@@ -265,11 +294,20 @@ def get_data_summaries(
         }
 
         logger.info('Extracting data from server')
-        response = requests.get(
-            url,
-            headers=headers)
-        logger.info('Converting data to DataFrame')
-        summaries_df = pd.DataFrame.from_dict(response.json())
+        with stage_timer("get_data_summaries", study_id=study_id,
+                         time_granularity=time_granularity) as timer:
+            with scheduler_slot(scheduler, INTERACTIVE) as slot:
+                response = requests.get(
+                    url,
+                    headers=headers)
+                slot.record_response(response)
+                slot.add_bytes(len(response.content))
+            timer.add_bytes(len(response.content))
+            logger.info('Converting data to DataFrame')
+            summaries_df = pd.DataFrame.from_dict(response.json())
+            if registry is not None and "participant_id" in summaries_df:
+                summaries_df = registry.filter_frame(summaries_df, study_id)
+            timer.add_count("rows", summaries_df.shape[0])
         logger.info('Writing CSV file')
         summaries_df.to_csv(output_file_path, index = False)
         summaries_downloaded = True
@@ -298,6 +336,7 @@ def ensure_time_coverage(summaries_df, time_column):
             plot_heatmap
         time_column: The column indicating date.
         """
+    import pandas as pd
     lines_to_add = []
     max_date = summaries_df[time_column].max()
     min_date = summaries_df[time_column].min()
@@ -328,7 +367,124 @@ def ensure_time_coverage(summaries_df, time_column):
 
     return summaries_df
 
-def plot_heatmap(input_summaries_df: pd.DataFrame,
+
+def summary_byte_columns(summaries_df: "pd.DataFrame",
+                         data_streams: list = None) -> list:
+    """The beiwe_<stream>_bytes columns of a summaries table, optionally
+    limited to some streams"""
+    if data_streams is None:
+        return [col for col in summaries_df.columns
+                if col.startswith("beiwe_") and col.endswith("_bytes")]
+    return [f"beiwe_{stream}_bytes" for stream in data_streams
+            if f"beiwe_{stream}_bytes" in summaries_df.columns]
+
+
+def normalize_summaries(summaries_df: "pd.DataFrame",
+                        data_streams: list = None) -> "pd.DataFrame":
+    """Cast a data volume summaries table to compact dtypes for plotting
+
+    Rows dated on or before BACKFILL_START_DATE (Beiwe reports some data in
+    1969) are dropped. The result has:
+        participant_id (and study_id, if present): category
+        date: datetime64[s] holding the start of the row's day or hour
+            (pandas has no day resolution, so this is the closest to
+            datetime64[D])
+        days_since_start: int16 days since the participant's first row
+        any_survey_submission: bool, any survey answers or audio recordings
+        beiwe_<stream>_bytes: uint32, or uint64 if a count doesn't fit,
+            with missing values as 0
+    A 5 million row hourly table with four streams takes about 150 MB, down
+    from about 530 MB as read by pandas.read_csv.
+
+    Args:
+        summaries_df: Data volume summaries from get_data_summaries
+        data_streams: Streams whose byte columns to keep. Defaults to every
+            beiwe_<stream>_bytes column.
+
+    Returns:
+        A new dataframe; summaries_df is not modified
+    """
+    import numpy as np
+    import pandas as pd
+    from mano.sync import BACKFILL_START_DATE
+
+    dates = pd.to_datetime(summaries_df["date"], format="ISO8601",
+                           errors="coerce", utc=True).dt.tz_localize(None)
+    keep = (dates > pd.Timestamp(BACKFILL_START_DATE)).to_numpy()
+    # Columns are built from arrays so the result gets a RangeIndex
+    dates = dates[keep].astype("datetime64[s]").reset_index(drop=True)
+    participant_ids = pd.Series(
+        pd.Categorical(summaries_df["participant_id"].to_numpy()[keep])
+    )
+    normalized = {"participant_id": participant_ids}
+    if "study_id" in summaries_df.columns:
+        normalized["study_id"] = pd.Categorical(
+            summaries_df["study_id"].to_numpy()[keep])
+    normalized["date"] = dates
+    days = dates.dt.normalize()
+    first_days = days.groupby(participant_ids, observed=True).transform("min")
+    normalized["days_since_start"] = (
+        (days - first_days) // pd.Timedelta(days=1)
+    ).astype(np.int16)
+
+    any_survey = np.zeros(keep.sum(), dtype=bool)
+    for col in summary_byte_columns(summaries_df,
+                                    ["survey_answers", "audio_recordings"]):
+        any_survey |= pd.to_numeric(summaries_df[col],
+                                    errors="coerce").to_numpy()[keep] > 0
+    normalized["any_survey_submission"] = any_survey
+    for col in summary_byte_columns(summaries_df, data_streams):
+        volume = pd.to_numeric(summaries_df[col], errors="coerce").to_numpy(
+            dtype=np.float64, na_value=0)[keep]
+        volume = np.maximum(volume, 0).round()
+        dtype = np.uint64 if volume.size and volume.max() >= 2 ** 32 else np.uint32
+        normalized[col] = volume.astype(dtype)
+    return pd.DataFrame(normalized)
+
+def bin_summary_times(summaries_df: "pd.DataFrame", time_bin: str = "day",
+                      study_time: bool = True) -> tuple:
+    """Assign each summaries row to a time bin
+
+    Args:
+        summaries_df: Summaries from normalize_summaries, daily or hourly
+        time_bin: A key of TIME_BINS: "hour", "6h", "day" or "week"
+        study_time: Whether to count bins from the participant's first day
+            instead of binning by date
+
+    Returns:
+        (time_column, values): the name of the x axis (see TIME_BINS) and a
+        Series holding each row's bin, as the start of the bin or, for
+        study time, an integer number of bins since the start of the
+        participant's first day. Weeks start on Mondays.
+
+    Raises:
+        ValueError: If time_bin isn't one of TIME_BINS
+    """
+    import numpy as np
+    import pandas as pd
+    if time_bin not in TIME_BINS:
+        raise ValueError(f"time_bin must be one of {list(TIME_BINS)}, "
+                         f"not {time_bin!r}")
+    bin_info = TIME_BINS[time_bin]
+    if study_time and time_bin == "day" and "days_since_start" in summaries_df:
+        return bin_info["study_column"], summaries_df["days_since_start"]
+    dates = pd.to_datetime(summaries_df["date"])
+    if study_time:
+        days = dates.dt.normalize()
+        first_days = days.groupby(summaries_df["participant_id"],
+                                  observed=True).transform("min")
+        values = ((dates - first_days) // bin_info["width"]).astype(np.int32)
+        return bin_info["study_column"], values
+    if time_bin == "week":
+        values = dates.dt.normalize() - pd.to_timedelta(dates.dt.dayofweek,
+                                                         unit="D")
+    else:
+        values = dates.dt.floor(bin_info["width"])
+    return bin_info["column"], values
+
+
+@timed()
+def plot_heatmap(input_summaries_df: "pd.DataFrame",
                  stream_to_plot: str,
                  output_dir: str,
                  plot_study_time: bool,
@@ -336,7 +492,8 @@ def plot_heatmap(input_summaries_df: pd.DataFrame,
                  overlay_surveys: bool,
                  display_plots: bool,
                  max_ids_per_plot: int,
-                 include_y_labels: bool):
+                 include_y_labels: bool,
+                 time_bin: str = "day"):
     """Create a heatmap for a given data stream
     Args:
         input_summaries_df: A preprocessed input_summaries_df created during
@@ -356,79 +513,106 @@ def plot_heatmap(input_summaries_df: pd.DataFrame,
             summaries_df has more than this many Beiwe IDs, it will break
             the plot up
         include_y_labels: Whether to include y labels with participant IDs on the plot.
+        time_bin: Width of each heatmap cell: "hour", "6h", "day" or "week".
+            Finer bins than the summaries' granularity leave gaps.
 
     """
+    import numpy as np
+    import pandas as pd
 
     os.makedirs(output_dir, exist_ok = True)
 
-    summaries_df = input_summaries_df.copy()
-    # We want to plot the first column that matches our data stream.
-    col_to_plot = [col for col in summaries_df.columns
-                   if col.find(stream_to_plot) > 0][0]
-    if plot_study_time:
-        time_column = "days_since_start"
-    else:
-        time_column = "date"
+    # Work on column arrays rather than a copy of the whole table; the same
+    # summaries are passed in once per stream.
+    col_to_plot = f"beiwe_{stream_to_plot}_bytes"
+    if col_to_plot not in input_summaries_df.columns:
+        # We want to plot the first column that matches our data stream.
+        col_to_plot = [col for col in input_summaries_df.columns
+                       if col.find(stream_to_plot) > 0][0]
+    time_column, time_values = bin_summary_times(input_summaries_df, time_bin,
+                                                 plot_study_time)
+    bin_info = TIME_BINS[time_bin]
+    participant_ids = input_summaries_df["participant_id"]
 
     if overlay_surveys: # We need to get survey submissions before we filter
         # out unnecessary rows because some rows may have a survey submission
         # but no non-zero data volume value.
-        surveys_df = summaries_df.loc[
-            summaries_df["any_survey_submission"] > 0,
-            ["participant_id", time_column]
-        ].reset_index(drop = True)
+        has_survey = (input_summaries_df["any_survey_submission"] > 0
+                      ).to_numpy()
+        survey_ids = participant_ids.to_numpy()[has_survey]
+        survey_times = time_values.to_numpy()[has_survey]
 
     # We only want to show users for which there is at least one non-zero value
-    summaries_df = summaries_df.loc[summaries_df[col_to_plot] > 0]
-    if summaries_df.shape[0] == 0:
+    volume = input_summaries_df[col_to_plot].to_numpy()
+    has_data = volume > 0
+    if not has_data.any():
         logger.error("Error: No data volume of type %s found", stream_to_plot )
         return
 
-    summaries_df = ensure_time_coverage(summaries_df, time_column)
+    # Sum rows sharing a participant and time bin, then fill in bins without
+    # rows so every bin between the first and last has a column.
+    df_to_plot = pd.DataFrame({
+        "participant_id": participant_ids.to_numpy()[has_data],
+        time_column: time_values.to_numpy()[has_data],
+        "volume": volume[has_data].astype(np.float32)
+    }).groupby(["participant_id", time_column], observed=True, sort=True)[
+        "volume"
+    ].sum().unstack(fill_value=0)
+    df_to_plot.index = df_to_plot.index.astype(str)
+    if not plot_study_time:
+        time_range = pd.date_range(df_to_plot.columns.min(),
+                                   df_to_plot.columns.max(),
+                                   freq=bin_info["width"])
+    else:
+        time_range = range(int(df_to_plot.columns.min()),
+                           int(df_to_plot.columns.max()) + 1)
+    df_to_plot = df_to_plot.reindex(columns=time_range, fill_value=0)
     if binary_heatmap:
-        summaries_df[col_to_plot] = (
-                summaries_df[col_to_plot] > 0
-        ).astype(float)
+        df_to_plot = (df_to_plot > 0).astype(np.float32)
     else:  # otherwise, convert this to Megabytes
-        summaries_df[col_to_plot] = summaries_df[col_to_plot] / 1000000
-
-    df_to_plot = summaries_df.pivot(
-        index="participant_id", columns=time_column,
-        values=col_to_plot
-    ).fillna(0)
+        df_to_plot = df_to_plot / 1000000
 
-    df_to_plot["sums"] = df_to_plot.sum(axis=1)
-    df_to_plot.sort_values("sums", ascending=False, inplace=True)
+    sums = df_to_plot.sum(axis=1).sort_values(ascending=False)
+    df_to_plot = df_to_plot.loc[sums.index]
 
     if binary_heatmap:
-        volume_string = "days"
-        xlab_addition = ("\n\n Days in black indicate that a user collected "
-                         "some data that day.")
+        volume_string = bin_info["units"]
+        xlab_addition = (f"\n\n {bin_info['units'].capitalize()} in black "
+                         "indicate that a user collected some data that "
+                         f"{bin_info['unit']}.")
     else:
         volume_string = "MB"
-        xlab_addition = ("\n\n Days in darker shades of grey indicate that a"
-                         " user collected more data.")
+        xlab_addition = (f"\n\n {bin_info['units'].capitalize()} in darker "
+                         "shades of grey indicate that a user collected more "
+                         "data.")
 
     survey_y = []
     survey_x = []
     if overlay_surveys:  # in order to overlay the surveys on the heat map, we
         # have to figure out which list index corresponds to which value in
         # the surveys.
-        surveys_df = surveys_df.loc[
-            surveys_df["participant_id"].isin(df_to_plot.index) &
-            surveys_df[time_column].isin(df_to_plot.columns),:
-            ]
-        survey_y = [df_to_plot.index.tolist().index(participant_id)
-                    for participant_id in surveys_df["participant_id"]]
-        survey_x = [df_to_plot.columns.tolist().index(time_val)
-                    for time_val in surveys_df[time_column]]
+        survey_y = df_to_plot.index.get_indexer(survey_ids.astype(str))
+        survey_x = df_to_plot.columns.get_indexer(survey_times)
+        on_plot = (survey_y >= 0) & (survey_x >= 0)
+        # Hourly summaries have many submissions per cell; draw each once
+        cells = np.unique(survey_y[on_plot] * df_to_plot.shape[1]
+                          + survey_x[on_plot])
+        survey_y, survey_x = np.divmod(cells, df_to_plot.shape[1])
         xlab_addition += ("\nTurquoise dashes indicate that a survey "
-                          "was taken that day.")
+                          f"was taken that {bin_info['unit']}.")
+    if plot_study_time:
+        x_label = f"{bin_info['units'].capitalize()} Since Registration"
+    elif time_bin in ["day", "week"]:
+        x_label = "Date" if time_bin == "day" else "Week Starting"
+        df_to_plot.columns = df_to_plot.columns.date
+    else:
+        x_label = "Date and Hour"
+        df_to_plot.columns = df_to_plot.columns.strftime("%Y-%m-%d %H:00")
 
 
     y_label_df = pd.DataFrame(
         {"participant_id": df_to_plot.index,
-         "sums": df_to_plot["sums"]}
+         "sums": sums}
     )
     y_label_df["rank"] = y_label_df["sums"].rank(ascending=False)
 
@@ -444,7 +628,6 @@ def plot_heatmap(input_summaries_df: pd.DataFrame,
     # Change the index so that the added data will show up as y labels
     # in the plot.
     df_to_plot.index = y_label_df["left_axis"]
-    df_to_plot.drop("sums", axis=1, inplace=True)
     # Now, we need to automatically space X axis ticks.
     num_x_ticks = 10
     num_y_ticks = 5
@@ -500,19 +683,24 @@ def plot_heatmap(input_summaries_df: pd.DataFrame,
             create_save_plot(current_df,
                              current_x_axis, survey_x, survey_y, xlab_addition,
                              plot_study_time, display_plots, current_save_path,
-                             current_plot_title, include_y_labels, y_axis)
+                             current_plot_title, include_y_labels, y_axis,
+                             x_label)
     else:
         create_save_plot(df_to_plot, x_axis, survey_x, survey_y, xlab_addition,
                          plot_study_time, display_plots, save_path, plot_title,
-                         include_y_labels, y_axis)
+                         include_y_labels, y_axis, x_label)
 
 
 
 
 def create_save_plot(df_to_plot, x_axis, survey_x, survey_y,
                      xlab_addition, plot_study_time,display_plots,
-                     save_path, plot_title, include_y_labels, y_axis):
+                     save_path, plot_title, include_y_labels, y_axis,
+                     x_label=None):
     """Helper function used to create and save a plot"""
+    import numpy as np
+    import matplotlib.pyplot as plt
+
     if include_y_labels:
         plot_height = int(np.round(df_to_plot.shape[0] / 2)) #we need space for each label
     else:
@@ -531,7 +719,9 @@ def create_save_plot(df_to_plot, x_axis, survey_x, survey_y,
         plt.ylabel("Beiwe ID, rank, and total volume")
     else:
         plt.ylabel("Rank")
-    if plot_study_time:
+    if x_label is not None:
+        plt.xlabel(x_label + xlab_addition)
+    elif plot_study_time:
         plt.xlabel("Days Since Registration" + xlab_addition)
     else:
         plt.xlabel("Date" + xlab_addition)
@@ -553,6 +743,7 @@ def create_save_plot(df_to_plot, x_axis, survey_x, survey_y,
     plt.close()
 
 
+@timed()
 def data_volume_plots(
         data_summaries_path: str = None, output_dir: str = "data_volume_plots",
         display_plots: bool = True, data_streams_to_plot: list = None,
@@ -561,7 +752,10 @@ def data_volume_plots(
         binary_heatmap: bool = True, plot_study_time: bool = True,
         max_ids_per_plot: int = 1000,
         overlay_surveys: bool = False,
-        include_y_labels: bool = True
+        include_y_labels: bool = True,
+        registry=None,
+        time_bin: str = "day",
+        study_id: str = None
 ):
     """Create data volume summary plots for a study
 
@@ -603,56 +797,70 @@ def data_volume_plots(
             summaries_df has more than this many Beiwe IDs, it will break
             the plot up
         include_y_labels: whether to include Beiwe IDs as y labels in the plot
+        registry: A participant_registry.ParticipantRegistry. If given, only
+            participants it lists as active are plotted.
+        time_bin: Width of each heatmap cell: "hour", "6h", "day" or "week".
+            Summaries downloaded with time_granularity="hourly" can be
+            plotted at any of these; daily summaries at "day" or "week".
+        study_id: Study the summaries belong to, used with registry. If this
+            is None, each row's study is taken from the summaries' study_id
+            column.
+
+    Raises:
+        ValueError: If registry is given without study_id and the summaries
+            have no study_id column
     """
+    import numpy as np
+    import pandas as pd
+    if time_bin not in TIME_BINS:
+        raise ValueError(f"time_bin must be one of {list(TIME_BINS)}, "
+                         f"not {time_bin!r}")
+    if data_streams_to_plot is None:
+        data_streams_to_plot = DATA_STREAMS_WITH_FOREST_TREES
+    # Only read the columns that get plotted
+    needed_columns = {"participant_id", "study_id", "date"}.union(
+        f"beiwe_{stream}_bytes" for stream in
+        list(data_streams_to_plot) + ["survey_answers", "audio_recordings"]
+    )
+    summaries_df = pd.read_csv(data_summaries_path,
+                               usecols=lambda col: col in needed_columns)
+    if registry is not None:
+        if study_id is None and "study_id" not in summaries_df.columns:
+            raise ValueError(f"{data_summaries_path} has no study_id column; "
+                             "pass study_id to filter it with registry")
+        summaries_df = registry.filter_frame(summaries_df, study_id)
 
-    summaries_df = pd.read_csv(data_summaries_path)
-
-    
     if summaries_df.shape[0] == 0:
         logger.error("Error: No data volume summaries data found")
         return
-    if data_streams_to_plot is None:
-        data_streams_to_plot = DATA_STREAMS_WITH_FOREST_TREES
 
-
-    summaries_df.fillna(0, inplace = True)
-    summaries_df["date"] = pd.to_datetime(summaries_df["date"]).dt.date
-    # Some people have data volume days in 1969. We want to get rid of this
-    # so we don't screw up our plots.
-    summaries_df = summaries_df.loc[
-        summaries_df["date"] > pd.to_datetime(BACKFILL_START_DATE),:
-    ]
-    summaries_df["min_date"] = summaries_df.groupby("participant_id")[
-        "date"
-    ].transform("min")
-    summaries_df["days_since_start"] = (summaries_df["date"]
-                                        - summaries_df["min_date"]).dt.days
-    if overlay_surveys:
-        summaries_df["any_survey_submission"] = (
-            summaries_df["beiwe_survey_answers_bytes"] +
-            summaries_df["beiwe_audio_recordings_bytes"]
-        ) > 0
-    else:
-        summaries_df["any_survey_submission"] = 0
+    # Some people have data volume days in 1969. normalize_summaries gets rid
+    # of these so we don't screw up our plots.
+    summaries_df = normalize_summaries(summaries_df, data_streams_to_plot)
+    if not overlay_surveys:
+        summaries_df["any_survey_submission"] = False
+    keep = np.ones(summaries_df.shape[0], dtype=bool)
     if start_date is not None:
-        start_datetime = pd.to_datetime(start_date)
-        summaries_df = summaries_df.loc[summaries_df["date"] > start_datetime]
+        keep &= (summaries_df["date"] > pd.Timestamp(start_date)).to_numpy()
     if end_date is not None:
-        end_datetime = pd.to_datetime(end_date)
-        summaries_df = summaries_df.loc[summaries_df["date"] < end_datetime]
+        keep &= (summaries_df["date"] < pd.Timestamp(end_date)).to_numpy()
     if max_study_days is not None:
-        summaries_df = summaries_df.loc[
-            summaries_df["days_since_start"] <= max_study_days
-        ]
+        keep &= (summaries_df["days_since_start"] <= max_study_days).to_numpy()
     if users_to_include is not None:
-        summaries_df = summaries_df.loc[
-            summaries_df["participant_id"].isin(users_to_include),:
-        ]
+        keep &= summaries_df["participant_id"].isin(users_to_include).to_numpy()
+    if not keep.all():
+        summaries_df = summaries_df.loc[keep]
+    if (TIME_BINS[time_bin]["width"] < TIME_BINS["day"]["width"]
+            and (summaries_df["date"] == summaries_df["date"].dt.normalize()).all()):
+        logger.warning("Summaries look daily; plotting them in %s bins will "
+                       "leave gaps. Use summaries downloaded with "
+                       "time_granularity='hourly'.", time_bin)
 
     for stream_to_plot in data_streams_to_plot:
         plot_heatmap(summaries_df, stream_to_plot, output_dir,
                      plot_study_time, binary_heatmap, overlay_surveys,
-                     display_plots, max_ids_per_plot, include_y_labels)
+                     display_plots, max_ids_per_plot, include_y_labels,
+                     time_bin)
 
 
 def get_num_users(summaries_df=None, summaries_path=None, data_streams=None):
@@ -668,6 +876,7 @@ def get_num_users(summaries_df=None, summaries_path=None, data_streams=None):
         Dataframe with a row for each thing in data_streams and a column saying
         how many people have non-zero days.
      """
+    import pandas as pd
     if summaries_df is None and summaries_path is not None:
         summaries_df = pd.read_csv(summaries_path)
     else:
@@ -0,0 +1,205 @@
+"""Decide which participants are worth downloading before calling the server
+
+mano.users lists every participant in a study, including ones who never
+registered or were retired long ago, and each of them costs a full download
+request. plan_downloads joins the participant list against the participant
+table (registration status, registration and last upload dates) and,
+optionally, data volume summaries, and marks each participant as:
+
+    download  expected to have data in the window
+    defer     nothing says they can't have data, but nothing says they do
+              (for example, missing from the summaries); downloaded last
+    skip      can't have data in the window
+
+with the reason for the decision, so skipped participants can be reported.
+
+Example:
+    plan = plan_downloads(users, study_id, "2024-01-01", "2024-01-31",
+                          registry=ParticipantRegistry(keyring))
+    for participant_id in planned_users(plan):
+        ...
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from participant_registry import INACTIVE_STATUSES
+
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD = "download"
+DEFER = "defer"
+SKIP = "skip"
+
+# Uploads lag collection, so allow some slack before deciding a participant
+# had no uploads in the window
+UPLOAD_SLACK = pd.Timedelta(days=1)
+
+PLAN_COLUMNS = ["participant_id", "action", "reason", "status", "last_upload",
+                "expected_bytes"]
+
+
+def _timestamp(value) -> pd.Timestamp:
+    """Parse a window bound to a naive UTC timestamp, or None"""
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return timestamp
+
+
+def expected_bytes(summaries_df: pd.DataFrame, time_start=None, time_end=None,
+                   data_streams: list = None) -> pd.Series:
+    """Bytes each participant uploaded in a window, according to summaries
+
+    Args:
+        summaries_df: Data volume summaries from get_data_summaries
+        time_start: Start of the window; None for no lower bound
+        time_end: End of the window; None for no upper bound
+        data_streams: Streams to count. Defaults to every beiwe_*_bytes
+            column.
+
+    Returns:
+        Series of byte totals indexed by participant_id. Participants with
+        rows only outside the window get 0.
+    """
+    if data_streams:
+        columns = [f"beiwe_{stream}_bytes" for stream in data_streams
+                   if f"beiwe_{stream}_bytes" in summaries_df.columns]
+    else:
+        columns = [c for c in summaries_df.columns
+                   if c.startswith("beiwe_") and c.endswith("_bytes")]
+    dates = pd.to_datetime(summaries_df["date"].astype(str).str[:10],
+                           format="%Y-%m-%d", errors="coerce")
+    in_window = dates.notna()
+    start, end = _timestamp(time_start), _timestamp(time_end)
+    if start is not None:
+        in_window &= dates >= start.normalize()
+    if end is not None:
+        in_window &= dates <= end
+    volume = summaries_df[columns].apply(pd.to_numeric, errors="coerce").sum(
+        axis=1).where(in_window, 0)
+    return volume.groupby(summaries_df["participant_id"]).sum()
+
+
+def summaries_cover(summaries_df: pd.DataFrame, time_end=None) -> bool:
+    """Whether summaries are recent enough to show every upload up to
+    time_end (now if None), allowing UPLOAD_SLACK for uploads to arrive"""
+    end = _timestamp(time_end)
+    if end is None:
+        end = pd.Timestamp.now(tz="UTC").tz_localize(None)
+    dates = pd.to_datetime(summaries_df["date"].astype(str).str[:10],
+                           format="%Y-%m-%d", errors="coerce")
+    last_date = dates.max()
+    return pd.notna(last_date) and last_date >= end.normalize() + UPLOAD_SLACK
+
+
+def plan_downloads(users: list, study_id: str, time_start=None, time_end=None,
+                   registry=None, summaries_df: pd.DataFrame = None,
+                   data_streams: list = None,
+                   skip_statuses: list = INACTIVE_STATUSES) -> pd.DataFrame:
+    """Decide which participants to download and in what order
+
+    Participants are skipped, in order of precedence, when their status is in
+    skip_statuses, when they first registered after the window ends, when
+    their last upload was before the window starts, or when summaries show
+    no bytes for the requested streams in the window. Participants missing
+    from the participant table or the summaries are deferred, as are
+    participants with no bytes when the summaries don't yet cover the
+    window's end (see summaries_cover), e.g. in a daily incremental sync.
+
+    Args:
+        users: Participant IDs to consider, e.g. from mano.users
+        study_id: 24-character study ID
+        time_start: Start of the download window (UTC); None for no bound
+        time_end: End of the download window (UTC); None for no bound
+        registry: A participant_registry.ParticipantRegistry for the
+            status, registration and upload checks
+        summaries_df: Data volume summaries for the byte check
+        data_streams: Streams that will be downloaded; other streams are
+            ignored in the byte check
+        skip_statuses: Statuses that are always skipped
+
+    Returns:
+        Dataframe with PLAN_COLUMNS and one row per participant, ordered
+        downloads first (largest expected download first when summaries are
+        given), then deferred, then skipped
+    """
+    start, end = _timestamp(time_start), _timestamp(time_end)
+    plan = pd.DataFrame({"participant_id": pd.Series(users, dtype=str)})
+    plan["action"] = DOWNLOAD
+    plan["reason"] = ""
+    plan["status"] = None
+    plan["last_upload"] = pd.NaT
+    plan["expected_bytes"] = np.nan
+
+    def mark(mask, action, reason):
+        # skips override deferrals; the first reason found is kept
+        if action == DEFER:
+            mask = mask & (plan["action"] == DOWNLOAD)
+        else:
+            mask = mask & (plan["action"] != SKIP)
+        plan.loc[mask, "action"] = action
+        plan.loc[mask, "reason"] = reason
+
+    if registry is not None:
+        participants_df = registry.table(study_id)
+        known = plan["participant_id"].isin(participants_df.index)
+        table = participants_df.reindex(plan["participant_id"])
+        plan["status"] = table["status"].astype(object).to_numpy()
+        plan["last_upload"] = table["last_upload"].to_numpy()
+        registered = table["first_registration_date"].to_numpy()
+        mark(~known, DEFER, "not in participant table")
+        for status in skip_statuses:
+            mark(plan["status"] == status, SKIP, f"status is {status}")
+        if end is not None:
+            mark(pd.Series(registered > np.datetime64(end), index=plan.index),
+                 SKIP, "registered after window")
+        if start is not None:
+            mark(plan["last_upload"] < start - UPLOAD_SLACK, SKIP,
+                 "no uploads since window start")
+
+    if summaries_df is not None:
+        volume = expected_bytes(summaries_df, start, end, data_streams)
+        plan["expected_bytes"] = plan["participant_id"].map(volume).to_numpy()
+        mark(plan["expected_bytes"].isna(), DEFER, "not in summaries")
+        # Summaries are computed after upload, so no bytes only proves there
+        # is no data if the summaries reach past the window's end
+        if summaries_cover(summaries_df, end):
+            mark(plan["expected_bytes"] == 0, SKIP, "no data in summaries")
+        else:
+            mark(plan["expected_bytes"] == 0, DEFER,
+                 "no data in summaries yet")
+
+    order = plan["action"].map({DOWNLOAD: 0, DEFER: 1, SKIP: 2})
+    plan = plan.assign(_order=order).sort_values(
+        ["_order", "expected_bytes"], ascending=[True, False],
+        na_position="last", kind="stable"
+    )
+    return plan.drop(columns="_order").reset_index(drop=True)[PLAN_COLUMNS]
+
+
+def planned_users(plan: pd.DataFrame, include_deferred: bool = True) -> list:
+    """Participant IDs to download, in plan order"""
+    actions = [DOWNLOAD, DEFER] if include_deferred else [DOWNLOAD]
+    return plan.loc[plan["action"].isin(actions), "participant_id"].tolist()
+
+
+def summarize_plan(plan: pd.DataFrame) -> pd.DataFrame:
+    """Number of participants for each action and reason"""
+    return (plan.groupby(["action", "reason"]).size()
+            .rename("participants").reset_index())
+
+
+def log_plan(plan: pd.DataFrame):
+    """Log how many participants will be downloaded, deferred and skipped"""
+    for row in summarize_plan(plan).itertuples(index=False):
+        if row.action == DOWNLOAD:
+            logger.info("Downloading %d participants", row.participants)
+        else:
+            logger.info("%s %d participants: %s", row.action.capitalize(),
+                        row.participants, row.reason)
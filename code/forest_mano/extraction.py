@@ -0,0 +1,457 @@
+"""Extract downloaded archives without rewriting files that are already there
+
+download_data re-extracts overlapping time windows into the same folder, so
+most members of a repeated sync already exist at their destination with the
+same content. extract_archive streams each zip member through SHA-256 and
+only writes members whose content differs from what is on disk. A
+ContentIndex kept in the download folder remembers the size, modification
+time and digest of every extracted file, so existing files are only hashed
+again if they changed, and finding files with identical content is a lookup
+instead of a filename heuristic. Identical content under a new name can
+optionally be hard-linked instead of written again.
+
+Members are written to a staging folder, checked against the CRC-32 and size
+recorded in the archive, and only then moved into place, so a participant
+folder never holds a partial or corrupt file. A member that fails the check
+is skipped and reported with its data stream; the other members still land.
+An ExtractionManifest records which streams of which participants were
+fully extracted for a time window, so a retry only requests the streams that
+are still missing.
+
+With a compression (see raw_storage.py), raw files are written as
+<name>.csv.gz or <name>.csv.zst, and digests are of the uncompressed content
+so unchanged files are still recognized.
+
+Example:
+    index = ContentIndex(download_folder)
+    counts = extract_archive(zf, download_folder, index, hard_link=True)
+    index.save()
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+import zlib
+
+from raw_storage import (COMPRESSION_SUFFIXES, RAW_FILE_EXTENSIONS,
+                         check_compression, compression_of, is_raw_file,
+                         open_raw, stored_variants)
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".content_index.json"
+
+MANIFEST_FILENAME = ".extraction_manifest.json"
+
+# Folder inside the download folder that members are written to before
+# they are verified and moved into place
+STAGING_DIRNAME = ".staging"
+
+CHUNK_SIZE = 1 << 20
+
+
+class IntegrityError(Exception):
+    """An archive member doesn't match the CRC-32 or size in the archive"""
+
+
+def _part_path(staging_dir: str, compression: str = None) -> str:
+    """Temporary path in staging_dir; unique per thread, since archives for
+    different streams of a participant can be extracted at the same time"""
+    suffix = COMPRESSION_SUFFIXES.get(compression, "")
+    return os.path.join(staging_dir,
+                        f"{os.getpid()}-{threading.get_ident()}.part{suffix}")
+
+
+def member_stream(rel_path: str) -> str:
+    """Data stream of an extracted file, from its participant_id/stream/...
+    path; None for files outside a stream folder, such as the registry"""
+    parts = rel_path.split(os.sep)
+    return parts[1] if len(parts) > 2 else None
+
+
+def hash_file_object(f, chunk_size: int = CHUNK_SIZE) -> str:
+    """SHA-256 hex digest of a binary file object, read in chunks"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def member_path(member: zipfile.ZipInfo) -> str:
+    """Relative destination path of a zip member, as extractall would write it
+
+    Drive letters, leading slashes and "." and ".." components are removed so
+    members can't be written outside the destination folder.
+    """
+    parts = member.filename.replace("\\", "/").split("/")
+    parts = [part for part in parts if part not in ("", ".", "..")]
+    if parts:
+        parts[0] = os.path.splitdrive(parts[0])[1] or parts[0]
+    return os.path.join(*parts) if parts else ""
+
+
+class ContentIndex:
+    """Digests of the files extracted into a folder
+
+    Entries are keyed by path relative to root and hold the file's size,
+    modification time (ns) and SHA-256 digest (of the uncompressed content
+    for compressed raw files). A digest is trusted as long
+    as the file's size and modification time match; otherwise the file is
+    hashed again. The index is safe to share between threads.
+
+    Args:
+        root: The download folder
+        path: Where the index is stored. Defaults to INDEX_FILENAME in root.
+    """
+
+    def __init__(self, root: str, path: str = None):
+        self.root = root
+        self.path = path or os.path.join(root, INDEX_FILENAME)
+        self._entries = dict()
+        self._by_digest = dict()
+        self._size_counts = dict()
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable content index %s: %s",
+                               self.path, e)
+                entries = dict()
+            for rel_path, (size, mtime_ns, digest) in entries.items():
+                self._add(rel_path, size, mtime_ns, digest)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _add(self, rel_path: str, size: int, mtime_ns: int, digest: str):
+        self._forget(rel_path)
+        self._entries[rel_path] = (size, mtime_ns, digest)
+        self._by_digest.setdefault(digest, set()).add(rel_path)
+        self._size_counts[size] = self._size_counts.get(size, 0) + 1
+
+    def _forget(self, rel_path: str):
+        old = self._entries.pop(rel_path, None)
+        if old is not None:
+            self._by_digest.get(old[2], set()).discard(rel_path)
+            self._size_counts[old[0]] -= 1
+
+    def record(self, rel_path: str, digest: str):
+        """Record the digest of a file that was just written"""
+        stat = os.stat(os.path.join(self.root, rel_path))
+        with self._lock:
+            self._add(rel_path, stat.st_size, stat.st_mtime_ns, digest)
+
+    def digest(self, rel_path: str) -> str:
+        """Digest of a file under root, hashing it only if it is new or has
+        changed since it was indexed; None if the file doesn't exist"""
+        full_path = os.path.join(self.root, rel_path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(rel_path)
+            return None
+        with self._lock:
+            entry = self._entries.get(rel_path)
+        if entry is not None and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        with open_raw(full_path, "rb") as f:
+            digest = hash_file_object(f)
+        with self._lock:
+            self._add(rel_path, stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def forget(self, rel_path: str):
+        """Drop a file that was removed from root"""
+        with self._lock:
+            self._forget(rel_path)
+
+    def has_size(self, size: int) -> bool:
+        """Whether any indexed file has this size"""
+        with self._lock:
+            return self._size_counts.get(size, 0) > 0
+
+    def find(self, digest: str, exclude: str = None) -> str:
+        """Relative path of an unchanged indexed file with this digest, or
+        None"""
+        with self._lock:
+            candidates = [p for p in self._by_digest.get(digest, ())
+                          if p != exclude]
+        for rel_path in candidates:
+            if self.digest(rel_path) == digest:
+                return rel_path
+        return None
+
+    def duplicates(self, prefix: str = "") -> list:
+        """Groups of indexed paths (under prefix) that share content
+
+        Returns:
+            List of sorted lists of relative paths, one per digest held by
+            more than one file
+        """
+        with self._lock:
+            groups = [sorted(p for p in paths if p.startswith(prefix))
+                      for paths in self._by_digest.values()]
+        return sorted(group for group in groups if len(group) > 1)
+
+    def scan(self, subfolder: str = ""):
+        """Index every file under root (or a subfolder of it), hashing only
+        files that are new or changed"""
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, subfolder)):
+            if STAGING_DIRNAME in dirnames:
+                dirnames.remove(STAGING_DIRNAME)
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                if os.path.abspath(full_path) == os.path.abspath(self.path):
+                    continue
+                self.digest(os.path.relpath(full_path, self.root))
+
+    def save(self):
+        """Write the index atomically"""
+        with self._save_lock:
+            with self._lock:
+                entries = {p: list(entry) for p, entry in self._entries.items()}
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+
+
+def _write_member(zf: zipfile.ZipFile, member: zipfile.ZipInfo,
+                  full_path: str, staging_dir: str) -> str:
+    """Stream a member to a staging file (compressed if full_path has a
+    compression suffix), verify its CRC-32 and size, and move it to
+    full_path, returning its digest
+
+    Raises:
+        IntegrityError: If the member doesn't match the archive's CRC-32 or
+            size, or can't be decompressed
+    """
+    digest = hashlib.sha256()
+    crc = 0
+    size = 0
+    tmp_path = _part_path(staging_dir, compression_of(full_path))
+    try:
+        with zf.open(member) as source, open_raw(tmp_path, "wb") as target:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                target.write(chunk)
+        if size != member.file_size or crc != member.CRC:
+            raise IntegrityError(f"{member.filename}: got {size} bytes with "
+                                 f"CRC {crc:08x}, expected {member.file_size} "
+                                 f"with CRC {member.CRC:08x}")
+        os.replace(tmp_path, full_path)
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise IntegrityError(f"{member.filename}: {e}") from e
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return digest.hexdigest()
+
+
+def _hash_member(zf: zipfile.ZipFile, member: zipfile.ZipInfo) -> str:
+    """Digest of a member; zipfile checks its CRC-32 once it is read"""
+    try:
+        with zf.open(member) as source:
+            return hash_file_object(source)
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise IntegrityError(f"{member.filename}: {e}") from e
+
+
+def _link_file(source_path: str, full_path: str, staging_dir: str) -> bool:
+    tmp_path = _part_path(staging_dir)
+    try:
+        os.link(source_path, tmp_path)
+        os.replace(tmp_path, full_path)
+        return True
+    except OSError as e:  # no hard links on this filesystem
+        logger.debug("Unable to hard link %s: %s", source_path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def _remove_other_variants(download_folder: str, rel_path: str,
+                           index: ContentIndex):
+    """Remove copies of a raw file stored with another compression, e.g.
+    the plain csv once its compressed copy has landed"""
+    for variant in stored_variants(rel_path):
+        if variant != rel_path and os.path.exists(
+                os.path.join(download_folder, variant)):
+            os.remove(os.path.join(download_folder, variant))
+            index.forget(variant)
+
+
+def extract_archive(zf: zipfile.ZipFile, download_folder: str,
+                    index: ContentIndex = None,
+                    hard_link: bool = False, compression: str = None) -> dict:
+    """Extract a zip archive, skipping members that are already on disk
+
+    A member is only hashed before writing when its destination exists with
+    the same size or, with hard_link, when some indexed file has its size;
+    every other member is hashed while it is written. Members are written to
+    a folder of their own in STAGING_DIRNAME and moved into place once their
+    CRC-32 and size match the archive, so an interrupted extraction never
+    leaves a partial file behind. Members that fail the check are skipped and counted.
+
+    Args:
+        zf: An open archive, e.g. from mano.sync.download
+        download_folder: Folder to extract into
+        index: ContentIndex of download_folder. Defaults to a new index that
+            is loaded from and saved to download_folder.
+        hard_link: Hard link members whose content already exists elsewhere
+            in the folder instead of writing them. Hard-linked files share
+            storage, so editing one edits all of them. Not applied to
+            compressed files.
+        compression: "gzip" or "zstd" to store raw files (csv, json and
+            recordings) compressed, replacing plain copies already on disk;
+            None writes them plain, replacing compressed copies
+
+    Returns:
+        Dict with files_written, files_skipped, files_linked, files_failed,
+        bytes_written and bytes_skipped counts, and failed_streams, the
+        sorted data streams with a member that failed verification (None
+        stands for files outside a stream folder)
+    """
+    own_index = index is None
+    if own_index:
+        index = ContentIndex(download_folder)
+    suffix = ""
+    if compression is not None:
+        check_compression(compression)
+        suffix = COMPRESSION_SUFFIXES[compression]
+    staging_root = os.path.join(download_folder, STAGING_DIRNAME)
+    os.makedirs(staging_root, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=staging_root)
+    counts = {"files_written": 0, "files_skipped": 0, "files_linked": 0,
+              "files_failed": 0, "bytes_written": 0, "bytes_skipped": 0}
+    failed_streams = set()
+    for member in zf.infolist():
+        rel_path = member_path(member)
+        if not rel_path:
+            continue
+        if member.is_dir():
+            os.makedirs(os.path.join(download_folder, rel_path), exist_ok=True)
+            continue
+        compressed = bool(suffix) and is_raw_file(rel_path, RAW_FILE_EXTENSIONS)
+        stream = member_stream(rel_path)
+        if compressed:
+            rel_path += suffix
+        full_path = os.path.join(download_folder, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        try:
+            # compressed sizes can't be compared with the member's
+            exists_same_size = os.path.isfile(full_path) and (
+                compressed or os.path.getsize(full_path) == member.file_size)
+            can_link = hard_link and not compressed
+            if exists_same_size or (can_link and index.has_size(member.file_size)):
+                digest = _hash_member(zf, member)
+                if exists_same_size and index.digest(rel_path) == digest:
+                    counts["files_skipped"] += 1
+                    counts["bytes_skipped"] += member.file_size
+                    continue
+                if can_link:
+                    source_path = index.find(digest, exclude=rel_path)
+                    if source_path is not None and _link_file(
+                            os.path.join(download_folder, source_path),
+                            full_path, staging_dir):
+                        index.record(rel_path, digest)
+                        counts["files_linked"] += 1
+                        counts["bytes_skipped"] += member.file_size
+                        continue
+            index.record(rel_path,
+                         _write_member(zf, member, full_path, staging_dir))
+        except IntegrityError as e:
+            logger.warning("Not extracting corrupt member %s", e)
+            counts["files_failed"] += 1
+            failed_streams.add(stream)
+            continue
+        finally:
+            if os.path.exists(full_path):
+                _remove_other_variants(download_folder, rel_path, index)
+        counts["files_written"] += 1
+        counts["bytes_written"] += member.file_size
+    # only this extraction's folder; other threads may be extracting into
+    # STAGING_DIRNAME, and ContentIndex.scan skips it
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    if own_index:
+        index.save()
+    counts["failed_streams"] = sorted(failed_streams, key=str)
+    return counts
+
+
+class ExtractionManifest:
+    """Time windows for which each participant's streams were fully
+    extracted
+
+    download_data records a stream once every member of it in an archive
+    has been verified and moved into place (or the archive had no data for
+    it), so retries, and resumed runs, only request the streams that are
+    still missing. Windows are ISO 8601 UTC strings, as download_data passes
+    them to the server; overlapping windows are merged. The manifest is safe
+    to share between threads.
+
+    Args:
+        root: The download folder
+        path: Where the manifest is stored. Defaults to MANIFEST_FILENAME in
+            root.
+    """
+
+    def __init__(self, root: str, path: str = None):
+        self.path = path or os.path.join(root, MANIFEST_FILENAME)
+        self._windows = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self._windows = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable extraction manifest %s: %s",
+                               self.path, e)
+
+    def record(self, participant_id: str, data_streams: list,
+               time_start: str, time_end: str):
+        """Record streams as fully extracted for a window"""
+        with self._lock:
+            participant = self._windows.setdefault(participant_id, dict())
+            for stream in data_streams:
+                windows = sorted(participant.get(stream, [])
+                                 + [[time_start, time_end]])
+                merged = [windows[0]]
+                for start, end in windows[1:]:
+                    if start <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], end)
+                    else:
+                        merged.append([start, end])
+                participant[stream] = merged
+
+    def complete_streams(self, participant_id: str, time_start: str,
+                         time_end: str) -> set:
+        """Streams of a participant fully extracted for the whole window"""
+        with self._lock:
+            participant = self._windows.get(participant_id, dict())
+            return {stream for stream, windows in participant.items()
+                    if any(start <= time_start and time_end <= end
+                           for start, end in windows)}
+
+    def save(self):
+        """Write the manifest atomically"""
+        with self._lock:
+            tmp_path = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._windows, f)
+            os.replace(tmp_path, self.path)
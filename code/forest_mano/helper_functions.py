@@ -1,19 +1,43 @@
 from pathlib import Path
 from itertools import islice
-import numpy as np
-import pandas as pd
-from pandas import json_normalize
-import orjson
 import os
 import sys
 from datetime import datetime
 from datetime import timedelta
-import pytz
 import math
 from functools import reduce
-import mano
-import mano.sync as msync
-import requests
+from instrumentation import stage_timer, timed
+from extraction import ContentIndex, ExtractionManifest, extract_archive
+from concurrent.futures import ThreadPoolExecutor
+import time
+from scheduler import BULK, INTERACTIVE, THROTTLE_STATUSES, scheduler_slot, status_from_exception
+import io
+import zipfile
+
+# pandas, numpy, pytz, mano and requests are imported in the functions that use them, so scripts that only
+# need tree or convert_to_utc_and_format start quickly (see benchmarks/bench_import_time.py)
+
+
+def all_data_streams():
+    '''
+    Every data stream mano can download
+    '''
+    import mano
+    return list(mano.DATA_STREAMS)
+
+
+def __getattr__(name):
+    # ALL_DATA_STREAMS is looked up on first use so importing this module doesn't import mano
+    if name == "ALL_DATA_STREAMS":
+        return all_data_streams()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Data streams from typically smallest to largest daily volume
+DATA_STREAMS_BY_SIZE = [
+    "identifiers", "calls", "reachability", "survey_answers", "texts", "survey_timings", "proximity",
+    "power_state", "app_log", "ios_log", "audio_recordings", "bluetooth", "wifi", "gps", "magnetometer",
+    "devicemotion", "gyro", "accelerometer"
+]
 
 space =  '    '
 branch = '│   '
@@ -71,37 +95,43 @@ def concatenate_summaries(dir_path: Path, output_filename: str):
   
 def concatenate_folder(dir_path: Path, output_filename: str):
     """Concatenate one folder of GPS- or communication-related summaries"""
+    import pandas as pd
     
-    # initialize dataframe list
-    df_list = []
-
-    # loop through files in dir_path
-    for file in os.listdir(dir_path):        
-        # obtain subject study_id 
-        file_dir = os.path.join(dir_path,file)
-        subject_id = os.path.basename(file_dir)[:-4]
-        if file.endswith(".csv"): 
-            temp_df = pd.read_csv(file_dir)
-            temp_df.insert(loc=0, column='Beiwe_ID', value=subject_id)
-            df_list.append(temp_df)
-                
-    if len(df_list) > 0:
+    with stage_timer("concatenate_folder", dir_path=str(dir_path)) as timer:
+        # initialize dataframe list
+        df_list = []
+
+        # loop through files in dir_path
+        for file in os.listdir(dir_path):        
+            # obtain subject study_id 
+            file_dir = os.path.join(dir_path,file)
+            subject_id = os.path.basename(file_dir)[:-4]
+            if file.endswith(".csv"): 
+                timer.add_bytes(os.path.getsize(file_dir))
+                temp_df = pd.read_csv(file_dir)
+                temp_df.insert(loc=0, column='Beiwe_ID', value=subject_id)
+                df_list.append(temp_df)
+        timer.add_count("files_read", len(df_list))
                     
-        # concatenate dataframes within list --> Final Data for trajectories
-        response_data = pd.concat(df_list, axis=0)
+        if len(df_list) > 0:
+                        
+            # concatenate dataframes within list --> Final Data for trajectories
+            response_data = pd.concat(df_list, axis=0)
+            timer.add_count("rows", response_data.shape[0])
 
-        # make directory 
-        os.makedirs(dir_path / "concatenated", exist_ok=True) 
-        path_resp = os.path.join(dir_path / "concatenated", output_filename)    
+            # make directory 
+            os.makedirs(dir_path / "concatenated", exist_ok=True) 
+            path_resp = os.path.join(dir_path / "concatenated", output_filename)    
 
-        # write to csv
-        response_data.to_csv(path_resp, index=False)
-        print("Concatenated folder " + str(dir_path) + " to " + str(output_filename))
-    else:
-        print("No input data found in folder " + str(dir_path))
+            # write to csv
+            response_data.to_csv(path_resp, index=False)
+            print("Concatenated folder " + str(dir_path) + " to " + str(output_filename))
+        else:
+            print("No input data found in folder " + str(dir_path))
 
 # Convert study time to UTC
 def convert_to_utc_and_format(date_str, time_str, timezone_str):
+    import pytz
     local_time = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
     local_timezone = pytz.timezone(timezone_str)
     local_time = local_timezone.localize(local_time)
@@ -110,8 +140,78 @@ def convert_to_utc_and_format(date_str, time_str, timezone_str):
     
     return utc_time_str
 
+# Convert many study times to UTC at once
+def convert_to_utc(dates, times = None, timezone_str: str = "UTC", ambiguous: str = "raise",
+                   nonexistent: str = "raise", output_format: str = "%Y-%m-%dT%H:%M:%S"):
+    '''
+    Converts local dates or datetimes in the study timezone to UTC in one vectorized pass.
+
+    This is the batched version of convert_to_utc_and_format, for converting whole columns instead of
+    applying the scalar function row by row.
+
+    Args:
+        dates(array-like): Local dates (YYYY-MM-DD) or datetimes, as strings, datetimes, or a datetime64 Series
+
+        times(str or array-like): Local times of day (HH:MM:SS) added to dates. Either one time for every
+            row or one per row. The default (None) uses dates as they are.
+
+        timezone_str(str): The study timezone
+
+        ambiguous(str): How to handle local times that happen twice when clocks fall back. "raise" raises
+            an error, "earliest" uses the first (daylight saving) occurrence, "latest" uses the second
+            (standard time) occurrence, and "NaT" returns a missing value.
+
+        nonexistent(str): How to handle local times skipped when clocks spring forward. "raise" raises an
+            error, "shift_forward" and "shift_backward" move to the nearest existing time, and "NaT"
+            returns a missing value.
+
+        output_format(str): strftime format of the returned strings. If this is None, UTC datetimes
+            (datetime64, timezone-naive) are returned instead.
+
+    Returns:
+        A pandas Series of UTC time strings (or datetimes), aligned with dates
+    '''
+    import numpy as np
+    import pandas as pd
+
+    index = dates.index if isinstance(dates, pd.Series) else None
+    dates = pd.Series(dates, index=index)
+    if times is not None and pd.api.types.is_string_dtype(dates):
+        # Parse "date time" strings with an explicit format; much faster than
+        # adding separately parsed timedeltas
+        local_times = pd.to_datetime(dates + " " + pd.Series(times, index=dates.index).astype(str),
+                                     format="%Y-%m-%d %H:%M:%S")
+    else:
+        local_times = pd.to_datetime(dates)
+        if local_times.dt.tz is not None:
+            local_times = local_times.dt.tz_localize(None)
+        if times is not None:
+            local_times = local_times + pd.to_timedelta(pd.Series(times, index=dates.index).astype(str))
+
+    if ambiguous == "earliest":
+        ambiguous = np.ones(len(local_times), dtype=bool)
+    elif ambiguous == "latest":
+        ambiguous = np.zeros(len(local_times), dtype=bool)
+    elif ambiguous not in ("raise", "NaT"):
+        raise ValueError(f"Unknown value for ambiguous: {ambiguous}")
+
+    utc_times = local_times.dt.tz_localize(
+        timezone_str, ambiguous=ambiguous, nonexistent=nonexistent
+    ).dt.tz_convert("UTC").dt.tz_localize(None)
+    if output_format is None:
+        return utc_times
+    if output_format == "%Y-%m-%dT%H:%M:%S":
+        # numpy's ISO formatting is an order of magnitude faster than strftime
+        utc_strings = np.datetime_as_string(utc_times.to_numpy().astype("datetime64[s]"))
+        return pd.Series(utc_strings, index=utc_times.index).where(utc_times.notna())
+    return utc_times.dt.strftime(output_format)
+
+@timed("download_data")
 def download_data(keyring, study_id, download_folder, tz_str: str = "UTC", users = [], time_start = "2008-01-01", 
-                      time_end = None, data_streams = None):
+                      time_end = None, data_streams = None, registry = None, summaries_df = None,
+                      hard_link_duplicates = False, split_streams = False, max_concurrent_downloads = 4,
+                      on_downloaded = None, scheduler = None, progress = None,
+                      resume = False, compression = None):
     '''
     Downloads all data for specified users, time frame, and data streams. 
     
@@ -136,8 +236,53 @@ def download_data(keyring, study_id, download_folder, tz_str: str = "UTC", users
         time_end(str): The date to end downloads. The default is today at midnight.
 
         data_streams(iterable): A list of all data streams to download. The default (None) is all possible data streams. 
+
+        registry(ParticipantRegistry): If given, participants who are retired or unregistered, registered after
+            time_end, or have not uploaded since time_start are skipped (see download_planning.plan_downloads).
+
+        summaries_df(DataFrame): Data volume summaries from get_data_summaries. If given, participants with no
+            bytes for data_streams in the window are skipped and the largest downloads are started first.
+
+        hard_link_duplicates(bool): Hard link downloaded files whose content already exists elsewhere in
+            download_folder instead of writing them again. Files already at their destination with the same
+            content are never rewritten (see extraction.extract_archive).
+
+        split_streams(bool): Download each data stream of a participant with its own request, with up to
+            max_concurrent_downloads requests at a time across all participants. Small streams (calls, texts,
+            surveys) are requested first, so they arrive without waiting for large sensor streams.
+
+        max_concurrent_downloads(int): Number of simultaneous requests when split_streams is True
+
+        on_downloaded(callable): Called as on_downloaded(participant_id, data_streams, failed_streams) each time
+            a request for a participant finishes (once per participant, or once per stream with split_streams),
+            whether or not it returned data, so work on those streams can start while other downloads continue.
+            failed_streams lists the streams of data_streams that may be missing or incomplete because the
+            download gave up (too many failures, corrupt files left after retries, or a server error); it is
+            empty when the request succeeded. If it blocks, downloading waits.
+
+        scheduler(RequestScheduler): Rate, bandwidth and concurrency budget shared with other jobs using the
+            same server (see scheduler.shared_scheduler). The participant list is fetched with interactive
+            priority and data with bulk priority. Throttled requests (429/503) are retried after the pause the
+            scheduler sets; without a scheduler they are retried with exponential backoff.
+
+        progress(ProgressTracker): Receives bytes received, files extracted and the end of each request, and
+            reports overall and per-participant throughput and ETA to its callbacks and status file (see
+            progress.ProgressTracker). Participants not registered with progress.set_participants are
+            registered here, with the bytes summaries_df expects for them when it is given.
+
+        resume(bool): Skip participants' streams that an earlier run fully extracted for a window covering
+            time_start to time_end. Which streams landed is recorded in download_folder (see
+            extraction.ExtractionManifest) on every run; retries after a corrupt archive always request only
+            the streams whose files failed verification.
+
+        compression(str): "gzip" or "zstd" to store extracted raw files compressed (see raw_storage.py), or
+            None for plain csv files. Forest needs plain files; see raw_storage.decompress_tree.
         
     '''
+    import mano
+    import pytz
+    from download_planning import expected_bytes, plan_downloads, planned_users, summarize_plan, SKIP
+
     if study_id == "":
         print("Error: Study ID is blank")
         return
@@ -169,7 +314,8 @@ def download_data(keyring, study_id, download_folder, tz_str: str = "UTC", users
         num_tries = 1
         while num_tries < 5:
             try:
-                users = [u for u in mano.users(keyring, study_id)]
+                with scheduler_slot(scheduler, INTERACTIVE):
+                    users = [u for u in mano.users(keyring, study_id)]
                 num_tries = 6
             except KeyboardInterrupt:
                 print("Someone closed the program")
@@ -180,37 +326,217 @@ def download_data(keyring, study_id, download_folder, tz_str: str = "UTC", users
                 num_tries = 6
             except:
                 num_tries = num_tries + 1
-        
-            
-    
-    for u in users:
-        zf = None
-        download_success = False
-        num_tries = 0
-        while not download_success:
-            try:
-                print(f'Downloading data for {u}')
-                zf = msync.download(keyring, study_id, u, data_streams, time_start = time_start, time_end = time_end)
-                if zf is not None:
-                    zf.extractall(download_folder)
+
+    if registry is not None or summaries_df is not None:
+        plan = plan_downloads(users, study_id, time_start, time_end, registry=registry,
+                              summaries_df=summaries_df, data_streams=data_streams)
+        for row in summarize_plan(plan).itertuples(index=False):
+            if row.action == SKIP:
+                print(f'Skipping {row.participants} participants: {row.reason}')
+        users = planned_users(plan)
+
+    if progress is not None:
+        expected = None
+        if summaries_df is not None:
+            expected = expected_bytes(summaries_df, time_start, time_end, data_streams)
+        num_requests = len(data_streams or all_data_streams()) if split_streams else 1
+        registered = set(progress.participant_ids())
+        progress.set_participants([u for u in users if u not in registered], expected,
+                                  requests_per_participant=num_requests)
+
+    # Digests of files already in download_folder, so re-downloaded files that haven't changed aren't rewritten
+    content_index = ContentIndex(download_folder)
+    manifest = ExtractionManifest(download_folder)
+    if not split_streams:
+        for u in users:
+            with stage_timer("download_participant", study_id=study_id, participant_id=u) as timer:
+                failed_streams = _download_participant(keyring, study_id, u, data_streams, time_start, time_end, download_folder,
+                                      content_index, hard_link_duplicates, timer, scheduler, progress,
+                                      manifest, resume, compression)
+            if on_downloaded is not None:
+                on_downloaded(u, list(data_streams or all_data_streams()), failed_streams)
+        if progress is not None:
+            progress.close()
+        return
+
+    # One request per participant and stream, lightest streams first, sharing one pool of connections
+    tasks = [(u, stream) for u in users for stream in order_streams_by_size(data_streams or all_data_streams())]
+    def download_stream(task):
+        u, stream = task
+        with stage_timer("download_participant", study_id=study_id, participant_id=u, data_stream=stream) as timer:
+            failed_streams = _download_participant(keyring, study_id, u, [stream], time_start, time_end, download_folder,
+                                  content_index, hard_link_duplicates, timer, scheduler, progress,
+                                  manifest, resume, compression)
+        if on_downloaded is not None:
+            on_downloaded(u, [stream], failed_streams)
+    with ThreadPoolExecutor(max_workers=max_concurrent_downloads) as executor:
+        for _ in executor.map(download_stream, tasks):
+            pass
+    if progress is not None:
+        progress.close()
+
+
+def order_streams_by_size(data_streams):
+    '''
+    Sorts data streams from typically smallest to largest (see DATA_STREAMS_BY_SIZE). Unknown streams go last.
+    '''
+    rank = {stream: i for i, stream in enumerate(DATA_STREAMS_BY_SIZE)}
+    return sorted(data_streams, key=lambda stream: rank.get(stream, len(rank)))
+
+
+def fetch_archive(keyring, study_id, u, data_streams, time_start, time_end, on_chunk=None, chunk_size=1 << 16):
+    '''
+    Requests one participant's data archive, like mano.sync.download, but calls on_chunk(num_bytes) as each
+    chunk of the response arrives so progress and bandwidth limits apply during the transfer.
+
+    Returns:
+        A zipfile.ZipFile, or None if the server has no data for the participant (404)
+
+    Raises:
+        mano.sync.APIError: The server returned another error status
+        mano.sync.DownloadError: The response was not a zip archive
+    '''
+    import dateutil.parser
+    import mano
+    import mano.sync as msync
+    import requests
+
+    time_start = dateutil.parser.parse(time_start) if isinstance(time_start, str) else time_start
+    time_end = dateutil.parser.parse(time_end) if isinstance(time_end, str) else time_end
+    payload = {
+        'access_key': keyring['ACCESS_KEY'],
+        'secret_key': keyring['SECRET_KEY'],
+        'study_id': study_id,
+        'user_ids': [u],
+        'data_streams': list(data_streams or []),
+        'time_start': time_start.strftime(mano.TIME_FORMAT),
+        'time_end': time_end.strftime(mano.TIME_FORMAT)
+    }
+    with requests.post(keyring['URL'].rstrip('/') + '/get-data/v1', data=payload, stream=True) as response:
+        if response.status_code == requests.codes.NOT_FOUND:
+            return None
+        if response.status_code != requests.codes.OK:
+            raise msync.APIError(f'response not ok ({response.status_code}) {response.url}')
+        content = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            content.write(chunk)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+    try:
+        return zipfile.ZipFile(content)
+    except zipfile.BadZipfile:
+        raise msync.DownloadError(f'bad zip file for {u} ({content.tell()} bytes)')
+
+
+def _download_participant(keyring, study_id, u, data_streams, time_start, time_end, download_folder,
+                          content_index, hard_link_duplicates, timer, scheduler=None, progress=None,
+                          manifest=None, resume=False, compression=None):
+    '''
+    Downloads and extracts one participant's data, retrying on network failures and corrupt archives. Streams
+    that are fully extracted are recorded in manifest, and a retry only requests the streams that are still
+    missing; with resume, so does the first request. Returns the requested streams that may be missing or
+    incomplete because the download gave up, or an empty list.
+    '''
+    import mano
+    import mano.sync as msync
+    import requests
+
+    if data_streams is not None and len(data_streams) == 1:
+        description = f'{data_streams[0]} data for {u}'
+    else:
+        description = f'data for {u}'
+    requested = list(data_streams or all_data_streams())
+    pending = requested
+    if resume and manifest is not None:
+        complete = manifest.complete_streams(u, time_start, time_end)
+        pending = [stream for stream in requested if stream not in complete]
+        if not pending:
+            print(f'Already downloaded {description}; skipping')
+    extracted = None
+    files_extracted = 0
+    bytes_extracted = 0
+    download_success = not pending
+    failed = []
+    num_tries = 0
+    if progress is not None:
+        progress.start(u)
+    while not download_success:
+        try:
+            print(f'Downloading {description}')
+            with scheduler_slot(scheduler, BULK) as slot:
+                unmetered = [0]  # bytes not yet counted against the scheduler's bandwidth budget
+                def on_chunk(num_bytes):
+                    timer.add_bytes(num_bytes)
+                    if progress is not None:
+                        progress.add_bytes(u, num_bytes)
+                    unmetered[0] += num_bytes
+                    if unmetered[0] >= 1 << 20:
+                        slot.add_bytes(unmetered[0])
+                        unmetered[0] = 0
+                # Ask for everything the caller asked for (None is all streams) unless only some are missing
+                zf = fetch_archive(keyring, study_id, u, data_streams if pending == requested else pending,
+                                   time_start, time_end, on_chunk=on_chunk)
+                slot.add_bytes(unmetered[0])
+            failed_streams = []
+            if zf is not None:
+                counts = extract_archive(zf, download_folder, content_index,
+                                         hard_link=hard_link_duplicates, compression=compression)
+                content_index.save()
+                extracted = True
+                files_extracted += counts["files_written"] + counts["files_linked"]
+                bytes_extracted += counts["bytes_written"]
+                timer.add_count("files_extracted", counts["files_written"] + counts["files_linked"])
+                timer.add_count("bytes_extracted", counts["bytes_written"])
+                timer.add_count("files_unchanged", counts["files_skipped"])
+                timer.add_count("bytes_unchanged", counts["bytes_skipped"])
+                timer.add_count("files_corrupt", counts["files_failed"])
+                failed_streams = [stream for stream in counts["failed_streams"] if stream in pending]
+            elif extracted is None:
+                extracted = False
+            if manifest is not None:
+                manifest.record(u, [stream for stream in pending if stream not in failed_streams],
+                                time_start, time_end)
+                manifest.save()
+            if failed_streams:
+                print(f'{counts["files_failed"]} corrupt files in download of {description}; retrying '
+                      f'{", ".join(failed_streams)}, try {num_tries}')
+                pending = failed_streams
+                num_tries = num_tries + 1
+                timer.add_count("retries")
+            else:
                 download_success = True
-            except requests.exceptions.ChunkedEncodingError:
-                print(f'Network failed in download of {u}, try {num_tries}')
+        except (requests.exceptions.ChunkedEncodingError, msync.DownloadError):
+            print(f'Network failed in download of {description}, try {num_tries}')
+            num_tries = num_tries + 1
+            timer.add_count("retries")
+        except KeyboardInterrupt:
+            print("Someone closed the program")
+            sys.exit()
+        except (mano.APIError, msync.APIError) as e:
+            status = status_from_exception(e)
+            if status in THROTTLE_STATUSES:
+                print(f'Server is busy ({status}) in download of {description}, try {num_tries}')
                 num_tries = num_tries + 1
-            except KeyboardInterrupt:
-                print("Someone closed the program")
-                sys.exit()
-            except mano.APIError as e:
+                timer.add_count("throttled")
+                if scheduler is None:  # the scheduler pauses every job using the server
+                    time.sleep(min(2 ** num_tries, 60))
+            else:
                 print("Something is wrong with your credentials:")
                 print(e)
                 download_success = True
-            if num_tries > 5:
-                download_success = True
-                print(f"Too many failures; skipping user {u}")
-        if zf is None:
-            print(f'No data for {u}; nothing written')
+                failed = pending
+        if num_tries > 5 and not download_success:
+            download_success = True
+            failed = pending
+            print(f"Too many failures; skipping {description}")
+    if extracted is False:
+        print(f'No {description}; nothing written')
+    if progress is not None:
+        progress.finish(u, files_extracted=files_extracted, bytes_extracted=bytes_extracted,
+                        failed=bool(failed))
+    return list(failed)
 
-def call_api(endpoint, study_id, access_key, secret_key):
+def call_api(endpoint, study_id, access_key, secret_key, scheduler=None):
     '''
     Calls a specific Beiwe API to gather different pieces of information about a study. 
     
@@ -225,33 +551,45 @@ def call_api(endpoint, study_id, access_key, secret_key):
         access_key: API access key from the keyring file
 
         secret_key: API secret key from the keyring file 
+
+        scheduler: Optional RequestScheduler; the call is made with interactive priority
         
     '''
+    import orjson
+    from pandas import json_normalize
+    import requests
+
     # make a post request to the get-participant-upload-history/v1 endpoint, including the api key,
     # secret key, and participant_id as post parameters.
     t_start = datetime.now()
     print("Starting request at", t_start, flush=True)
-    response = requests.post(
-        endpoint,
+    with stage_timer("call_api", endpoint=endpoint, study_id=study_id) as timer, \
+            scheduler_slot(scheduler, INTERACTIVE) as slot:
+        response = requests.post(
+            endpoint,
         
-        # refine your parameters here
-        data={
-            "access_key": access_key,
-            "secret_key": secret_key,
+            # refine your parameters here
+            data={
+                "access_key": access_key,
+                "secret_key": secret_key,
             
-            # several endpoints take a participant id, 
-            "study_id": study_id,
+                # several endpoints take a participant id, 
+                "study_id": study_id,
             
-            # `omit_keys` is an option on some endpoints, it causes the return data to be potentially
-            # much smaller and faster. Format of data will replace dictions with lists of values, order
-            # will be retained. It takes a string, "true" or "false".
-            # "omit_keys": "true",
-            "data_format": "json"
-            # etc.
+                # `omit_keys` is an option on some endpoints, it causes the return data to be potentially
+                # much smaller and faster. Format of data will replace dictions with lists of values, order
+                # will be retained. It takes a string, "true" or "false".
+                # "omit_keys": "true",
+                "data_format": "json"
+                # etc.
             
-        },
-        allow_redirects=False,
-    )
+            },
+            allow_redirects=False,
+        )
+        slot.record_response(response)
+        slot.add_bytes(len(response.content))
+        timer.add_bytes(len(response.content))
+        timer.add_count("status_" + str(response.status_code))
     t_end = datetime.now()
     print("Request completed at", t_end.isoformat(), "duration:", (t_end - t_start).total_seconds(), "seconds")
     
@@ -0,0 +1,193 @@
+"""Lightweight timing and resource metrics for pipeline stages
+
+Stages are wrapped in stage_timer (a context manager) or decorated with
+timed. When a stage finishes, one JSON object is appended to the metrics
+file. The record holds the stage name, labels (study, participant, ...),
+wall time, CPU time of the thread that ran the stage, byte and item counters,
+and peak resident memory.
+
+Metrics are off until configure_metrics is called or the BEIWE_METRICS_PATH
+environment variable is set, so instrumented functions cost almost nothing
+by default.
+
+Example:
+    configure_metrics("metrics.jsonl")
+    with stage_timer("download_participant", participant_id=u) as timer:
+        ...
+        timer.add_bytes(num_bytes)
+"""
+
+from contextlib import ContextDecorator
+from datetime import datetime, timezone
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH_ENV = "BEIWE_METRICS_PATH"
+
+_config = {
+    "path": os.environ.get(METRICS_PATH_ENV),
+    "run_id": uuid.uuid4().hex[:12],
+    "rss_sample_interval": 0.5
+}
+_write_lock = threading.Lock()
+
+
+def configure_metrics(path: str = None, run_id: str = None,
+                      rss_sample_interval: float = None):
+    """Turn on metrics and set where they are written
+
+    Args:
+        path: File to append JSON-lines metrics to. "-" writes to stderr.
+            None turns metrics off.
+        run_id: Identifier added to every record so runs can be compared.
+            A random one is generated at import time.
+        rss_sample_interval: Seconds between resident memory samples while a
+            stage runs. 0 disables sampling, in which case only the
+            process-lifetime peak is reported.
+    """
+    _config["path"] = path
+    if run_id is not None:
+        _config["run_id"] = run_id
+    if rss_sample_interval is not None:
+        _config["rss_sample_interval"] = rss_sample_interval
+
+
+def metrics_enabled() -> bool:
+    return _config["path"] is not None
+
+
+def emit_metric(record: dict):
+    """Append one metrics record as a JSON line, if metrics are enabled"""
+    if not metrics_enabled():
+        return
+    record = {"timestamp": datetime.now(timezone.utc).isoformat(),
+              "run_id": _config["run_id"], "pid": os.getpid(), **record}
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        if _config["path"] == "-":
+            sys.stderr.write(line)
+        else:
+            with open(_config["path"], "a") as f:
+                f.write(line)
+
+
+def current_rss_bytes() -> int:
+    """Current resident set size of this process, or None if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size over the life of this process"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class stage_timer(ContextDecorator):
+    """Time a pipeline stage and emit its metrics when it ends
+
+    Works as a context manager (the timer is returned by __enter__ so
+    counters can be added) and as a decorator.
+
+    cpu_s is time.thread_time() for the thread that entered the timer, so
+    stages running side by side in threads are not billed for each other's
+    CPU. Work the stage hands off to other threads is not included.
+
+    Args:
+        stage: Name of the stage, e.g. "download_participant"
+        **labels: Extra fields identifying the unit of work, such as study_id
+            or participant_id
+    """
+
+    def __init__(self, stage: str, **labels):
+        self.stage = stage
+        self.labels = labels
+        self.num_bytes = 0
+        self.counts = dict()
+        self._peak_rss = None
+        self._stop_sampling = None
+
+    def add_bytes(self, num_bytes: int):
+        self.num_bytes += int(num_bytes)
+
+    def add_count(self, name: str, count: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + int(count)
+
+    def _sample_rss(self, interval: float):
+        while not self._stop_sampling.wait(interval):
+            rss = current_rss_bytes()
+            if rss is not None and (self._peak_rss is None or rss > self._peak_rss):
+                self._peak_rss = rss
+
+    def __enter__(self):
+        self.num_bytes = 0
+        self.counts = dict()
+        self._peak_rss = current_rss_bytes()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.thread_time()
+        interval = _config["rss_sample_interval"]
+        if metrics_enabled() and interval:
+            self._stop_sampling = threading.Event()
+            self._sampler = threading.Thread(target=self._sample_rss,
+                                             args=(interval,), daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self._start_wall
+        cpu_time = time.thread_time() - self._start_cpu
+        if self._stop_sampling is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._stop_sampling = None
+        rss = current_rss_bytes()
+        if rss is not None and (self._peak_rss is None or rss > self._peak_rss):
+            self._peak_rss = rss
+        record = {
+            "stage": self.stage,
+            **self.labels,
+            "status": "ok" if exc_type is None else "error",
+            "duration_s": round(duration, 6),
+            "cpu_s": round(cpu_time, 6),
+            "bytes": self.num_bytes,
+            "counts": self.counts,
+            "stage_peak_rss_bytes": self._peak_rss,
+            "process_peak_rss_bytes": peak_rss_bytes()
+        }
+        if exc_type is not None:
+            record["error"] = f"{exc_type.__name__}: {exc_value}"
+        emit_metric(record)
+        return False
+
+
+def timed(stage: str = None, **labels):
+    """Decorator that runs a function inside stage_timer
+
+    Args:
+        stage: Stage name. Defaults to the function's name.
+        **labels: Extra fields added to the record
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage or func.__name__, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,305 @@
+"""Participant and data collection metrics for many studies at once
+
+Computes the metrics of generate_participant_metrics.ipynb (registration
+counts, OS split, status counts) and generate_summary_statistics.ipynb
+(per-participant upload date range and GPS/accelerometer coverage and
+volume) for any number of studies. Each source table is concatenated across
+studies and reduced with a single grouped aggregation, and the tables are
+fetched over one requests.Session so connections are kept alive and reused
+between studies.
+
+Usage:
+    python participant_metrics.py keyring_studies.py STUDY_ID [STUDY_ID ...]
+        [--output-dir metrics]
+
+Example:
+    with make_session() as session:
+        participants_df, summaries_df = fetch_study_tables(keyring, study_ids,
+                                                           session)
+    study_df = study_metrics(participants_df, summaries_df)
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from participant_registry import (INACTIVE_STATUSES, fetch_participant_table,
+                                  parse_participant_table)
+
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_STATISTICS_ENDPOINT = "/get-summary-statistics/v1"
+
+METRIC_STREAMS = ["gps", "accelerometer"]
+
+# Stream names as they appear in the notebooks' column names
+STREAM_LABELS = {"gps": "GPS"}
+
+OS_TYPES = ["ANDROID", "IOS"]
+
+
+def make_session(total_retries: int = 3, backoff: float = 0.5,
+                 pool_size: int = 8) -> requests.Session:
+    """A session with keep-alive connections and retries on busy servers
+
+    Args:
+        total_retries: Retries for connection errors and 429/5xx responses
+        backoff: Backoff factor between retries, in seconds
+        pool_size: Connections kept open per host; should be at least the
+            number of threads sharing the session
+    """
+    session = requests.Session()
+    retry = Retry(total=total_retries, connect=total_retries,
+                  read=total_retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=frozenset(["POST"]), raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_summary_statistics(keyring: dict, study_id: str,
+                             session: requests.Session = None,
+                             timeout: float = 120) -> pd.DataFrame:
+    """Download one study's /get-summary-statistics/v1 table
+
+    Raises:
+        RuntimeError: If the server does not return the table
+    """
+    response = (session or requests).post(
+        keyring["URL"].rstrip("/") + SUMMARY_STATISTICS_ENDPOINT,
+        data={"access_key": keyring["ACCESS_KEY"],
+              "secret_key": keyring["SECRET_KEY"], "study_id": study_id},
+        timeout=timeout, allow_redirects=False
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code} fetching summary "
+                           f"statistics for {study_id}: {response.text[:300]}")
+    return pd.DataFrame(response.json())
+
+
+def fetch_study_tables(keyring: dict, study_ids: list,
+                       session: requests.Session = None,
+                       max_workers: int = 4) -> tuple:
+    """Fetch the participant table and summary statistics of many studies
+
+    Requests are spread over max_workers threads that share one session, so
+    at most max_workers connections are opened and each is reused. Studies
+    whose tables can't be fetched are logged and left out.
+
+    Args:
+        keyring: Keyring read by read_keyring()
+        study_ids: 24-character study IDs
+        session: Session to use. Defaults to make_session(pool_size=max_workers).
+        max_workers: Number of concurrent requests
+
+    Returns:
+        (participants_df, summaries_df), each with a study_id column. The
+        participant table is typed as in parse_participant_table, with
+        participant_id as a column.
+    """
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=max_workers)
+
+    def fetch(study_id):
+        try:
+            participants_df = parse_participant_table(
+                fetch_participant_table(keyring, study_id, session=session)
+            ).reset_index()
+            summaries_df = fetch_summary_statistics(keyring, study_id, session)
+        except (RuntimeError, requests.RequestException, ValueError) as e:
+            logger.warning("Unable to fetch tables for %s: %s", study_id, e)
+            return None, None
+        participants_df.insert(0, "study_id", study_id)
+        summaries_df["study_id"] = study_id
+        return participants_df, summaries_df
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(fetch, study_ids))
+    finally:
+        if own_session:
+            session.close()
+    participant_frames = [p for p, _ in results if p is not None]
+    summary_frames = [s for _, s in results if s is not None]
+    participants_df = (pd.concat(participant_frames, ignore_index=True)
+                       if participant_frames else pd.DataFrame())
+    summaries_df = (pd.concat(summary_frames, ignore_index=True)
+                    if summary_frames else pd.DataFrame())
+    return participants_df, summaries_df
+
+
+def registration_metrics(participants_df: pd.DataFrame) -> pd.DataFrame:
+    """Registration, OS and status counts for every study
+
+    Args:
+        participants_df: Participant tables with a study_id column, from
+            fetch_study_tables
+
+    Returns:
+        Dataframe indexed by study_id with registered, currently_registered,
+        android and ios counts and one status_<status> count per status of
+        currently registered participants
+    """
+    status = participants_df["status"].astype(str)
+    active = ~status.isin(INACTIVE_STATUSES)
+    os_type = participants_df["os_type"].astype(str)
+    indicators = pd.DataFrame({
+        "study_id": participants_df["study_id"],
+        "participants": 1,
+        "registered": participants_df["first_registration_date"].notna(),
+        "currently_registered": active,
+        "android": os_type == "ANDROID",
+        "ios": os_type == "IOS"
+    })
+    statuses = pd.get_dummies(status.where(active), prefix="status",
+                              prefix_sep="_", dtype=bool)
+    return pd.concat([indicators, statuses], axis=1).groupby("study_id").sum()
+
+
+def participant_upload_metrics(summaries_df: pd.DataFrame,
+                               streams: list = None) -> pd.DataFrame:
+    """Per-participant upload range and coverage for each stream
+
+    Matches generate_summary_statistics.ipynb: for each stream, the number
+    of days with data, the percent of days with data, and the mean and
+    median volume of days with data.
+
+    Args:
+        summaries_df: Summary statistics with study_id, participant_id, date
+            and beiwe_<stream>_bytes columns
+        streams: Streams to report. Defaults to METRIC_STREAMS.
+
+    Returns:
+        Dataframe with one row per study and participant
+    """
+    if streams is None:
+        streams = METRIC_STREAMS
+    columns = {
+        "study_id": summaries_df["study_id"],
+        "participant_id": summaries_df["participant_id"],
+        "first_date_uploaded": summaries_df["date"],
+        "last_date_uploaded": summaries_df["date"]
+    }
+    aggregations = {"first_date_uploaded": "min", "last_date_uploaded": "max"}
+    for stream in streams:
+        label = STREAM_LABELS.get(stream, stream)
+        volume = pd.to_numeric(summaries_df[f"beiwe_{stream}_bytes"],
+                               errors="coerce")
+        has_data = volume > 0
+        columns[f"total_{label}_days"] = has_data
+        columns[f"pct_study_days_with_{label}"] = has_data
+        columns[f"avg_daily_{label}_volume"] = volume.where(has_data)
+        columns[f"median_daily_{label}_volume"] = volume.where(has_data)
+        aggregations.update({f"total_{label}_days": "sum",
+                             f"pct_study_days_with_{label}": "mean",
+                             f"avg_daily_{label}_volume": "mean",
+                             f"median_daily_{label}_volume": "median"})
+    metrics_df = pd.DataFrame(columns).groupby(
+        ["study_id", "participant_id"], sort=True, observed=True
+    ).agg(aggregations)
+    for stream in streams:
+        label = STREAM_LABELS.get(stream, stream)
+        metrics_df[f"pct_study_days_with_{label}"] = (
+            metrics_df[f"pct_study_days_with_{label}"] * 100).round(2)
+        metrics_df[f"avg_daily_{label}_volume"] = (
+            metrics_df[f"avg_daily_{label}_volume"].round(3))
+        metrics_df[f"median_daily_{label}_volume"] = (
+            metrics_df[f"median_daily_{label}_volume"].round(3))
+        metrics_df[f"total_{label}_days"] = (
+            metrics_df[f"total_{label}_days"].astype(np.int32))
+    return metrics_df.reset_index()
+
+
+def study_metrics(participants_df: pd.DataFrame,
+                  summaries_df: pd.DataFrame = None,
+                  streams: list = None,
+                  upload_df: pd.DataFrame = None) -> pd.DataFrame:
+    """One row per study combining registration and upload metrics
+
+    Upload columns are the number of participants with summary statistics
+    and, per stream, the median over participants of the percent of days
+    with data.
+
+    Args:
+        participants_df: Participant tables from fetch_study_tables
+        summaries_df: Summary statistics from fetch_study_tables; not needed
+            if upload_df is given
+        streams: Streams to report. Defaults to METRIC_STREAMS.
+        upload_df: participant_upload_metrics output for these streams, if
+            already computed, so the summaries aren't aggregated again
+    """
+    if streams is None:
+        streams = METRIC_STREAMS
+    if upload_df is None:
+        upload_df = participant_upload_metrics(summaries_df, streams)
+    per_study = {"unique_participants": ("participant_id", "nunique")}
+    for stream in streams:
+        label = STREAM_LABELS.get(stream, stream)
+        per_study[f"median_pct_days_with_{label}"] = (
+            f"pct_study_days_with_{label}", "median")
+    upload_study_df = upload_df.groupby("study_id").agg(**per_study)
+    return registration_metrics(participants_df).join(
+        upload_study_df, how="outer"
+    ).reset_index()
+
+
+def generate_metrics(keyring: dict, study_ids: list, output_dir: str,
+                     max_workers: int = 4) -> tuple:
+    """Fetch tables for many studies and write the metric tables
+
+    Writes study_metrics.csv (one row per study) and
+    participant_metrics.csv (one row per study and participant) to
+    output_dir.
+
+    Returns:
+        (study_df, participant_df)
+    """
+    participants_df, summaries_df = fetch_study_tables(
+        keyring, study_ids, max_workers=max_workers
+    )
+    if participants_df.empty or summaries_df.empty:
+        logger.error("No tables could be fetched")
+        return None, None
+    participant_df = participant_upload_metrics(summaries_df)
+    study_df = study_metrics(participants_df, upload_df=participant_df)
+    os.makedirs(output_dir, exist_ok=True)
+    study_df.to_csv(os.path.join(output_dir, "study_metrics.csv"), index=False)
+    participant_df.to_csv(os.path.join(output_dir, "participant_metrics.csv"),
+                          index=False)
+    return study_df, participant_df
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Write participant metrics for one or more studies"
+    )
+    parser.add_argument("keyring_path")
+    parser.add_argument("study_ids", nargs="+")
+    parser.add_argument("--keyring-password", default=None)
+    parser.add_argument("--output-dir", default="metrics")
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args(argv)
+    import data_summaries  # only needed to read keyrings
+    keyring = data_summaries.read_keyring(args.keyring_path,
+                                          args.keyring_password)
+    study_df, _ = generate_metrics(keyring, args.study_ids, args.output_dir,
+                                   args.max_workers)
+    if study_df is not None:
+        print(study_df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
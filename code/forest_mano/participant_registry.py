@@ -0,0 +1,279 @@
+"""Cached participant table with fast filters and joins
+
+The participant table (/get-participant-table-data/v1) holds each
+participant's status, phone OS and registration and upload dates. The
+ParticipantRegistry fetches it once per study, keeps it in memory and
+optionally on disk for a configurable time to live, and stores it as a typed
+dataframe indexed by participant ID so other tables can be filtered or
+joined against it without Python loops.
+
+Example:
+    registry = ParticipantRegistry(keyring, cache_dir="cache", ttl=3600)
+    active_ids = registry.active_ids(study_id)
+    summaries_df = registry.filter_frame(summaries_df, study_id)
+"""
+
+import io
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+PARTICIPANT_TABLE_ENDPOINT = "/get-participant-table-data/v1"
+
+INACTIVE_STATUSES = ["Not Registered", "Permanently Retired"]
+
+DEFAULT_TTL = 3600
+
+# participant table column -> registry column
+PARTICIPANT_TABLE_COLUMNS = {
+    "Patient ID": "participant_id",
+    "Created On": "created_on",
+    "Status": "status",
+    "OS Type": "os_type",
+    "First Registration Date": "first_registration_date",
+    "Last Registration": "last_registration",
+    "Last Upload": "last_upload"
+}
+
+DATE_COLUMNS = ["created_on", "first_registration_date", "last_registration",
+                "last_upload"]
+CATEGORY_COLUMNS = ["status", "os_type"]
+
+
+def fetch_participant_table(keyring: dict, study_id: str,
+                            timeout: float = 120,
+                            session: requests.Session = None) -> bytes:
+    """Download one study's participant table as csv
+
+    Args:
+        keyring: Keyring read by read_keyring()
+        study_id: 24-character study ID
+        timeout: Seconds to wait for the server
+        session: Session to send the request on, so connections can be
+            reused across studies. Defaults to a one-off request.
+
+    Returns:
+        The csv body of the response
+
+    Raises:
+        RuntimeError: If the server does not return the table
+    """
+    response = (session or requests).post(
+        keyring["URL"].rstrip("/") + PARTICIPANT_TABLE_ENDPOINT,
+        data={"access_key": keyring["ACCESS_KEY"],
+              "secret_key": keyring["SECRET_KEY"],
+              "study_id": study_id, "data_format": "csv"},
+        timeout=timeout, allow_redirects=False
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code} fetching participant "
+                           f"table for {study_id}: {response.text[:300]}")
+    return response.content
+
+
+def parse_participant_table(csv_data) -> pd.DataFrame:
+    """Convert a participant table csv to a typed dataframe
+
+    Known columns are renamed to snake case, dates are parsed (timezone
+    information is dropped), and status and OS type become categoricals.
+    Other columns are kept as strings with their names lowercased.
+
+    Args:
+        csv_data: Bytes, text, or a path to a participant table csv
+
+    Returns:
+        Dataframe indexed by participant_id
+    """
+    if isinstance(csv_data, bytes):
+        csv_data = io.BytesIO(csv_data)
+    elif isinstance(csv_data, str) and not os.path.exists(csv_data):
+        csv_data = io.StringIO(csv_data)
+    participants_df = pd.read_csv(csv_data, dtype=str, keep_default_na=False)
+    participants_df.columns = [
+        PARTICIPANT_TABLE_COLUMNS.get(column.strip(),
+                                      column.strip().lower().replace(" ", "_"))
+        for column in participants_df.columns
+    ]
+    for column in DATE_COLUMNS:
+        if column not in participants_df:
+            participants_df[column] = pd.NaT
+            continue
+        dates = pd.to_datetime(participants_df[column].replace("", None),
+                               errors="coerce", format="ISO8601", utc=True)
+        participants_df[column] = dates.dt.tz_localize(None)
+    for column in CATEGORY_COLUMNS:
+        if column not in participants_df:
+            participants_df[column] = ""
+        participants_df[column] = participants_df[column].astype("category")
+    return participants_df.set_index("participant_id")
+
+
+class ParticipantRegistry:
+    """Participant tables for one or more studies, fetched on demand
+
+    Tables are kept in memory, and in cache_dir if it is given, for ttl
+    seconds before they are fetched again. The registry is safe to share
+    between threads.
+
+    Args:
+        keyring: Keyring read by read_keyring()
+        cache_dir: Folder to keep participant_table_<study_id>.csv files in.
+            If None, tables are only cached in memory.
+        ttl: Seconds a cached table is used before it is fetched again
+        fetch: Function (keyring, study_id) -> csv bytes, for tests or other
+            sources. Defaults to fetch_participant_table.
+    """
+
+    def __init__(self, keyring: dict = None, cache_dir: str = None,
+                 ttl: float = DEFAULT_TTL, fetch=fetch_participant_table):
+        self.keyring = keyring
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._fetch = fetch
+        self._tables = dict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, study_id: str) -> str:
+        return os.path.join(self.cache_dir, f"participant_table_{study_id}.csv")
+
+    def table(self, study_id: str, refresh: bool = False) -> pd.DataFrame:
+        """The participant table for a study, fetching it if it is stale
+
+        Args:
+            study_id: 24-character study ID
+            refresh: Fetch the table even if the cached copy is fresh
+
+        Returns:
+            Dataframe indexed by participant_id; see parse_participant_table
+        """
+        with self._lock:
+            now = time.time()
+            cached = self._tables.get(study_id)
+            if not refresh and cached is not None and now - cached[0] < self.ttl:
+                return cached[1]
+            if not refresh and self.cache_dir is not None:
+                path = self._cache_path(study_id)
+                if os.path.exists(path) and now - os.path.getmtime(path) < self.ttl:
+                    participants_df = parse_participant_table(path)
+                    self._tables[study_id] = (os.path.getmtime(path),
+                                              participants_df)
+                    return participants_df
+            logger.info("Fetching participant table for %s", study_id)
+            csv_data = self._fetch(self.keyring, study_id)
+            if self.cache_dir is not None:
+                path = self._cache_path(study_id)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(csv_data)
+                os.replace(path + ".tmp", path)
+            participants_df = parse_participant_table(csv_data)
+            self._tables[study_id] = (now, participants_df)
+            return participants_df
+
+    def invalidate(self, study_id: str = None):
+        """Forget cached tables (all studies if study_id is None)"""
+        with self._lock:
+            studies = [study_id] if study_id else list(self._tables)
+            for study in studies:
+                self._tables.pop(study, None)
+                if self.cache_dir is not None and os.path.exists(self._cache_path(study)):
+                    os.remove(self._cache_path(study))
+
+    def select(self, study_id: str, active_only: bool = True,
+               statuses: list = None, os_types: list = None,
+               registered_before: str = None,
+               uploaded_since: str = None) -> pd.DataFrame:
+        """Rows of the participant table that match every given filter
+
+        Args:
+            study_id: 24-character study ID
+            active_only: Drop participants whose status is in
+                INACTIVE_STATUSES
+            statuses: Keep only these statuses
+            os_types: Keep only these OS types ("ANDROID", "IOS")
+            registered_before: Keep only participants first registered
+                before this date
+            uploaded_since: Keep only participants whose last upload is on
+                or after this date
+
+        Returns:
+            Filtered participant table
+        """
+        participants_df = self.table(study_id)
+        keep = pd.Series(True, index=participants_df.index)
+        if active_only:
+            keep &= ~participants_df["status"].isin(INACTIVE_STATUSES)
+        if statuses is not None:
+            keep &= participants_df["status"].isin(statuses)
+        if os_types is not None:
+            keep &= participants_df["os_type"].isin(os_types)
+        if registered_before is not None:
+            keep &= (participants_df["first_registration_date"]
+                     < pd.Timestamp(registered_before))
+        if uploaded_since is not None:
+            keep &= participants_df["last_upload"] >= pd.Timestamp(uploaded_since)
+        return participants_df.loc[keep.to_numpy()]
+
+    def active_ids(self, study_id: str, **filters) -> list:
+        """IDs of participants that are not retired or unregistered
+
+        Keyword arguments are passed on to select.
+        """
+        return self.select(study_id, **filters).index.tolist()
+
+    def filter_frame(self, df: pd.DataFrame, study_id: str = None,
+                     id_column: str = "participant_id",
+                     study_column: str = "study_id",
+                     **filters) -> pd.DataFrame:
+        """Keep only the rows of df whose participant passes select's filters
+
+        Args:
+            df: Any dataframe with a participant ID column, such as data
+                volume summaries
+            study_id: 24-character study ID. If None, df may hold several
+                studies and each row is checked against the table of the
+                study in its study_column.
+            id_column: Name of the participant ID column in df
+            study_column: Name of the study ID column in df, used when
+                study_id is None
+            **filters: Passed on to select; active_only defaults to True
+
+        Returns:
+            The matching rows of df
+        """
+        if study_id is not None:
+            keep_ids = self.select(study_id, **filters).index
+            return df.loc[df[id_column].isin(keep_ids).to_numpy()]
+        keep = pd.Series(False, index=df.index)
+        for study in df[study_column].dropna().unique():
+            keep_ids = self.select(study, **filters).index
+            keep |= (df[study_column] == study) & df[id_column].isin(keep_ids)
+        return df.loc[keep.to_numpy()]
+
+    def join(self, df: pd.DataFrame, study_id: str,
+             columns: list = None, id_column: str = "participant_id",
+             how: str = "left") -> pd.DataFrame:
+        """Add participant table columns to df
+
+        Args:
+            df: Any dataframe with a participant ID column
+            study_id: 24-character study ID
+            columns: Participant table columns to add. Defaults to status,
+                os_type and first_registration_date.
+            id_column: Name of the participant ID column in df
+            how: Join type, as in pandas.DataFrame.join
+
+        Returns:
+            df with the requested columns added
+        """
+        if columns is None:
+            columns = ["status", "os_type", "first_registration_date"]
+        return df.join(self.table(study_id)[columns], on=id_column, how=how)
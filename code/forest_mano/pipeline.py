@@ -0,0 +1,640 @@
+"""Run the download -> Forest -> concatenate pipeline for many studies
+
+This automates the steps of forest_and_mano_usage_new.ipynb. A JSON or YAML
+file lists studies and the stages to run for each:
+
+    {
+        "keyring_path": "keyring_studies.py",
+        "max_workers": 4,
+        "memory_limit_gb": 16,
+        "studies": [
+            {
+                "name": "study_a",
+                "study_id": "STUDY_ID",
+                "output_dir": "study_a",
+                "tz_str": "America/New_York",
+                "time_start": "2024-01-01",
+                "data_streams": ["gps", "calls", "texts", "accelerometer"],
+                "stages": ["download", "jasmine", "willow", "oak"]
+            }
+        ]
+    }
+
+Every study gets a dependency graph: Forest trees depend on the download and
+each tree's concatenate_summaries step depends on the tree. Independent
+studies and independent trees run concurrently in a process pool. A stage is
+skipped when the fingerprint of its inputs (parameters plus the names, sizes
+and modification times of its input files) matches the last successful run.
+
+With --pipelined, each study's Forest trees run per participant as soon as
+that participant's data is downloaded, instead of after the whole download
+(see run_study_pipelined).
+
+A study's "download" options may set "status_path", a file in output_dir
+where download progress, throughput and ETA are kept as JSON for monitoring
+(see progress.ProgressTracker).
+
+Usage:
+    python pipeline.py pipeline_config.json [--max-workers 4] [--force] [--dry-run]
+        [--pipelined]
+"""
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+import helper_functions
+from progress import ProgressTracker
+
+
+logger = logging.getLogger(__name__)
+
+FOREST_TREES = ["jasmine", "willow", "sycamore", "oak"]
+
+STAGES = ["download"] + FOREST_TREES
+
+# Output folders written by each tree, relative to the study output_dir
+TREE_OUTPUT_DIRS = {
+    "jasmine": "gps_output",
+    "willow": "comm_output",
+    "sycamore": "survey_output",
+    "oak": "accel_output"
+}
+
+# Trees whose per-participant outputs are concatenated with
+# helper_functions.concatenate_summaries, and the resulting filename
+CONCATENATED_FILENAMES = {
+    "jasmine": "gps_summaries.csv",
+    "willow": "comm_summaries.csv",
+    "oak": "accel_summaries.csv"
+}
+
+# Raw data streams read by each tree
+TREE_DATA_STREAMS = {
+    "jasmine": ["gps"],
+    "willow": ["calls", "texts", "identifiers"],
+    "sycamore": ["survey_answers", "survey_timings", "identifiers"],
+    "oak": ["accelerometer", "identifiers"]
+}
+
+# Trees that can run on one participant at a time. Sycamore writes
+# study-wide summaries, so in pipelined runs it runs once downloads finish.
+PER_PARTICIPANT_TREES = ["jasmine", "willow", "oak"]
+
+STATE_FILENAME = "pipeline_state.json"
+
+# Seconds between progress reports in pipelined runs
+PROGRESS_INTERVAL = 30
+
+
+def read_pipeline_config(config_path: str) -> dict:
+    """Read a pipeline configuration file
+
+    Args:
+        config_path: Path to a .json, .yaml or .yml file
+
+    Returns:
+        Dict with the pipeline configuration
+    """
+    with open(config_path) as f:
+        if config_path.endswith((".yaml", ".yml")):
+            import yaml  # only needed for YAML configs
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    for study in config.get("studies", []):
+        study.setdefault("name", study["study_id"])
+        study.setdefault("output_dir", study["name"])
+        study.setdefault("stages", list(STAGES))
+        unknown_stages = set(study["stages"]) - set(STAGES)
+        if unknown_stages:
+            raise ValueError(f"Unknown stages for {study['name']}: "
+                             f"{sorted(unknown_stages)}")
+    return config
+
+
+def build_stage_graph(config: dict) -> dict:
+    """Build the dependency graph for every study in a pipeline config
+
+    Args:
+        config: Output of read_pipeline_config
+
+    Returns:
+        Dict mapping node keys ("study_name/stage") to a dict with the stage
+        name, the study dict and a list of the node keys it depends on
+    """
+    graph = dict()
+    for study in config["studies"]:
+        name = study["name"]
+        stages = study["stages"]
+        for stage in stages:
+            depends_on = []
+            if stage in FOREST_TREES and "download" in stages:
+                depends_on.append(f"{name}/download")
+            graph[f"{name}/{stage}"] = {"stage": stage, "study": study,
+                                        "depends_on": depends_on}
+            if stage in CONCATENATED_FILENAMES:
+                graph[f"{name}/concatenate_{stage}"] = {
+                    "stage": "concatenate_" + stage, "study": study,
+                    "depends_on": [f"{name}/{stage}"]
+                }
+    return graph
+
+
+def _raw_data_dir(study: dict) -> str:
+    return os.path.join(study["output_dir"], "raw_data")
+
+
+def _tree_output_dir(study: dict, tree: str) -> str:
+    return os.path.join(study["output_dir"], TREE_OUTPUT_DIRS[tree])
+
+
+def fingerprint_files(paths: list) -> str:
+    """Hash the names, sizes and modification times of files under paths"""
+    hasher = hashlib.sha256()
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                stat = os.stat(file_path)
+                hasher.update(
+                    f"{file_path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode()
+                )
+    return hasher.hexdigest()
+
+
+def stage_fingerprint(stage: str, study: dict) -> str:
+    """Fingerprint the inputs of one stage
+
+    The download stage depends only on its parameters (and today's date if
+    time_end is open-ended). Forest trees depend on the raw data streams they
+    read, and concatenation depends on the tree's output folder.
+    """
+    params = {key: value for key, value in study.items() if key != "stages"}
+    hasher = hashlib.sha256(
+        json.dumps([stage, params], sort_keys=True, default=str).encode()
+    )
+    if stage == "download":
+        if study.get("time_end") is None:
+            hasher.update(datetime.now().strftime("%Y-%m-%d").encode())
+    elif stage in FOREST_TREES:
+        raw_data_dir = _raw_data_dir(study)
+        stream_dirs = []
+        if os.path.isdir(raw_data_dir):
+            for participant in sorted(os.listdir(raw_data_dir)):
+                stream_dirs.extend(
+                    os.path.join(raw_data_dir, participant, stream)
+                    for stream in TREE_DATA_STREAMS[stage]
+                )
+        hasher.update(fingerprint_files(stream_dirs).encode())
+    else:
+        tree = stage[len("concatenate_"):]
+        hasher.update(fingerprint_files([_tree_output_dir(study, tree)]).encode())
+    return hasher.hexdigest()
+
+
+def _forest_frequency(study: dict, tree: str):
+    from forest.constants import Frequency
+    frequency = study.get(tree, {}).get("frequency", "daily")
+    return Frequency[frequency.upper()]
+
+
+def _download_progress(study: dict) -> ProgressTracker:
+    """Progress tracker writing to the study's download status_path, if
+    one is configured"""
+    status_path = study.get("download", {}).get("status_path")
+    if status_path is None:
+        return None
+    return ProgressTracker(status_path=os.path.join(study["output_dir"],
+                                                    status_path))
+
+
+def run_stage(stage: str, study: dict, keyring: dict) -> str:
+    """Run one pipeline stage for one study
+
+    Forest is imported inside each branch so that a process only loads the
+    tree it runs.
+
+    Returns:
+        The node key, so the scheduler can match results to nodes
+    """
+    raw_data_dir = _raw_data_dir(study)
+    tz_str = study.get("tz_str", "UTC")
+    beiwe_ids = study.get("beiwe_ids") or None
+    options = study.get(stage, {})
+    if stage == "download":
+        os.makedirs(study["output_dir"], exist_ok=True)
+        helper_functions.download_data(
+            keyring, study["study_id"], raw_data_dir, tz_str,
+            study.get("beiwe_ids", []), study.get("time_start", "2008-01-01"),
+            study.get("time_end"), study.get("data_streams"),
+            progress=_download_progress(study)
+        )
+    elif stage == "jasmine":
+        from forest.jasmine.traj2stats import gps_stats_main, Hyperparameters
+        parameters = Hyperparameters()
+        for key, value in options.get("parameters", {}).items():
+            setattr(parameters, key, value)
+        gps_stats_main(
+            raw_data_dir, _tree_output_dir(study, stage), tz_str,
+            _forest_frequency(study, stage), options.get("save_traj", False),
+            places_of_interest=options.get("places_of_interest"),
+            participant_ids=beiwe_ids, parameters=parameters
+        )
+    elif stage == "willow":
+        from forest.willow.log_stats import log_stats_main
+        log_stats_main(raw_data_dir, _tree_output_dir(study, stage), tz_str,
+                       _forest_frequency(study, stage), beiwe_ids=beiwe_ids)
+    elif stage == "sycamore":
+        from forest.sycamore.base import compute_survey_stats
+        compute_survey_stats(
+            study_folder=raw_data_dir,
+            output_folder=_tree_output_dir(study, stage),
+            config_path=options.get("config_path"), tz_str=tz_str,
+            users=beiwe_ids, start_date=study.get("time_start"),
+            end_date=study.get("time_end"),
+            interventions_filepath=options.get("interventions_filepath")
+        )
+    elif stage == "oak":
+        from forest.oak.base import run
+        run(raw_data_dir, _tree_output_dir(study, stage), tz_str,
+            _forest_frequency(study, stage), users=beiwe_ids)
+    elif stage.startswith("concatenate_"):
+        tree = stage[len("concatenate_"):]
+        helper_functions.concatenate_summaries(
+            dir_path=_tree_output_dir(study, tree),
+            output_filename=CONCATENATED_FILENAMES[tree]
+        )
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    return f"{study['name']}/{stage}"
+
+
+def _limit_resources(memory_limit_gb: float):
+    """Process pool initializer that caps each worker's address space"""
+    if memory_limit_gb is None:
+        return
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    limit = int(memory_limit_gb * 1024 ** 3)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def read_state(state_dir: str) -> dict:
+    state_path = os.path.join(state_dir, STATE_FILENAME)
+    if not os.path.exists(state_path):
+        return dict()
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def write_state(state_dir: str, state: dict):
+    os.makedirs(state_dir, exist_ok=True)
+    state_path = os.path.join(state_dir, STATE_FILENAME)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def run_pipeline(config: dict, keyring: dict, max_workers: int = None,
+                 force: bool = False, dry_run: bool = False) -> dict:
+    """Run every stage in a pipeline config, respecting dependencies
+
+    Args:
+        config: Output of read_pipeline_config
+        keyring: Keyring used by the download stage
+        max_workers: Number of worker processes. Defaults to the config's
+            max_workers, then to the executor default.
+        force: Run every stage even if its inputs haven't changed
+        dry_run: Log what would run without running anything
+
+    Returns:
+        Dict mapping node keys to "completed", "skipped", "failed" or
+        "blocked" (a dependency failed)
+    """
+    graph = build_stage_graph(config)
+    state_dir = config.get("state_dir", ".pipeline_state")
+    state = read_state(state_dir)
+    if max_workers is None:
+        max_workers = config.get("max_workers")
+    results = dict()
+    fingerprints = dict()
+    pending = dict(graph)
+    running = dict()
+
+    with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_limit_resources,
+            initargs=(config.get("memory_limit_gb"),)
+    ) as executor:
+        while pending or running:
+            for key, node in list(pending.items()):
+                dependency_results = [results.get(dep) for dep in node["depends_on"]]
+                if any(result in ("failed", "blocked")
+                       for result in dependency_results):
+                    logger.error("Not running %s because a dependency failed", key)
+                    results[key] = "blocked"
+                    del pending[key]
+                    continue
+                if not all(result in ("completed", "skipped")
+                           for result in dependency_results):
+                    continue
+                del pending[key]
+                # fingerprint once dependencies are done so new inputs count
+                fingerprint = stage_fingerprint(node["stage"], node["study"])
+                dependency_ran = any(result == "completed"
+                                     for result in dependency_results)
+                if (not force and not dependency_ran
+                        and state.get(key, {}).get("fingerprint") == fingerprint):
+                    logger.info("Skipping %s; inputs unchanged since %s", key,
+                                state[key]["completed_at"])
+                    results[key] = "skipped"
+                    continue
+                if dry_run:
+                    logger.info("Would run %s", key)
+                    results[key] = "skipped"
+                    continue
+                logger.info("Starting %s", key)
+                fingerprints[key] = fingerprint
+                future = executor.submit(run_stage, node["stage"],
+                                         node["study"], keyring)
+                running[future] = key
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.exception("Stage %s failed: %s", key, e)
+                    results[key] = "failed"
+                    continue
+                logger.info("Finished %s", key)
+                results[key] = "completed"
+                # Re-fingerprint now that the stage is done; a tree's own
+                # outputs don't change its inputs but downloads do.
+                state[key] = {
+                    "fingerprint": stage_fingerprint(graph[key]["stage"],
+                                                     graph[key]["study"])
+                    if graph[key]["stage"] != "download" else fingerprints[key],
+                    "completed_at": datetime.now().isoformat()
+                }
+                write_state(state_dir, state)
+    return results
+
+
+def run_participant_tree(tree: str, study: dict, participant_id: str,
+                         keyring: dict) -> str:
+    """Run one Forest tree on one participant's data
+
+    Returns:
+        The node key, "study_name/participant_id/tree"
+    """
+    run_stage(tree, dict(study, beiwe_ids=[participant_id]), keyring)
+    return f"{study['name']}/{participant_id}/{tree}"
+
+
+class PipelineProgress:
+    """Counts for the combined download and Forest progress report"""
+
+    def __init__(self, name: str, num_participants: int = None):
+        self.name = name
+        self.num_participants = num_participants
+        self.downloaded = set()
+        self.counts = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+        self._last_report = 0
+
+    def report(self) -> str:
+        total = f"/{self.num_participants}" if self.num_participants else ""
+        return (f"{self.name}: {len(self.downloaded)}{total} participants "
+                f"downloaded; Forest {self.counts['completed']} completed, "
+                f"{self.counts['failed']} failed, {self.counts['running']} "
+                f"running, {self.counts['queued']} waiting")
+
+    def log(self, force: bool = False):
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            logger.info(self.report())
+
+
+def run_study_pipelined(study: dict, keyring: dict, max_workers: int = None,
+                        max_queued: int = None,
+                        memory_limit_gb: float = None) -> dict:
+    """Download a study and run Forest on each participant as they arrive
+
+    Downloads run in a background thread and report each finished
+    participant (or, with split_streams, each finished stream) on a queue.
+    A tree in PER_PARTICIPANT_TREES is submitted to the process pool for a
+    participant as soon as the streams it reads are downloaded. The queue
+    holds at most max_queued participants; it is only read while the pool
+    has a free worker, so when Forest falls behind, downloads pause instead
+    of piling up. After the downloads, sycamore and the concatenate steps
+    run for the whole study.
+
+    Args:
+        study: A study from read_pipeline_config. Its download options may
+            include split_streams, max_concurrent_downloads and status_path.
+        keyring: Keyring used by the download
+        max_workers: Number of Forest worker processes
+        max_queued: Size of the download queue. Defaults to max_workers.
+        memory_limit_gb: Address space limit for each worker process
+
+    Returns:
+        Dict mapping "study_name/participant_id/tree" and
+        "study_name/stage" keys (including download) to "completed",
+        "failed" or "blocked" (some of the streams the tree reads failed to
+        download)
+    """
+    name = study["name"]
+    stages = study["stages"]
+    trees = [tree for tree in PER_PARTICIPANT_TREES if tree in stages]
+    requested_streams = set(study.get("data_streams")
+                            or helper_functions.ALL_DATA_STREAMS)
+    # A tree waits for the streams it reads that are being downloaded, or
+    # for the whole participant if it reads none of them
+    tree_streams = {tree: set(TREE_DATA_STREAMS[tree]) & requested_streams
+                    or requested_streams for tree in trees}
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    arrivals = queue.Queue(maxsize=max_queued or max_workers)
+    finished = object()
+    progress = PipelineProgress(name, len(study.get("beiwe_ids") or []))
+    results = dict()
+    download_error = []
+
+    def download():
+        options = study.get("download", {})
+        try:
+            if "download" not in stages:  # run on what is already on disk
+                raw_data_dir = _raw_data_dir(study)
+                for participant_id in sorted(os.listdir(raw_data_dir)):
+                    if (not participant_id.startswith(".")
+                            and os.path.isdir(os.path.join(raw_data_dir, participant_id))):
+                        arrivals.put((participant_id, list(requested_streams), []))
+                return
+            os.makedirs(study["output_dir"], exist_ok=True)
+            helper_functions.download_data(
+                keyring, study["study_id"], _raw_data_dir(study),
+                study.get("tz_str", "UTC"), study.get("beiwe_ids", []),
+                study.get("time_start", "2008-01-01"), study.get("time_end"),
+                study.get("data_streams"),
+                split_streams=options.get("split_streams", False),
+                max_concurrent_downloads=options.get(
+                    "max_concurrent_downloads", 4),
+                on_downloaded=lambda u, streams, failed_streams: arrivals.put(
+                    (u, streams, failed_streams)),
+                progress=_download_progress(study)
+            )
+        except BaseException as e:  # report in the main thread
+            download_error.append(e)
+        finally:
+            arrivals.put(finished)
+
+    received = dict()
+    failed = dict()
+    submitted = set()
+    running = dict()
+    downloader = threading.Thread(target=download, name=f"download-{name}",
+                                  daemon=True)
+
+    def reap(futures):
+        for future in futures:
+            key = running.pop(future)
+            progress.counts["running"] -= 1
+            try:
+                future.result()
+                results[key] = "completed"
+                progress.counts["completed"] += 1
+            except Exception as e:
+                logger.exception("Forest failed for %s: %s", key, e)
+                results[key] = "failed"
+                progress.counts["failed"] += 1
+
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_limit_resources,
+                             initargs=(memory_limit_gb,)) as executor:
+        downloader.start()
+        while True:
+            if len(running) >= max_workers:
+                done, _ = wait(running, timeout=PROGRESS_INTERVAL,
+                               return_when=FIRST_COMPLETED)
+                reap(done)
+                progress.log()
+                continue
+            try:
+                item = arrivals.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                reap([future for future in list(running) if future.done()])
+                progress.log()
+                continue
+            if item is finished:
+                break
+            participant_id, streams, failed_streams = item
+            received.setdefault(participant_id, set()).update(streams)
+            failed.setdefault(participant_id, set()).update(failed_streams)
+            if (received[participant_id] >= requested_streams
+                    and not failed[participant_id]):
+                progress.downloaded.add(participant_id)
+            for tree in trees:
+                if ((participant_id, tree) in submitted
+                        or not received[participant_id] >= tree_streams[tree]):
+                    continue
+                submitted.add((participant_id, tree))
+                if failed[participant_id] & tree_streams[tree]:
+                    # don't run Forest on partial data
+                    logger.error("Not running %s for %s: download of %s "
+                                 "failed", tree, participant_id,
+                                 ", ".join(sorted(failed[participant_id]
+                                                  & tree_streams[tree])))
+                    results[f"{name}/{participant_id}/{tree}"] = "blocked"
+                    continue
+                future = executor.submit(run_participant_tree, tree, study,
+                                         participant_id, keyring)
+                running[future] = f"{name}/{participant_id}/{tree}"
+                progress.counts["running"] += 1
+            reap([future for future in list(running) if future.done()])
+            progress.counts["queued"] = arrivals.qsize()
+            progress.log()
+        downloader.join()
+        if download_error:
+            logger.error("Download failed for %s: %s", name, download_error[0])
+            results[f"{name}/download"] = "failed"
+        elif any(failed.values()):
+            logger.error("Download failed for %s: %s", name, ", ".join(
+                sorted(pid for pid, streams in failed.items() if streams)))
+            results[f"{name}/download"] = "failed"
+        elif "download" in stages:
+            results[f"{name}/download"] = "completed"
+        progress.counts["queued"] = 0
+        progress.log(force=True)
+
+        # Study-wide stages, once every participant's trees are done
+        reap(wait(running).done)
+        study_stages = (["sycamore"] if "sycamore" in stages else []) + [
+            "concatenate_" + tree for tree in stages
+            if tree in CONCATENATED_FILENAMES
+        ]
+        for stage in study_stages:
+            future = executor.submit(run_stage, stage, study, keyring)
+            running[future] = f"{name}/{stage}"
+            progress.counts["running"] += 1
+        reap(wait(running).done)
+    progress.log(force=True)
+    return results
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Run the download -> Forest -> concatenate pipeline "
+                    "for several Beiwe studies"
+    )
+    parser.add_argument("config_path", help="Pipeline configuration (.json or .yaml)")
+    parser.add_argument("--max-workers", type=int, default=None,
+                        help="Number of worker processes")
+    parser.add_argument("--force", action="store_true",
+                        help="Run stages even if their inputs haven't changed")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Show which stages would run")
+    parser.add_argument("--pipelined", action="store_true",
+                        help="Run Forest on each participant as soon as "
+                             "their data is downloaded")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    config = read_pipeline_config(args.config_path)
+    keyring = dict()
+    if "keyring_path" in config:
+        import data_summaries  # only needed to read keyrings
+        keyring = data_summaries.read_keyring(config["keyring_path"],
+                                              config.get("keyring_password"))
+    if args.pipelined:
+        results = dict()
+        for study in config["studies"]:
+            results.update(run_study_pipelined(
+                study, keyring, args.max_workers or config.get("max_workers"),
+                config.get("max_queued"), config.get("memory_limit_gb")
+            ))
+    else:
+        results = run_pipeline(config, keyring, args.max_workers, args.force,
+                               args.dry_run)
+    for key in sorted(results):
+        print(f"{key}: {results[key]}")
+    if any(result in ("failed", "blocked") for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
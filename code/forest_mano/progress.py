@@ -0,0 +1,272 @@
+"""Progress, throughput and ETA reporting for downloads
+
+A ProgressTracker counts the bytes received and files extracted for each
+participant and overall, and estimates the time remaining. When data volume
+summaries are available, the estimate uses the bytes each remaining
+participant is expected to send, scaled by how archive sizes compared to the
+summaries for the participants already downloaded; otherwise it uses the
+average time per participant.
+
+Progress is reported to callbacks, and to a JSON status file that is
+replaced atomically so monitoring can poll it at any time.
+
+Example:
+    tracker = ProgressTracker(status_path="download_status.json",
+                              callbacks=[print_progress])
+    tracker.set_participants(users, expected_bytes(summaries_df))
+    download_data(..., progress=tracker)
+"""
+
+from collections import deque
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds of history used for the current throughput
+THROUGHPUT_WINDOW = 30
+
+PENDING = "pending"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def format_bytes(num_bytes: float) -> str:
+    """Human readable byte count, e.g. "12.3 MB\""""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1000:
+            return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes:.0f} B"
+        num_bytes /= 1000
+    return f"{num_bytes:.1f} TB"
+
+
+def print_progress(status: dict):
+    """Callback that prints one line of overall progress"""
+    overall = status["overall"]
+    total = overall["participants_total"] or "?"
+    eta = overall["eta_seconds"]
+    eta_text = f", ETA {eta / 60:.0f} min" if eta is not None else ""
+    print(f"{overall['participants_done']}/{total} participants, "
+          f"{format_bytes(overall['bytes_received'])} received at "
+          f"{format_bytes(overall['throughput_bps'])}/s{eta_text}", flush=True)
+
+
+class ProgressTracker:
+    """Download progress for one run of download_data
+
+    Safe to update from several threads. Callbacks receive the status dict
+    described in status(); they and the status file are updated at most
+    every `interval` seconds while bytes arrive, and always when a
+    participant finishes.
+
+    Args:
+        status_path: JSON file to write the status to, or None
+        callbacks: Functions called with the status dict
+        interval: Seconds between updates while bytes arrive
+    """
+
+    def __init__(self, status_path: str = None, callbacks: list = None,
+                 interval: float = 1.0):
+        self.status_path = status_path
+        self.callbacks = list(callbacks or [])
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._participants = dict()
+        self._started = time.monotonic()
+        self._started_at = _now_iso()
+        self._history = deque()
+        self._bytes_received = 0
+        self._last_report = 0
+        self._finished = False
+
+    def set_participants(self, participant_ids: list,
+                         expected_bytes=None, requests_per_participant: int = 1):
+        """Register the participants that will be downloaded
+
+        Args:
+            participant_ids: Participants to download
+            expected_bytes: Mapping (e.g. a Series from
+                download_planning.expected_bytes) of participant ID to the
+                bytes the data volume summaries show for the window
+            requests_per_participant: Requests each participant is split
+                into; a participant is done once all of them finish
+        """
+        with self._lock:
+            for participant_id in participant_ids:
+                expected = None
+                if expected_bytes is not None and participant_id in expected_bytes:
+                    expected = float(expected_bytes[participant_id])
+                self._participants[participant_id] = {
+                    "state": PENDING, "bytes_received": 0,
+                    "expected_bytes": expected, "files_extracted": 0,
+                    "bytes_extracted": 0, "requests_left":
+                        requests_per_participant,
+                    "started": None, "elapsed_seconds": None
+                }
+
+    def participant_ids(self) -> list:
+        """IDs of the participants registered so far"""
+        with self._lock:
+            return list(self._participants)
+
+    def _participant(self, participant_id: str) -> dict:
+        if participant_id not in self._participants:
+            self._participants[participant_id] = {
+                "state": PENDING, "bytes_received": 0, "expected_bytes": None,
+                "files_extracted": 0, "bytes_extracted": 0,
+                "requests_left": 1, "started": None, "elapsed_seconds": None
+            }
+        return self._participants[participant_id]
+
+    def start(self, participant_id: str):
+        """Mark a participant (or one of its requests) as downloading"""
+        with self._lock:
+            participant = self._participant(participant_id)
+            if participant["started"] is None:
+                participant["started"] = time.monotonic()
+            participant["state"] = DOWNLOADING
+        self._report()
+
+    def add_bytes(self, participant_id: str, num_bytes: int):
+        """Count bytes received for a participant"""
+        with self._lock:
+            self._participant(participant_id)["bytes_received"] += num_bytes
+            self._bytes_received += num_bytes
+        self._report()
+
+    def finish(self, participant_id: str, files_extracted: int = 0,
+               bytes_extracted: int = 0, failed: bool = False):
+        """Record the end of one of a participant's requests"""
+        with self._lock:
+            participant = self._participant(participant_id)
+            participant["files_extracted"] += files_extracted
+            participant["bytes_extracted"] += bytes_extracted
+            participant["requests_left"] -= 1
+            if failed:
+                participant["state"] = FAILED
+            if participant["requests_left"] <= 0:
+                if participant["state"] != FAILED:
+                    participant["state"] = DONE
+                if participant["started"] is not None:
+                    participant["elapsed_seconds"] = (time.monotonic()
+                                                      - participant["started"])
+        self._report(force=True)
+
+    def close(self):
+        """Write the final status"""
+        self._finished = True
+        self._report(force=True)
+
+    def _throughput(self, now: float) -> float:
+        """Bytes per second over the last THROUGHPUT_WINDOW seconds"""
+        self._history.append((now, self._bytes_received))
+        while len(self._history) > 2 and now - self._history[1][0] > THROUGHPUT_WINDOW:
+            self._history.popleft()
+        start_time, start_bytes = self._history[0]
+        if now - start_time <= 0:
+            elapsed = now - self._started
+            return self._bytes_received / elapsed if elapsed > 0 else 0.0
+        return (self._bytes_received - start_bytes) / (now - start_time)
+
+    def _eta(self, throughput: float, elapsed: float) -> float:
+        participants = self._participants.values()
+        finished = [p for p in participants if p["state"] in (DONE, FAILED)]
+        remaining = [p for p in participants if p["state"] not in (DONE, FAILED)]
+        if not remaining:
+            return 0.0
+        # Compare archive sizes with the summaries for finished participants
+        received = sum(p["bytes_received"] for p in finished
+                       if p["expected_bytes"])
+        expected = sum(p["expected_bytes"] for p in finished
+                       if p["expected_bytes"])
+        if (throughput > 0 and expected > 0
+                and all(p["expected_bytes"] is not None for p in remaining)):
+            ratio = received / expected
+            bytes_left = sum(max(p["expected_bytes"] * ratio
+                                 - p["bytes_received"], 0) for p in remaining)
+            return bytes_left / throughput
+        if finished:
+            return elapsed / len(finished) * len(remaining)
+        return None
+
+    def status(self) -> dict:
+        """Current progress
+
+        Returns:
+            Dict with "overall" (bytes_received, expected_bytes,
+            throughput_bps, average_bps, files_extracted, bytes_extracted,
+            participants_total, participants_done, participants_failed,
+            elapsed_seconds, eta_seconds) and "participants" (state and
+            counts for each participant), plus timestamps
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._started
+            throughput = self._throughput(now)
+            participants = {
+                participant_id: {key: value for key, value in p.items()
+                                 if key not in ("started", "requests_left")}
+                for participant_id, p in self._participants.items()
+            }
+            expected = [p["expected_bytes"] for p in participants.values()]
+            overall = {
+                "bytes_received": self._bytes_received,
+                "expected_bytes": (sum(expected) if expected and None not in expected
+                                   else None),
+                "throughput_bps": throughput,
+                "average_bps": self._bytes_received / elapsed if elapsed > 0 else 0.0,
+                "files_extracted": sum(p["files_extracted"]
+                                       for p in participants.values()),
+                "bytes_extracted": sum(p["bytes_extracted"]
+                                       for p in participants.values()),
+                "participants_total": len(participants),
+                "participants_done": sum(p["state"] == DONE
+                                         for p in participants.values()),
+                "participants_failed": sum(p["state"] == FAILED
+                                           for p in participants.values()),
+                "elapsed_seconds": elapsed,
+                "eta_seconds": 0.0 if self._finished else self._eta(throughput,
+                                                                    elapsed)
+            }
+        return {"started_at": self._started_at, "updated_at": _now_iso(),
+                "finished": self._finished, "overall": overall,
+                "participants": participants}
+
+    def _report(self, force: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+        status = self.status()
+        if self.status_path is not None:
+            write_status(self.status_path, status)
+        for callback in self.callbacks:
+            try:
+                callback(status)
+            except Exception as e:  # a broken callback shouldn't stop downloads
+                logger.warning("Progress callback failed: %s", e)
+
+
+def write_status(status_path: str, status: dict):
+    """Write a status dict as JSON, replacing the file atomically"""
+    tmp_path = f"{status_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(status, f, indent=1)
+    os.replace(tmp_path, status_path)
+
+
+def read_status(status_path: str) -> dict:
+    """Read a status file written by a ProgressTracker"""
+    with open(status_path) as f:
+        return json.load(f)
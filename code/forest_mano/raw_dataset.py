@@ -0,0 +1,331 @@
+"""Convert raw sensor streams into a partitioned Parquet dataset
+
+Analyses over raw accelerometer, gyro or GPS data otherwise re-parse
+thousands of small hourly csv files. convert_to_dataset, run after
+download_data, writes each participant's stream data as one Parquet file per
+UTC day:
+
+    dataset_dir/participant_id=<id>/stream=<stream>/date=<YYYY-MM-DD>/part.parquet
+
+Timestamps are stored as UTC datetimes and sensor readings as float32
+(latitude and longitude stay float64, which float32 would round to about a
+metre). The layout is hive-style, so pyarrow.dataset and other Parquet
+readers can filter on the partition columns. A sources file in each
+participant's folder records which hourly files each day was built from, so
+later runs only rewrite the days that gained or changed hours.
+
+Example:
+    convert_to_dataset("raw_data", "raw_dataset", data_streams=["gps"])
+    gps_df = read_dataset("raw_dataset", "abc123", "gps",
+                          "2024-03-01", "2024-04-01")
+
+Usage:
+    python raw_dataset.py raw_data raw_dataset [--streams gps accelerometer]
+        [--participants abc123 ...] [--max-workers 4]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from raw_storage import list_raw_files, read_raw_csv
+
+
+logger = logging.getLogger(__name__)
+
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+DATASET_STREAMS = ["accelerometer", "gyro", "magnetometer", "gps"]
+
+SOURCES_FILENAME = "_sources.json"
+
+PART_FILENAME = "part.parquet"
+
+# Columns stored as numbers when every value parses; float32 unless listed
+# in FLOAT64_COLUMNS
+NUMERIC_COLUMNS = {"x", "y", "z", "accuracy", "latitude", "longitude",
+                   "altitude"}
+FLOAT64_COLUMNS = {"latitude", "longitude"}
+
+
+def _check_parquet():
+    if not PARQUET_AVAILABLE:
+        raise ImportError("The raw dataset needs pyarrow (pip install pyarrow)")
+
+
+def partition_dir(dataset_dir: str, participant_id: str, stream: str,
+                  date: str) -> str:
+    """Folder holding one participant's stream data for one UTC day"""
+    return os.path.join(dataset_dir, f"participant_id={participant_id}",
+                        f"stream={stream}", f"date={date}")
+
+
+def hour_files_by_date(stream_dir: str) -> dict:
+    """Raw files of a stream folder grouped by the UTC date in their names
+
+    Returns:
+        Dict mapping "YYYY-MM-DD" to sorted file paths
+    """
+    by_date = dict()
+    for path in list_raw_files(stream_dir):
+        by_date.setdefault(os.path.basename(path)[:10], []).append(path)
+    return by_date
+
+
+def read_hour_files(paths: list) -> pd.DataFrame:
+    """Read hourly raw files into one typed dataframe
+
+    The millisecond timestamp column becomes a UTC datetime, the redundant
+    "UTC time" text is dropped, and sensor readings become floats.
+
+    Returns:
+        Dataframe sorted by timestamp
+    """
+    frames = []
+    for path in paths:
+        try:
+            frames.append(read_raw_csv(path, dtype=str, keep_default_na=False))
+        except pd.errors.EmptyDataError:
+            logger.warning("Skipping empty raw file %s", path)
+    if not frames:
+        return pd.DataFrame({"timestamp": pd.Series(
+            [], dtype="datetime64[ms, UTC]")})
+    stream_df = pd.concat(frames, ignore_index=True)
+    stream_df.columns = stream_df.columns.str.strip()
+    stream_df = stream_df.drop(columns=["UTC time"], errors="ignore")
+    stream_df["timestamp"] = pd.to_datetime(
+        pd.to_numeric(stream_df["timestamp"], errors="coerce"), unit="ms",
+        utc=True
+    ).astype("datetime64[ms, UTC]")
+    for column in stream_df.columns:
+        if column not in NUMERIC_COLUMNS:
+            continue
+        values = pd.to_numeric(stream_df[column].replace("", None),
+                               errors="coerce")
+        # keep text such as "unknown" accuracy rather than losing it
+        if values.notna().sum() < (stream_df[column] != "").sum():
+            continue
+        stream_df[column] = values.astype(
+            np.float64 if column in FLOAT64_COLUMNS else np.float32)
+    stream_df = stream_df.loc[stream_df["timestamp"].notna()]
+    return stream_df.sort_values("timestamp", kind="stable", ignore_index=True)
+
+
+def _file_signature(path: str) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _write_partition(stream_df: pd.DataFrame, path: str):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pandas(stream_df, preserve_index=False),
+                   tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def convert_participant(raw_dir: str, dataset_dir: str, participant_id: str,
+                        data_streams: list = None,
+                        sources: dict = None) -> tuple:
+    """Convert one participant's new or changed days
+
+    Args:
+        raw_dir: Folder written by download_data
+        dataset_dir: Dataset folder
+        participant_id: Participant to convert
+        data_streams: Streams to convert. Defaults to DATASET_STREAMS.
+        sources: The participant's sources file (see read_sources), mapping
+            "stream/date" to {filename: [size, mtime_ns]}
+
+    Returns:
+        (participant_id, updated sources, counts) where counts has
+        partitions_written, partitions_unchanged, files_read and rows_written
+    """
+    _check_parquet()
+    sources = dict(sources or {})
+    counts = {"partitions_written": 0, "partitions_unchanged": 0,
+              "files_read": 0, "rows_written": 0}
+    for stream in data_streams or DATASET_STREAMS:
+        stream_dir = os.path.join(raw_dir, participant_id, stream)
+        for date, paths in sorted(hour_files_by_date(stream_dir).items()):
+            key = f"{stream}/{date}"
+            signature = {os.path.basename(path): _file_signature(path)
+                         for path in paths}
+            part_path = os.path.join(
+                partition_dir(dataset_dir, participant_id, stream, date),
+                PART_FILENAME)
+            if sources.get(key) == signature and os.path.exists(part_path):
+                counts["partitions_unchanged"] += 1
+                continue
+            stream_df = read_hour_files(paths)
+            _write_partition(stream_df, part_path)
+            sources[key] = signature
+            counts["partitions_written"] += 1
+            counts["files_read"] += len(paths)
+            counts["rows_written"] += len(stream_df)
+    return participant_id, sources, counts
+
+
+def _convert_participant(args: tuple) -> tuple:
+    """Worker for convert_to_dataset"""
+    return convert_participant(*args)
+
+
+def _sources_path(dataset_dir: str, participant_id: str) -> str:
+    return os.path.join(dataset_dir, f"participant_id={participant_id}",
+                        SOURCES_FILENAME)
+
+
+def read_sources(dataset_dir: str, participant_id: str) -> dict:
+    """A participant's sources file: "stream/date" -> {filename: signature}"""
+    path = _sources_path(dataset_dir, participant_id)
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_sources(dataset_dir: str, participant_id: str, sources: dict):
+    path = _sources_path(dataset_dir, participant_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(sources, f)
+    os.replace(path + ".tmp", path)
+
+
+def convert_to_dataset(raw_dir: str, dataset_dir: str,
+                       participant_ids: list = None,
+                       data_streams: list = None,
+                       max_workers: int = 1) -> dict:
+    """Convert a download folder's sensor streams into the dataset,
+    rewriting only days whose hourly files are new or changed
+
+    Args:
+        raw_dir: Folder written by download_data, with one subfolder per
+            participant
+        dataset_dir: Dataset folder; created if needed
+        participant_ids: Participants to convert. Defaults to every
+            participant folder in raw_dir.
+        data_streams: Streams to convert. Defaults to DATASET_STREAMS.
+        max_workers: Number of processes converting participants. If this is
+            1, everything runs in the current process.
+
+    Returns:
+        Dict with partitions_written, partitions_unchanged, files_read and
+        rows_written totals
+    """
+    _check_parquet()
+    os.makedirs(dataset_dir, exist_ok=True)
+    if participant_ids is None:
+        participant_ids = sorted(
+            name for name in os.listdir(raw_dir)
+            if not name.startswith(".")
+            and os.path.isdir(os.path.join(raw_dir, name)))
+    jobs = [(raw_dir, dataset_dir, participant_id, data_streams,
+             read_sources(dataset_dir, participant_id))
+            for participant_id in participant_ids]
+    totals = {"partitions_written": 0, "partitions_unchanged": 0,
+              "files_read": 0, "rows_written": 0}
+    if max_workers == 1:
+        results = map(_convert_participant, jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        results = executor.map(_convert_participant, jobs)
+    try:
+        for participant_id, participant_sources, counts in results:
+            # each participant's own file, so an interrupted run resumes
+            # without rewriting the sources of the whole study
+            if counts["partitions_written"]:
+                _write_sources(dataset_dir, participant_id, participant_sources)
+            for key, value in counts.items():
+                totals[key] += value
+            logger.info("Converted %s: %d days written, %d unchanged",
+                        participant_id, counts["partitions_written"],
+                        counts["partitions_unchanged"])
+    finally:
+        if max_workers != 1:
+            executor.shutdown()
+    return totals
+
+
+def read_dataset(dataset_dir: str, participant_id: str, stream: str,
+                 time_start=None, time_end=None,
+                 columns: list = None) -> pd.DataFrame:
+    """One participant's stream data for a time range, reading only the days
+    the range covers
+
+    Args:
+        dataset_dir: Dataset folder
+        participant_id: Participant to read
+        stream: Stream to read
+        time_start: Start of the range (inclusive), UTC; None for no bound
+        time_end: End of the range (exclusive), UTC; None for no bound
+        columns: Columns to read besides timestamp. Defaults to all.
+
+    Returns:
+        Dataframe sorted by timestamp
+    """
+    _check_parquet()
+    import pyarrow.parquet as pq
+
+    start = None if time_start is None else pd.Timestamp(time_start)
+    end = None if time_end is None else pd.Timestamp(time_end)
+    start = start.tz_localize("UTC") if start is not None and start.tz is None else start
+    end = end.tz_localize("UTC") if end is not None and end.tz is None else end
+    stream_dir = os.path.dirname(partition_dir(dataset_dir, participant_id,
+                                               stream, ""))
+    dates = sorted(name[len("date="):] for name in os.listdir(stream_dir)
+                   if name.startswith("date=")) if os.path.isdir(stream_dir) else []
+    if start is not None:
+        dates = [date for date in dates if date >= start.strftime("%Y-%m-%d")]
+    if end is not None:
+        dates = [date for date in dates if date <= end.strftime("%Y-%m-%d")]
+    if columns is not None:
+        columns = ["timestamp"] + [c for c in columns if c != "timestamp"]
+    frames = [pq.read_table(os.path.join(stream_dir, f"date={date}",
+                                         PART_FILENAME),
+                            columns=columns).to_pandas()
+              for date in dates]
+    if not frames:
+        return pd.DataFrame({"timestamp": pd.Series(
+            [], dtype="datetime64[ms, UTC]")})
+    stream_df = pd.concat(frames, ignore_index=True)
+    keep = np.ones(len(stream_df), dtype=bool)
+    if start is not None:
+        keep &= (stream_df["timestamp"] >= start).to_numpy()
+    if end is not None:
+        keep &= (stream_df["timestamp"] < end).to_numpy()
+    return stream_df.loc[keep].reset_index(drop=True)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Convert raw sensor streams into a partitioned Parquet "
+                    "dataset"
+    )
+    parser.add_argument("raw_dir", help="Folder written by download_data")
+    parser.add_argument("dataset_dir")
+    parser.add_argument("--streams", nargs="+", default=DATASET_STREAMS)
+    parser.add_argument("--participants", nargs="+", default=None)
+    parser.add_argument("--max-workers", type=int, default=1)
+    args = parser.parse_args(argv)
+    totals = convert_to_dataset(args.raw_dir, args.dataset_dir,
+                                args.participants, args.streams,
+                                args.max_workers)
+    logger.info("%d days written (%d rows from %d files), %d unchanged",
+                totals["partitions_written"], totals["rows_written"],
+                totals["files_read"], totals["partitions_unchanged"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
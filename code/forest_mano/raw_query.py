@@ -0,0 +1,242 @@
+"""Time-range queries over downloaded raw data
+
+Beiwe raw files are named by the UTC time they start at, e.g.
+"2023-01-31 14_00_00+00_00.csv" (sensor files cover one hour). A
+RawFileIndex parses those names once into a sorted list of start times per
+participant and stream, and finds the files that overlap a time range with a
+binary search instead of listing and globbing folders. The index is kept in
+memory and optionally in a JSON file, and a stream is only listed again when
+its folder's modification time changes.
+
+query yields the matching rows lazily, one dataframe chunk at a time, so an
+analysis only reads the hours it needs.
+
+Example:
+    index = RawFileIndex("raw_data", persist=True)
+    for chunk in query("raw_data", ["abc123"], ["gps"],
+                       "2024-03-01", "2024-04-01", index=index):
+        ...
+"""
+
+from bisect import bisect_left
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import re
+import threading
+
+import pandas as pd
+
+from raw_storage import logical_name, read_raw_csv
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".raw_file_index.json"
+
+# Longest time a raw file covers after the time in its name
+FILE_SPAN_SECONDS = 3600
+
+# Streams whose files are in one subfolder per survey
+SURVEY_STREAMS = ["survey_answers", "survey_timings"]
+
+# Files with anything after "+00_00" are duplicates and are skipped
+RAW_FILENAME_PATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2} \d{2}_\d{2}_\d{2})\+00_00\.csv$")
+
+
+def file_start_time(filename: str) -> int:
+    """UTC start of a raw file, in seconds since the epoch, from its name;
+    None if the name isn't a raw file name"""
+    match = RAW_FILENAME_PATTERN.match(logical_name(os.path.basename(filename)))
+    if match is None:
+        return None
+    start = datetime.strptime(match.group(1), "%Y-%m-%d %H_%M_%S")
+    return int(start.replace(tzinfo=timezone.utc).timestamp())
+
+
+def _epoch_seconds(time) -> int:
+    """Seconds since the epoch of a date, datetime or string; naive times
+    are UTC"""
+    timestamp = pd.Timestamp(time)
+    if timestamp.tz is None:
+        timestamp = timestamp.tz_localize("UTC")
+    return int(timestamp.timestamp())
+
+
+class RawFileIndex:
+    """Sorted start times of the raw files in a download folder
+
+    Entries are built per participant and stream on first use. The index is
+    safe to share between threads.
+
+    Args:
+        raw_dir: Folder written by download_data
+        persist: Keep the index in INDEX_FILENAME in raw_dir (or path)
+            between runs
+        path: Where to persist the index. Implies persist.
+    """
+
+    def __init__(self, raw_dir: str, persist: bool = False, path: str = None):
+        self.raw_dir = raw_dir
+        self.path = path or (os.path.join(raw_dir, INDEX_FILENAME)
+                             if persist else None)
+        self._entries = dict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable raw file index %s: %s",
+                               self.path, e)
+
+    def _stream_dirs(self, participant_id: str, stream: str) -> list:
+        stream_dir = os.path.join(self.raw_dir, participant_id, stream)
+        if not os.path.isdir(stream_dir):
+            return []
+        if stream not in SURVEY_STREAMS:
+            return [stream_dir]
+        return [stream_dir] + sorted(
+            os.path.join(stream_dir, name) for name in os.listdir(stream_dir)
+            if os.path.isdir(os.path.join(stream_dir, name)))
+
+    def _entry(self, participant_id: str, stream: str) -> dict:
+        """Index entry for a stream, listing its folders again if any of
+        them changed"""
+        key = f"{participant_id}/{stream}"
+        folders = self._stream_dirs(participant_id, stream)
+        mtimes = {os.path.relpath(folder, self.raw_dir):
+                  os.stat(folder).st_mtime_ns for folder in folders}
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry["mtimes"] == mtimes:
+            return entry
+        files = []
+        for folder in folders:
+            for filename in os.listdir(folder):
+                start = file_start_time(filename)
+                if start is not None:
+                    files.append((start, os.path.relpath(
+                        os.path.join(folder, filename), self.raw_dir)))
+        # plain and compressed copies of a file: keep the plain one, as
+        # raw_storage.list_raw_files does
+        files = sorted(dict((logical_name(path), (start, path)) for start, path
+                            in sorted(files, reverse=True)).values())
+        entry = {"mtimes": mtimes, "starts": [start for start, _ in files],
+                 "paths": [path for _, path in files]}
+        with self._lock:
+            self._entries[key] = entry
+            self._dirty = True
+        return entry
+
+    def files(self, participant_id: str, stream: str, time_start=None,
+              time_end=None) -> list:
+        """Paths of a stream's raw files that may hold data in a time range
+
+        Args:
+            participant_id: Participant to look up
+            stream: Data stream
+            time_start: Start of the range (inclusive), UTC; None for no
+                bound
+            time_end: End of the range (exclusive), UTC; None for no bound
+
+        Returns:
+            Full paths sorted by start time
+        """
+        entry = self._entry(participant_id, stream)
+        starts = entry["starts"]
+        first = 0
+        if time_start is not None:
+            first = bisect_left(starts, _epoch_seconds(time_start)
+                                - FILE_SPAN_SECONDS + 1)
+        last = len(starts)
+        if time_end is not None:
+            last = bisect_left(starts, _epoch_seconds(time_end))
+        return [os.path.join(self.raw_dir, path)
+                for path in entry["paths"][first:last]]
+
+    def save(self):
+        """Write the index atomically, if it is persisted and changed"""
+        if self.path is None or not self._dirty:
+            return
+        with self._lock:
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+def query(raw_dir: str, participant_ids: list, data_streams: list,
+          time_start=None, time_end=None, index: RawFileIndex = None,
+          chunk_rows: int = None, **read_csv_kwargs):
+    """Rows of raw files in a time range, read lazily
+
+    Rows are filtered on their millisecond timestamp column. Files without
+    one (survey answers) are kept whole if the time in their name is in the
+    range. Files can be plain or compressed (see raw_storage.py).
+
+    Args:
+        raw_dir: Folder written by download_data
+        participant_ids: Participants to read
+        data_streams: Streams to read
+        time_start: Start of the range (inclusive), UTC; None for no bound
+        time_end: End of the range (exclusive), UTC; None for no bound
+        index: RawFileIndex of raw_dir, to reuse between queries. Defaults
+            to a new in-memory index.
+        chunk_rows: Combine files into chunks of at least this many rows.
+            Defaults to one chunk per file.
+        **read_csv_kwargs: Passed on to pandas.read_csv
+
+    Yields:
+        Dataframes with participant_id and data_stream columns added, in
+        participant, stream and time order
+    """
+    if index is None:
+        index = RawFileIndex(raw_dir)
+    start_ms = None if time_start is None else _epoch_seconds(time_start) * 1000
+    end_ms = None if time_end is None else _epoch_seconds(time_end) * 1000
+    pending = []
+    pending_rows = 0
+    for participant_id in participant_ids:
+        for stream in data_streams:
+            for path in index.files(participant_id, stream, time_start,
+                                    time_end):
+                try:
+                    rows_df = read_raw_csv(path, **read_csv_kwargs)
+                except pd.errors.EmptyDataError:
+                    continue
+                if "timestamp" not in rows_df.columns:
+                    file_ms = file_start_time(path) * 1000
+                    if ((start_ms is not None and file_ms < start_ms)
+                            or (end_ms is not None and file_ms >= end_ms)):
+                        continue
+                else:
+                    timestamps = pd.to_numeric(rows_df["timestamp"],
+                                               errors="coerce")
+                    keep = timestamps.notna()
+                    if start_ms is not None:
+                        keep &= timestamps >= start_ms
+                    if end_ms is not None:
+                        keep &= timestamps < end_ms
+                    if not keep.all():
+                        rows_df = rows_df.loc[keep.to_numpy()]
+                if rows_df.empty:
+                    continue
+                rows_df.insert(0, "data_stream", stream)
+                rows_df.insert(0, "participant_id", participant_id)
+                if chunk_rows is None:
+                    yield rows_df.reset_index(drop=True)
+                    continue
+                pending.append(rows_df)
+                pending_rows += len(rows_df)
+                if pending_rows >= chunk_rows:
+                    yield pd.concat(pending, ignore_index=True)
+                    pending = []
+                    pending_rows = 0
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+    index.save()
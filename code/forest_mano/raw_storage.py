@@ -0,0 +1,274 @@
+"""Compressed at-rest storage for raw Beiwe files
+
+Raw sensor streams (accelerometer, gyro, GPS) are plain hourly csv files and
+compress 3-10x. With a compression, download_data (see extraction.py) writes
+each extracted file as <name>.csv.gz, or <name>.csv.zst when the zstandard
+package is installed, and compress_tree converts a folder that is already
+downloaded. The readers here, and the SurveyQC and survey answers scanners,
+accept either form, so analyses don't need to know how a folder is stored.
+
+Forest reads plain csv files only; run decompress_tree on a folder before
+running Forest on it.
+
+Example:
+    compress_tree("raw_data", compression="gzip", data_streams=["gps"])
+    for path in list_raw_files("raw_data/abc123/gps"):
+        gps_df = read_raw_csv(path)
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import importlib.util
+import io
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+ZSTD_AVAILABLE = importlib.util.find_spec("zstandard") is not None
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+# Streams written by the app; other files (e.g. the registry) stay plain
+RAW_FILE_EXTENSIONS = (".csv", ".json", ".mp4", ".wav")
+
+CHUNK_SIZE = 1 << 20
+
+
+def check_compression(compression: str):
+    """Raise ValueError for an unknown compression, or ImportError if its
+    package isn't installed"""
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"compression must be one of "
+                         f"{list(COMPRESSION_SUFFIXES)}, not {compression!r}")
+    if compression == "zstd" and not ZSTD_AVAILABLE:
+        raise ImportError("zstd compression needs zstandard "
+                          "(pip install zstandard)")
+
+
+def default_compression() -> str:
+    """zstd if zstandard is installed, otherwise gzip"""
+    return "zstd" if ZSTD_AVAILABLE else "gzip"
+
+
+def compression_of(path: str) -> str:
+    """Compression a raw file is stored with, from its suffix; None if plain"""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def logical_name(path: str) -> str:
+    """The path without a compression suffix, e.g. "x.csv.gz" -> "x.csv\""""
+    compression = compression_of(path)
+    if compression is None:
+        return path
+    return path[:-len(COMPRESSION_SUFFIXES[compression])]
+
+
+def stored_variants(path: str) -> list:
+    """Every path a raw file may be stored at: plain and each compression"""
+    path = logical_name(path)
+    return [path] + [path + suffix for suffix in COMPRESSION_SUFFIXES.values()]
+
+
+def is_raw_file(filename: str, extensions: tuple = (".csv",)) -> bool:
+    """Whether a filename is a raw file with one of these extensions, plain
+    or compressed"""
+    return logical_name(filename).endswith(extensions)
+
+
+def open_raw(path: str, mode: str = "rb"):
+    """Open a raw file for reading or writing, compressing or decompressing
+    on the fly according to its suffix
+
+    Args:
+        path: Path to the file, e.g. ".../2023-01-01 00_00_00+00_00.csv.gz"
+        mode: "rb", "wb", "r" or "w"; text modes use UTF-8
+
+    Returns:
+        A file object
+    """
+    compression = compression_of(path)
+    binary_mode = mode.replace("t", "").replace("b", "") + "b"
+    if compression is None:
+        f = open(path, binary_mode)
+    elif compression == "gzip":
+        f = gzip.open(path, binary_mode,
+                      compresslevel=COMPRESSION_LEVELS["gzip"])
+    else:
+        check_compression(compression)
+        import zstandard
+        if binary_mode == "rb":
+            f = zstandard.open(path, "rb")
+        else:
+            f = zstandard.open(path, binary_mode, cctx=zstandard.ZstdCompressor(
+                level=COMPRESSION_LEVELS["zstd"]))
+    if "b" in mode:
+        return f
+    return io.TextIOWrapper(f, encoding="utf-8")
+
+
+def read_raw_csv(path: str, **kwargs):
+    """pandas.read_csv for a plain or compressed raw file
+
+    Keyword arguments are passed on to pandas.read_csv.
+    """
+    import pandas as pd
+    with open_raw(path, "rb") as f:
+        return pd.read_csv(f, **kwargs)
+
+
+def raw_file_size(path: str) -> int:
+    """Size of a raw file's content, uncompressed
+
+    gzip files store their size (mod 4 GiB, which hourly files never reach)
+    in their last four bytes, and zstd files usually in their frame header,
+    so most files are measured without decompressing them.
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return os.path.getsize(path)
+    if compression == "gzip":
+        with open(path, "rb") as f:
+            f.seek(-4, os.SEEK_END)
+            return int.from_bytes(f.read(4), "little")
+    check_compression(compression)
+    import zstandard
+    with open(path, "rb") as f:
+        size = zstandard.frame_content_size(f.read(18))
+    if size >= 0:
+        return size
+    with open_raw(path, "rb") as f:
+        return sum(len(chunk) for chunk in iter(lambda: f.read(CHUNK_SIZE), b""))
+
+
+def list_raw_files(folder: str, extensions: tuple = (".csv",)) -> list:
+    """Sorted paths of the raw files in a folder, plain or compressed
+
+    If a file is stored both plain and compressed (a conversion was
+    interrupted), only the plain copy is listed.
+    """
+    if not os.path.isdir(folder):
+        return []
+    by_name = dict()
+    for filename in os.listdir(folder):
+        if not is_raw_file(filename, extensions):
+            continue
+        name = logical_name(filename)
+        if name not in by_name or filename == name:
+            by_name[name] = filename
+    return [os.path.join(folder, by_name[name]) for name in sorted(by_name)]
+
+
+def _tmp_path(path: str) -> str:
+    """Temporary path for writing path, with the same compression suffix"""
+    name = logical_name(path)
+    return f"{name}.{os.getpid()}-{threading.get_ident()}.tmp{path[len(name):]}"
+
+
+def copy_raw(source, target_path: str) -> int:
+    """Write a binary file object to target_path, compressed according to
+    its suffix, through a temporary file that replaces target_path
+
+    Returns:
+        Number of uncompressed bytes written
+    """
+    tmp_path = _tmp_path(target_path)
+    size = 0
+    try:
+        with open_raw(tmp_path, "wb") as target:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                target.write(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+
+def _convert_file(source_path: str, target_path: str):
+    """Rewrite a raw file with the compression of target_path's suffix,
+    keeping its modification time, and remove the source"""
+    stat = os.stat(source_path)
+    with open_raw(source_path, "rb") as source:
+        copy_raw(source, target_path)
+    os.utime(target_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(source_path)
+
+
+def _tree_files(root: str, data_streams: list = None):
+    """Raw files under root/<participant>/<stream>/..."""
+    for participant_id in sorted(os.listdir(root)):
+        participant_dir = os.path.join(root, participant_id)
+        if participant_id.startswith(".") or not os.path.isdir(participant_dir):
+            continue
+        for stream in sorted(os.listdir(participant_dir)):
+            if data_streams is not None and stream not in data_streams:
+                continue
+            for dirpath, _, filenames in os.walk(os.path.join(participant_dir,
+                                                              stream)):
+                for filename in filenames:
+                    if is_raw_file(filename, RAW_FILE_EXTENSIONS):
+                        yield os.path.join(dirpath, filename)
+
+
+def convert_tree(root: str, compression: str = None, data_streams: list = None,
+                 max_workers: int = 4) -> dict:
+    """Store every raw file in a download folder with one compression
+
+    Args:
+        root: Folder written by download_data, with one subfolder per
+            participant
+        compression: "gzip" or "zstd", or None to decompress
+        data_streams: Streams to convert. Defaults to all of them.
+        max_workers: Number of files converted at once
+
+    Returns:
+        Dict with files_converted, bytes_before and bytes_after counts
+    """
+    if compression is not None:
+        check_compression(compression)
+    suffix = COMPRESSION_SUFFIXES.get(compression, "")
+    counts = {"files_converted": 0, "bytes_before": 0, "bytes_after": 0}
+    lock = threading.Lock()
+
+    def convert(source_path):
+        if compression_of(source_path) == compression:
+            return
+        target_path = logical_name(source_path) + suffix
+        before = os.path.getsize(source_path)
+        _convert_file(source_path, target_path)
+        with lock:
+            counts["files_converted"] += 1
+            counts["bytes_before"] += before
+            counts["bytes_after"] += os.path.getsize(target_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in executor.map(convert, _tree_files(root, data_streams)):
+            pass
+    logger.info("Converted %d files in %s: %d -> %d bytes",
+                counts["files_converted"], root, counts["bytes_before"],
+                counts["bytes_after"])
+    return counts
+
+
+def compress_tree(root: str, compression: str = None,
+                  data_streams: list = None, max_workers: int = 4) -> dict:
+    """Compress every raw file in a download folder (see convert_tree);
+    compression defaults to default_compression()"""
+    return convert_tree(root, compression or default_compression(),
+                        data_streams, max_workers)
+
+
+def decompress_tree(root: str, data_streams: list = None,
+                    max_workers: int = 4) -> dict:
+    """Store every raw file in a download folder as plain csv again, e.g.
+    before running Forest (see convert_tree)"""
+    return convert_tree(root, None, data_streams, max_workers)
@@ -0,0 +1,362 @@
+"""Rate limiting and adaptive concurrency for requests to a Beiwe server
+
+When several jobs download from the same Beiwe deployment at once, the
+server starts answering 429 (Too Many Requests) or 503, and retrying right
+away makes it worse. A RequestScheduler hands out slots for server-bound
+calls:
+
+    requests/sec   a token bucket limits how often requests start
+    bytes/sec      a token bucket limits how fast response bytes are taken
+    concurrency    at most `limit` requests run at once; the limit halves
+                   when the server throttles (and pauses for Retry-After or
+                   an exponential backoff) and grows by one for every
+                   `limit` successful requests
+    priority       INTERACTIVE calls (summaries, participant lists) are
+                   given slots before BULK calls (raw data downloads)
+
+The scheduler state lives in memory, or in a JSON file guarded by a lock
+file when state_path is given, so separate processes on one machine can
+share one budget. Processes sharing a state file should use the same limits.
+
+Example:
+    scheduler = shared_scheduler(keyring["URL"], requests_per_second=2)
+    with scheduler.slot(BULK) as slot:
+        zf = msync.download(...)
+        slot.add_bytes(num_bytes)
+"""
+
+import contextlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows: the state is only shared between threads
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+
+THROTTLE_STATUSES = (429, 503)
+
+# Seconds between checks while waiting for a slot, and the longest sleep
+POLL_INTERVAL = 0.05
+MAX_SLEEP = 1.0
+
+# Pause after a throttled response without Retry-After, doubled for each
+# throttled response in a row up to MAX_BACKOFF
+DEFAULT_BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+
+_STATUS_PATTERN = re.compile(r"\((\d{3})\)")
+
+
+def status_from_exception(exc: BaseException) -> int:
+    """HTTP status behind an exception, or None
+
+    Understands requests.HTTPError and mano's APIError, whose message holds
+    the status in parentheses.
+    """
+    response = getattr(exc, "response", None)
+    if response is not None and getattr(response, "status_code", None):
+        return response.status_code
+    match = _STATUS_PATTERN.search(str(exc))
+    return int(match.group(1)) if match else None
+
+
+def _retry_after(response) -> float:
+    """Seconds from a Retry-After header, or None"""
+    try:
+        return max(float(response.headers.get("Retry-After")), 0)
+    except (TypeError, ValueError):  # missing, or an HTTP date
+        return None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+class Slot:
+    """A granted request slot; report the outcome of the request on it"""
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.status = None
+        self.retry_after = None
+
+    def record(self, status_code: int, retry_after: float = None):
+        """Report the HTTP status of the request made in this slot"""
+        self.status = status_code
+        self.retry_after = retry_after
+
+    def record_response(self, response):
+        """Report a requests.Response, including its Retry-After header"""
+        self.record(response.status_code, _retry_after(response))
+
+    def add_bytes(self, num_bytes: int):
+        """Count received bytes against the bytes/sec budget, sleeping if
+        it is used up"""
+        if self.scheduler is not None:
+            self.scheduler.consume_bytes(num_bytes)
+
+
+class RequestScheduler:
+    """Shared rate, bandwidth and concurrency budget for server requests
+
+    Args:
+        requests_per_second: Average request rate; None for no limit
+        bytes_per_second: Average download rate; None for no limit
+        max_concurrency: Most requests in flight at once
+        min_concurrency: Fewest requests in flight the limit backs off to
+        state_path: JSON file to share the budget with other processes
+            (see shared_scheduler). If None, it is shared between threads of
+            this process only.
+    """
+
+    def __init__(self, requests_per_second: float = None,
+                 bytes_per_second: float = None, max_concurrency: int = 4,
+                 min_concurrency: int = 1, state_path: str = None):
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.state_path = state_path
+        self._lock = threading.Lock()
+        self._memory_state = None
+        if state_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(state_path)),
+                        exist_ok=True)
+
+    def _new_state(self, now: float) -> dict:
+        return {
+            "request_tokens": max(self.requests_per_second or 0, 1),
+            "byte_tokens": self.bytes_per_second or 0,
+            "updated": now,
+            "limit": float(self.max_concurrency),
+            "paused_until": 0,
+            "throttled": 0,
+            "active": dict(),
+            "waiting": dict()
+        }
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Lock and yield the state dict; changes are saved on exit"""
+        with self._lock:
+            if self.state_path is None:
+                if self._memory_state is None:
+                    self._memory_state = self._new_state(time.time())
+                yield self._memory_state
+                return
+            with open(self.state_path + ".lock", "a") as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    try:
+                        with open(self.state_path) as f:
+                            state = json.load(f)
+                    except (OSError, ValueError):
+                        state = self._new_state(time.time())
+                    yield state
+                    tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w") as f:
+                        json.dump(state, f)
+                    os.replace(tmp_path, self.state_path)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refill(self, state: dict, now: float):
+        elapsed = max(now - state["updated"], 0)
+        if self.requests_per_second:
+            state["request_tokens"] = min(
+                max(self.requests_per_second, 1),
+                state["request_tokens"] + elapsed * self.requests_per_second)
+        if self.bytes_per_second:
+            state["byte_tokens"] = min(
+                self.bytes_per_second,
+                state["byte_tokens"] + elapsed * self.bytes_per_second)
+        state["updated"] = now
+        # Forget slots held by processes that have exited
+        for table in ("active", "waiting"):
+            for key in list(state[table]):
+                if not _pid_alive(int(key.split("-")[0])):
+                    del state[table][key]
+
+    def acquire(self, priority: int = BULK) -> str:
+        """Wait for a request slot
+
+        Returns:
+            A key to pass to release
+        """
+        key = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        granted = False
+        try:
+            while True:
+                with self._state() as state:
+                    now = time.time()
+                    self._refill(state, now)
+                    state["waiting"][key] = priority
+                    if now < state["paused_until"]:
+                        wait = state["paused_until"] - now
+                    elif (any(p < priority for p in state["waiting"].values())
+                          or len(state["active"]) >= int(state["limit"])):
+                        wait = POLL_INTERVAL
+                    elif (self.requests_per_second
+                          and state["request_tokens"] < 1):
+                        wait = ((1 - state["request_tokens"])
+                                / self.requests_per_second)
+                    else:
+                        if self.requests_per_second:
+                            state["request_tokens"] -= 1
+                        del state["waiting"][key]
+                        state["active"][key] = priority
+                        granted = True
+                        return key
+                time.sleep(min(max(wait, POLL_INTERVAL), MAX_SLEEP))
+        finally:
+            if not granted:
+                with self._state() as state:
+                    state["waiting"].pop(key, None)
+
+    def release(self, key: str, status_code: int = None,
+                retry_after: float = None):
+        """Give back a slot and adapt the concurrency limit to its outcome
+
+        Args:
+            key: Key returned by acquire
+            status_code: HTTP status of the request, if known
+            retry_after: Seconds the server asked to wait, if any
+        """
+        with self._state() as state:
+            now = time.time()
+            state["active"].pop(key, None)
+            if status_code in THROTTLE_STATUSES:
+                if retry_after is None:
+                    retry_after = min(DEFAULT_BACKOFF * 2 ** state["throttled"],
+                                      MAX_BACKOFF)
+                state["throttled"] += 1
+                state["limit"] = max(state["limit"] / 2, self.min_concurrency)
+                state["paused_until"] = max(state["paused_until"],
+                                            now + retry_after)
+                logger.warning("Server returned %d; pausing %.1f s and "
+                               "allowing %d concurrent requests", status_code,
+                               retry_after, int(state["limit"]))
+            elif status_code is not None and status_code < 500:
+                state["throttled"] = 0
+                state["limit"] = min(state["limit"] + 1 / state["limit"],
+                                     self.max_concurrency)
+
+    def consume_bytes(self, num_bytes: int):
+        """Take received bytes from the bytes/sec budget, sleeping until the
+        budget covers them"""
+        if not self.bytes_per_second or num_bytes <= 0:
+            return
+        with self._state() as state:
+            self._refill(state, time.time())
+            state["byte_tokens"] -= num_bytes
+            deficit = -state["byte_tokens"]
+        if deficit > 0:
+            time.sleep(deficit / self.bytes_per_second)
+
+    @contextlib.contextmanager
+    def slot(self, priority: int = BULK):
+        """Hold a request slot for the duration of the block
+
+        The request counts as successful unless Slot.record is called with
+        another status, or the block raises an exception carrying an HTTP
+        status (see status_from_exception).
+        """
+        key = self.acquire(priority)
+        granted = Slot(self)
+        try:
+            yield granted
+        except BaseException as e:
+            if granted.status is None:
+                granted.status = status_from_exception(e)
+            raise
+        else:
+            if granted.status is None:
+                granted.status = 200
+        finally:
+            self.release(key, granted.status, granted.retry_after)
+
+    def request(self, method: str, url: str, priority: int = INTERACTIVE,
+                session: "requests.Session" = None, max_retries: int = 5,
+                **kwargs) -> "requests.Response":
+        """Send a request in a slot, retrying throttled responses
+
+        Keyword arguments are passed to requests. The response body is read
+        and counted against the bytes/sec budget.
+
+        Returns:
+            The last response
+        """
+        import requests
+
+        for attempt in range(max_retries + 1):
+            with self.slot(priority) as granted:
+                response = (session or requests).request(method, url, **kwargs)
+                granted.record_response(response)
+                granted.add_bytes(len(response.content))
+            if response.status_code not in THROTTLE_STATUSES:
+                break
+        return response
+
+    def snapshot(self) -> dict:
+        """Current limit, pause and slot counts, for logging"""
+        with self._state() as state:
+            self._refill(state, time.time())
+            return {"limit": int(state["limit"]),
+                    "paused_for": max(state["paused_until"] - time.time(), 0),
+                    "active": len(state["active"]),
+                    "waiting": len(state["waiting"])}
+
+
+@contextlib.contextmanager
+def scheduler_slot(scheduler: RequestScheduler = None,
+                   priority: int = BULK):
+    """scheduler.slot(priority), or a slot that does nothing if scheduler is
+    None"""
+    if scheduler is None:
+        yield Slot()
+    else:
+        with scheduler.slot(priority) as granted:
+            yield granted
+
+
+def shared_scheduler(url: str, state_dir: str = None,
+                     **limits) -> RequestScheduler:
+    """A scheduler shared by every process on this machine that talks to the
+    same Beiwe server
+
+    Args:
+        url: The server URL (keyring["URL"])
+        state_dir: Folder for the state file. Defaults to the system
+            temporary folder.
+        **limits: Passed on to RequestScheduler
+
+    Returns:
+        A RequestScheduler whose state file is named after the server host
+    """
+    host = urlparse(url).netloc or url
+    host = re.sub(r"[^A-Za-z0-9_.-]", "_", host)
+    state_path = os.path.join(state_dir or tempfile.gettempdir(),
+                              f"beiwe_scheduler_{host}.json")
+    return RequestScheduler(state_path=state_path, **limits)
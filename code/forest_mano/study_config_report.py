@@ -0,0 +1,548 @@
+"""Readable reports of Beiwe study configurations
+
+Renders the surveys (schedules, questions, display logic) and device
+settings of study configuration JSON files, such as config/default_passive.json
+or the "surveys and settings" export from the study page, to HTML, Markdown
+or PDF. This is the batch version of Study Configuration JSON to PDF.ipynb:
+
+* A directory of configs is rendered in parallel, one config per process.
+* Configs whose contents (and requested formats) haven't changed since the
+  last run are skipped, using a manifest kept in the output directory.
+* display_if conditions and schedule tables are memoized, so conditions
+  repeated across questions, surveys and configs are only parsed once.
+
+PDF output needs reportlab; HTML and Markdown have no extra dependencies.
+
+Usage:
+    python study_config_report.py CONFIG_DIR [--output-dir reports]
+        [--formats html pdf] [--max-workers 4] [--force]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+import functools
+import hashlib
+import html
+import importlib.util
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+# Bump when the report layout changes so existing reports are re-rendered
+REPORT_VERSION = "1"
+
+MANIFEST_FILENAME = ".study_config_reports.json"
+
+FORMATS = {"html": ".html", "md": ".md", "pdf": ".pdf"}
+
+REPORTLAB_AVAILABLE = importlib.util.find_spec("reportlab") is not None
+
+DAY_NAMES = ["Sunday", "Monday", "Tuesday", "Wednesday",
+             "Thursday", "Friday", "Saturday"]
+
+STREAMS = [
+    "accelerometer", "gps", "calls", "texts", "wifi", "bluetooth",
+    "power_state", "ambient_audio", "proximity", "gyro",
+    "magnetometer", "devicemotion", "reachability"
+]
+
+COMPARISON_OPERATORS = ("==", "!=", "<=", "<", ">=", ">")
+
+
+def _canonical_json(obj) -> str:
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"))
+
+
+@functools.lru_cache(maxsize=None)
+def seconds_to_hhmm_ampm(seconds: int) -> str:
+    """Format seconds after midnight as e.g. "9:05 PM\""""
+    time = datetime(2000, 1, 1) + timedelta(seconds=seconds)
+    return time.strftime("%I:%M %p").lstrip("0")
+
+
+# survey fingerprint -> (question id -> number, question id -> answer texts)
+_question_maps = dict()
+
+
+def _register_question_maps(content: list) -> str:
+    """Store the question number and answer lookups of a survey and return
+    a fingerprint that identifies them in the display_if cache"""
+    id_to_num = {item["question_id"]: number
+                 for number, item in enumerate(content, 1)
+                 if item.get("question_id")}
+    id_to_answers = {item["question_id"]: tuple(a["text"] for a in
+                                                item.get("answers", []))
+                     for item in content if item.get("question_id")}
+    fingerprint = hashlib.sha1(
+        _canonical_json([id_to_num, id_to_answers]).encode()
+    ).hexdigest()
+    _question_maps.setdefault(fingerprint, (id_to_num, id_to_answers))
+    return fingerprint
+
+
+@functools.lru_cache(maxsize=65536)
+def _describe_condition(expression_json: str, maps_fingerprint: str) -> str:
+    """Memoized worker for describe_display_if. Every subexpression goes
+    through the cache, so shared branches are only described once."""
+    id_to_num, id_to_answers = _question_maps[maps_fingerprint]
+    expression = json.loads(expression_json)
+
+    def describe(sub_expression):
+        return _describe_condition(_canonical_json(sub_expression),
+                                   maps_fingerprint)
+
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, value = next(iter(expression.items()))
+        if operator in COMPARISON_OPERATORS:
+            question_id, answer = value
+            number = id_to_num.get(question_id, "?")
+            answers = id_to_answers.get(question_id, ())
+            if isinstance(answer, int) and 0 <= answer < len(answers):
+                answer = answers[answer]
+            return f"Question {number} {operator} {answer}"
+        if operator in ("and", "or"):
+            joiner = " AND " if operator == "and" else " OR "
+            return "(" + joiner.join(describe(item) for item in value) + ")"
+        if operator == "not":
+            return f"NOT ({describe(value)})"
+    if isinstance(expression, list):
+        return ", ".join(describe(item) for item in expression)
+    return str(expression)
+
+
+def describe_display_if(expression, content: list) -> str:
+    """Describe a question's display_if logic in words
+
+    Args:
+        expression: The display_if value of a question
+        content: The content list of the survey the question is in
+
+    Returns:
+        Text such as "(Question 2 == Yes AND NOT (Question 3 > 5))"
+    """
+    return _describe_condition(_canonical_json(expression),
+                               _register_question_maps(content))
+
+
+@functools.lru_cache(maxsize=4096)
+def _schedule_from_json(timings_json: str) -> tuple:
+    timings, absolute_timings, relative_timings = json.loads(timings_json)
+    weekly, absolute, relative = [], [], []
+
+    items = timings.items() if isinstance(timings, dict) else enumerate(timings)
+    for day, seconds_list in items:
+        for seconds in seconds_list:
+            weekly.append((int(day), seconds,
+                           f"{DAY_NAMES[int(day)]} at "
+                           f"{seconds_to_hhmm_ampm(seconds)}"))
+    weekly.sort(key=lambda x: (x[0], x[1]))
+
+    for timing in absolute_timings:
+        if isinstance(timing, (int, float)):
+            # Unix timestamp; report it in UTC so every host agrees
+            time = datetime.fromtimestamp(timing, tz=timezone.utc)
+            absolute.append((time.replace(tzinfo=None),
+                             time.strftime("%Y-%m-%d ")
+                             + seconds_to_hhmm_ampm(time.hour * 3600
+                                                    + time.minute * 60)
+                             + " UTC"))
+            continue
+        elif isinstance(timing, list) and len(timing) == 4:
+            # [year, month, day, seconds after midnight]
+            time = (datetime(*timing[:3]) + timedelta(seconds=timing[3]))
+        else:
+            absolute.append((datetime.min, str(timing)))
+            continue
+        absolute.append((time, time.strftime("%Y-%m-%d ")
+                         + seconds_to_hhmm_ampm(time.hour * 3600
+                                                + time.minute * 60)))
+    absolute.sort(key=lambda x: x[0])
+
+    entries = (relative_timings.values() if isinstance(relative_timings, dict)
+               else relative_timings)
+    for entry in entries:
+        if isinstance(entry, dict):
+            anchor = entry.get("anchor") or entry.get("0")
+            days = entry.get("days") or entry.get("1")
+            seconds = entry.get("seconds") or entry.get("2")
+        elif isinstance(entry, (list, tuple)) and len(entry) >= 3:
+            anchor, days, seconds = entry[0], entry[1], entry[2]
+        else:
+            continue
+        relative.append((int(days), seconds,
+                         f"{days} days after {anchor} at "
+                         f"{seconds_to_hhmm_ampm(seconds)}"))
+    relative.sort(key=lambda x: (x[0], x[1]))
+
+    return (tuple(d for _, _, d in weekly), tuple(d for _, d in absolute),
+            tuple(d for _, _, d in relative))
+
+
+def extract_schedule(survey: dict) -> tuple:
+    """Weekly, absolute and relative schedule descriptions of a survey
+
+    Surveys with identical timings share one cached result.
+
+    Returns:
+        Three tuples of strings, each sorted by time
+    """
+    return _schedule_from_json(_canonical_json([
+        survey.get("timings") or {}, survey.get("absolute_timings") or [],
+        survey.get("relative_timings") or {}
+    ]))
+
+
+def device_settings_table(config: dict) -> tuple:
+    """Rows of the device settings table: one per stream, with whether it
+    is enabled and its <stream>_* settings
+
+    Returns:
+        (column names, rows), where rows are lists of strings
+    """
+    device_settings = config.get("device_settings", {})
+    records = []
+    for stream in STREAMS:
+        record = {"data_stream": stream,
+                  "enabled": device_settings.get(stream, False)}
+        for key, value in device_settings.items():
+            if key.startswith(stream + "_"):
+                record[key[len(stream) + 1:]] = value
+        records.append(record)
+    columns = []
+    for record in records:
+        columns.extend(c for c in record if c not in columns)
+    rows = [[str(record.get(c, "nan")) for c in columns] for record in records]
+    return columns, rows
+
+
+def _survey_blocks(survey: dict, audio: bool) -> list:
+    weekly, absolute, relative = extract_schedule(survey)
+    baseline = survey.get("trigger_on_first_download", False)
+    always = survey.get("always_available", False)
+    if not (weekly or absolute or relative or baseline or always):
+        return []
+
+    blocks = [("heading2", f"Survey Name: {survey.get('name', 'Unnamed Survey')}")]
+    if audio:
+        blocks.append(("label", ("Prompt:", survey["content"][0].get("prompt", ""))))
+    if always:
+        blocks.append(("text", "Survey Always Available"))
+    if baseline:
+        blocks.append(("text", "Baseline"))
+    if weekly or absolute or relative:
+        blocks.append(("heading3", "Schedule"))
+        for title, descriptions in [("Weekly:", weekly), ("Absolute:", absolute),
+                                    ("Relative:", relative)]:
+            if descriptions:
+                blocks.append(("list", (title, descriptions)))
+        if not weekly and not always:
+            count = (1 if baseline else 0) + len(absolute) + len(relative)
+            blocks.append(("text", f"Total Deployments: {count}"))
+
+    if not audio:
+        content = survey["content"]
+        for number, item in enumerate(content, 1):
+            text = item.get("question_text", item.get("prompt", "")).strip()
+            details = [f"Type: {item.get('question_type', '')}"]
+            if item.get("question_type") == "slider":
+                details.append(f"Range: {item.get('min', '')} to {item.get('max', '')}")
+            if item.get("answers"):
+                details.append("Options: " + "; ".join(a["text"] for a in item["answers"]))
+            if item.get("display_if"):
+                details.append("Display If: "
+                               + describe_display_if(item["display_if"], content))
+            blocks.append(("question", (f"Question {number}", text, details)))
+    blocks.append(("rule", None))
+    return blocks
+
+
+def build_report(config: dict) -> list:
+    """Lay out a study configuration as a list of (kind, value) blocks that
+    the render_* functions turn into documents"""
+    surveys = [s for s in config.get("surveys", []) if s.get("content")]
+    blocks = [("heading1", "Active Surveys")]
+    for survey in surveys:
+        if survey.get("survey_type") != "audio_survey":
+            blocks.extend(_survey_blocks(survey, audio=False))
+    audio_blocks = []
+    for survey in surveys:
+        if survey.get("survey_type") == "audio_survey":
+            audio_blocks.extend(_survey_blocks(survey, audio=True))
+    if audio_blocks:
+        blocks.append(("heading1", "Audio Surveys"))
+        blocks.extend(audio_blocks)
+    blocks.append(("heading1", "Device Settings"))
+    blocks.append(("table", device_settings_table(config)))
+    return blocks
+
+
+def render_markdown(blocks: list, title: str) -> str:
+    lines = [f"# {title}", ""]
+    for kind, value in blocks:
+        if kind == "heading1":
+            lines += [f"## {value}", ""]
+        elif kind == "heading2":
+            lines += [f"### {value}", ""]
+        elif kind == "heading3":
+            lines += [f"**{value}**", ""]
+        elif kind == "label":
+            lines += [f"**{value[0]}** {value[1]}", ""]
+        elif kind == "list":
+            lines += [value[0]] + [f"{i}. {d}" for i, d in enumerate(value[1], 1)] + [""]
+        elif kind == "question":
+            lines += [f"#### {value[0]}", value[1]] + [f"- {d}" for d in value[2]] + [""]
+        elif kind == "rule":
+            lines += ["---", ""]
+        elif kind == "table":
+            columns, rows = value
+            lines.append("| " + " | ".join(columns) + " |")
+            lines.append("|" + "---|" * len(columns))
+            lines += ["| " + " | ".join(row) + " |" for row in rows]
+            lines.append("")
+        else:
+            lines += [value, ""]
+    return "\n".join(lines)
+
+
+def render_html(blocks: list, title: str) -> str:
+    escape = html.escape
+    parts = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\">",
+             f"<title>{escape(title)}</title>",
+             "<style>body{font-family:sans-serif;font-size:13px;max-width:60em;"
+             "margin:auto}table{border-collapse:collapse;font-size:11px}"
+             "td,th{border:1px solid #999;padding:2px 4px}"
+             "th{background:#ddd}</style>",
+             "</head><body>", f"<h1>{escape(title)}</h1>"]
+    for kind, value in blocks:
+        if kind == "heading1":
+            parts.append(f"<h2>{escape(value)}</h2>")
+        elif kind == "heading2":
+            parts.append(f"<h3>{escape(value)}</h3>")
+        elif kind == "heading3":
+            parts.append(f"<h4>{escape(value)}</h4>")
+        elif kind == "label":
+            parts.append(f"<p><b>{escape(value[0])}</b> {escape(value[1])}</p>")
+        elif kind == "list":
+            items = "".join(f"<li>{escape(d)}</li>" for d in value[1])
+            parts.append(f"<p><b>{escape(value[0])}</b></p><ol>{items}</ol>")
+        elif kind == "question":
+            items = "".join(f"<li>{escape(d)}</li>" for d in value[2])
+            parts.append(f"<h4>{escape(value[0])}</h4><p>{escape(value[1])}</p>"
+                         f"<ul>{items}</ul>")
+        elif kind == "rule":
+            parts.append("<hr>")
+        elif kind == "table":
+            columns, rows = value
+            header = "".join(f"<th>{escape(c)}</th>" for c in columns)
+            body = "".join("<tr>" + "".join(f"<td>{escape(v)}</td>" for v in row)
+                           + "</tr>" for row in rows)
+            parts.append(f"<table><tr>{header}</tr>{body}</table>")
+        else:
+            parts.append(f"<p>{escape(value)}</p>")
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def render_pdf(blocks: list, title: str, pdf_path: str):
+    """Write the report as a PDF with reportlab"""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.platypus import (
+        HRFlowable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+    )
+
+    escape = html.escape
+    styles = getSampleStyleSheet()
+    styles["Heading1"].fontSize, styles["Heading1"].leading = 14, 16
+    styles["Heading2"].fontSize, styles["Heading2"].leading = 12, 14
+    styles["Normal"].fontSize, styles["Normal"].leading = 8, 10
+    story = [Paragraph(escape(title), styles["Title"])]
+    for kind, value in blocks:
+        if kind == "heading1":
+            story.append(Paragraph(escape(value), styles["Heading1"]))
+        elif kind in ("heading2", "heading3"):
+            story.append(Paragraph(escape(value), styles["Heading2"]))
+        elif kind == "label":
+            story.append(Paragraph(f"<b>{escape(value[0])}</b> {escape(value[1])}",
+                                   styles["Normal"]))
+        elif kind == "list":
+            story.append(Paragraph(f"<b>{escape(value[0])}</b>", styles["Normal"]))
+            story += [Paragraph(f"{i}. {escape(d)}", styles["Normal"])
+                      for i, d in enumerate(value[1], 1)]
+            story.append(Spacer(1, 6))
+        elif kind == "question":
+            story.append(Paragraph(escape(value[0]), styles["Heading2"]))
+            story.append(Paragraph(escape(value[1]), styles["Normal"]))
+            story += [Paragraph("- " + escape(d), styles["Normal"])
+                      for d in value[2]]
+            story.append(Spacer(1, 6))
+        elif kind == "rule":
+            story += [Spacer(1, 6),
+                      HRFlowable(width="100%", thickness=1, color=colors.grey),
+                      Spacer(1, 6)]
+        elif kind == "table":
+            columns, rows = value
+            table = Table([columns] + rows, repeatRows=1)
+            table.setStyle(TableStyle([
+                ("FONTNAME", (0, 0), (-1, -1), "Helvetica"),
+                ("FONTSIZE", (0, 0), (-1, -1), 6),
+                ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+                ("GRID", (0, 0), (-1, -1), 0.25, colors.black),
+                ("PADDING", (0, 0), (-1, -1), 2),
+            ]))
+            story += [Spacer(1, 6), table]
+        else:
+            story.append(Paragraph(escape(value), styles["Normal"]))
+    SimpleDocTemplate(pdf_path, pagesize=letter).build(story)
+
+
+def config_fingerprint(config_bytes: bytes, formats: list) -> str:
+    """Hash of a config's contents, the requested formats and the report
+    version; a report is current if its fingerprint matches"""
+    digest = hashlib.sha256(config_bytes)
+    digest.update(f"|{REPORT_VERSION}|{','.join(sorted(formats))}".encode())
+    return digest.hexdigest()
+
+
+def render_config(config_path: str, output_dir: str,
+                  formats: list = ("html",)) -> list:
+    """Render one study configuration JSON
+
+    Args:
+        config_path: Path to the configuration JSON
+        output_dir: Folder for the reports, named after the config file
+        formats: Any of "html", "md" and "pdf"
+
+    Returns:
+        Paths of the files written
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    title = os.path.splitext(os.path.basename(config_path))[0]
+    blocks = build_report(config)
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    for report_format in formats:
+        path = os.path.join(output_dir, title + FORMATS[report_format])
+        if report_format == "pdf":
+            render_pdf(blocks, title, path)
+        else:
+            renderer = render_html if report_format == "html" else render_markdown
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(renderer(blocks, title))
+        written.append(path)
+    return written
+
+
+def _render_worker(args: tuple) -> tuple:
+    config_path, output_dir, formats = args
+    try:
+        return config_path, render_config(config_path, output_dir, formats), None
+    except Exception as e:  # report and keep rendering the other configs
+        return config_path, [], f"{type(e).__name__}: {e}"
+
+
+def _read_manifest(output_dir: str) -> dict:
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _write_manifest(output_dir: str, manifest: dict):
+    path = os.path.join(output_dir, MANIFEST_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def render_directory(config_dir: str, output_dir: str = None,
+                     formats: list = ("html",), max_workers: int = None,
+                     force: bool = False) -> dict:
+    """Render every *.json study configuration in a directory
+
+    Args:
+        config_dir: Folder of study configuration JSON files
+        output_dir: Folder for reports. Defaults to config_dir.
+        formats: Any of "html", "md" and "pdf"
+        max_workers: Number of processes. If this is 1, configs are rendered
+            in the current process. If this is None, the executor default is
+            used.
+        force: Render every config even if its report is up to date
+
+    Returns:
+        Dict mapping each config path to "rendered", "unchanged", or an
+        error message
+    """
+    formats = list(formats)
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown formats {unknown}; use {sorted(FORMATS)}")
+    if "pdf" in formats and not REPORTLAB_AVAILABLE:
+        raise ImportError("PDF reports need reportlab (pip install reportlab)")
+    output_dir = output_dir or config_dir
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _read_manifest(output_dir)
+
+    results = dict()
+    to_render = []
+    fingerprints = dict()
+    for filename in sorted(os.listdir(config_dir)):
+        if not filename.endswith(".json"):
+            continue
+        config_path = os.path.join(config_dir, filename)
+        with open(config_path, "rb") as f:
+            fingerprint = config_fingerprint(f.read(), formats)
+        previous = manifest.get(filename, {})
+        if (not force and previous.get("fingerprint") == fingerprint
+                and all(os.path.exists(p) for p in previous.get("outputs", []))):
+            results[config_path] = "unchanged"
+            continue
+        fingerprints[config_path] = fingerprint
+        to_render.append((config_path, output_dir, formats))
+
+    if max_workers == 1 or len(to_render) <= 1:
+        rendered = map(_render_worker, to_render)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rendered = list(executor.map(_render_worker, to_render))
+    for config_path, outputs, error in rendered:
+        if error is not None:
+            logger.warning("Unable to render %s: %s", config_path, error)
+            results[config_path] = error
+            continue
+        manifest[os.path.basename(config_path)] = {
+            "fingerprint": fingerprints[config_path], "outputs": outputs
+        }
+        results[config_path] = "rendered"
+    _write_manifest(output_dir, manifest)
+    return results
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Render Beiwe study configuration JSON files as reports"
+    )
+    parser.add_argument("config_dir")
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--formats", nargs="+", choices=sorted(FORMATS),
+                        default=["html"])
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true",
+                        help="Re-render configs that haven't changed")
+    args = parser.parse_args(argv)
+    results = render_directory(args.config_dir, args.output_dir, args.formats,
+                               args.max_workers, args.force)
+    for config_path, status in results.items():
+        print(f"{status:>10}  {config_path}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
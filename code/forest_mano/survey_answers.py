@@ -0,0 +1,265 @@
+"""Decode Beiwe survey answers files into answer indices
+
+Survey answers files store the selected options of radio button and checkbox
+questions as text, with every comma converted to a semicolon. Options that
+contain commas therefore can't be recovered by splitting the answer. This
+module reads the question definitions from a study configuration JSON (for
+example config/default_passive.json, or the output of the study settings
+endpoint) and matches answers against each question's known options.
+"""
+
+import json
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from raw_storage import is_raw_file
+
+
+logger = logging.getLogger(__name__)
+
+OPTION_QUESTION_TYPES = ["radio_button", "checkbox"]
+
+DECODED_COLUMNS = ["participant_id", "survey_id", "submission_time",
+                   "question_id", "answer_index", "answer"]
+
+DECODED_DTYPES = {
+    "participant_id": "category",
+    "survey_id": "category",
+    "submission_time": "datetime64[ns]",
+    "question_id": "category",
+    "answer_index": "int16",
+    "answer": "string"
+}
+
+# Sentinel answer_index for answers that aren't one of the question's options
+# (free text, sliders, skipped questions)
+NO_OPTION = -1
+
+
+def load_question_definitions(config_path: str) -> dict:
+    """Read question definitions from a study configuration JSON
+
+    Args:
+        config_path: Path to a study configuration JSON with a "surveys" list,
+            like config/default_passive.json
+
+    Returns:
+        Dict mapping question_id to a dict with survey_id, question_type,
+        question_text and answers (list of option texts, in order)
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    questions = dict()
+    for survey in config.get("surveys", []):
+        for item in survey.get("content", []):
+            question_id = item.get("question_id")
+            if not question_id:
+                continue
+            questions[question_id] = {
+                "survey_id": survey.get("object_id", ""),
+                "question_type": item.get("question_type", ""),
+                "question_text": item.get("question_text", ""),
+                "answers": [answer.get("text", "")
+                            for answer in item.get("answers", [])]
+            }
+    return questions
+
+
+def _normalize_option(option: str) -> str:
+    """Convert option text the same way the app does before writing CSVs"""
+    return option.replace(",", ";").strip()
+
+
+def compile_answer_matcher(options: list) -> tuple:
+    """Precompile a matcher for one question's options
+
+    Options are tried longest first so that an option which is a prefix of
+    another option (e.g. "Yes" and "Yes; often") can't shadow it.
+
+    Args:
+        options: List of option texts, in the order shown to participants
+
+    Returns:
+        Tuple of (compiled regular expression, dict mapping normalized option
+        text to its index)
+    """
+    lookup = dict()
+    for index, option in enumerate(options):
+        lookup.setdefault(_normalize_option(option), index)
+    alternatives = sorted(lookup.keys(), key=len, reverse=True)
+    pattern = re.compile(
+        r"(?:^|[\[;])\s*("
+        + "|".join(re.escape(option) for option in alternatives)
+        + r")\s*(?=[;\]]|$)"
+    )
+    return pattern, lookup
+
+
+def compile_question_matchers(questions: dict) -> dict:
+    """Precompile matchers for every radio button and checkbox question
+
+    Args:
+        questions: Output of load_question_definitions
+
+    Returns:
+        Dict mapping question_id to the output of compile_answer_matcher
+    """
+    return {
+        question_id: compile_answer_matcher(question["answers"])
+        for question_id, question in questions.items()
+        if question["question_type"] in OPTION_QUESTION_TYPES
+        and len(question["answers"]) > 0
+    }
+
+
+def match_answer(matcher: tuple, answer: str) -> list:
+    """Get the indices of the options selected in one answer
+
+    Args:
+        matcher: Output of compile_answer_matcher
+        answer: Answer text from a survey answers file
+
+    Returns:
+        List of option indices, in the order they appear in the answer
+    """
+    pattern, lookup = matcher
+    return [lookup[match.group(1)]
+            for match in pattern.finditer(answer.strip())]
+
+
+def decode_answers_file(file_path: str, matchers: dict,
+                        participant_id: str = "",
+                        survey_id: str = "") -> pd.DataFrame:
+    """Decode one survey answers file
+
+    Args:
+        file_path: Path to a survey answers csv file, plain or compressed
+        matchers: Output of compile_question_matchers
+        participant_id: Beiwe ID the file belongs to
+        survey_id: Survey ID the file belongs to
+
+    Returns:
+        Dataframe with DECODED_COLUMNS. Checkbox answers have one row per
+        selected option. Answers that don't match any option have an
+        answer_index of NO_OPTION.
+    """
+    try:
+        answers_df = pd.read_csv(file_path, dtype=str, keep_default_na=False)
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        logger.warning("Unable to read survey answers file %s", file_path)
+        return _empty_decoded_frame()
+    answers_df.columns = answers_df.columns.str.strip()
+    if ("question id" not in answers_df.columns
+            or "answer" not in answers_df.columns):
+        logger.warning("No question id or answer column in %s", file_path)
+        return _empty_decoded_frame()
+
+    question_ids = []
+    indices = []
+    answer_texts = []
+    for question_id, answer in zip(answers_df["question id"],
+                                   answers_df["answer"]):
+        matcher = matchers.get(question_id)
+        selected = match_answer(matcher, answer) if matcher else []
+        if not selected:
+            selected = [NO_OPTION]
+        question_ids.extend([question_id] * len(selected))
+        indices.extend(selected)
+        answer_texts.extend([answer] * len(selected))
+
+    filename = os.path.splitext(os.path.basename(file_path))[0]
+    submission_time = pd.to_datetime(
+        filename.replace("_", ":")[:19], format="%Y-%m-%d %H:%M:%S",
+        errors="coerce"
+    )
+    decoded_df = pd.DataFrame({
+        "participant_id": participant_id,
+        "survey_id": survey_id,
+        "submission_time": submission_time,
+        "question_id": question_ids,
+        "answer_index": np.array(indices, dtype=np.int16),
+        "answer": answer_texts
+    }, columns=DECODED_COLUMNS)
+    return decoded_df.astype(DECODED_DTYPES)
+
+
+def _empty_decoded_frame() -> pd.DataFrame:
+    return pd.DataFrame(columns=DECODED_COLUMNS).astype(DECODED_DTYPES)
+
+
+def iter_decoded_answers(data_dir: str, matchers: dict,
+                         participant_ids: list = None,
+                         survey_ids: list = None):
+    """Decode every survey answers file in a download folder, one at a time
+
+    Args:
+        data_dir: Folder written by download_data, with one subfolder per
+            participant
+        matchers: Output of compile_question_matchers
+        participant_ids: Participants to decode. None decodes everyone.
+        survey_ids: Surveys to decode. None decodes every survey.
+
+    Yields:
+        One dataframe (see decode_answers_file) per survey answers file
+    """
+    if participant_ids is None:
+        participant_ids = sorted(os.listdir(data_dir))
+    for participant_id in participant_ids:
+        answers_dir = os.path.join(data_dir, participant_id, "survey_answers")
+        if not os.path.isdir(answers_dir):
+            continue
+        for survey_id in sorted(os.listdir(answers_dir)):
+            if survey_ids is not None and survey_id not in survey_ids:
+                continue
+            survey_dir = os.path.join(answers_dir, survey_id)
+            if not os.path.isdir(survey_dir):
+                continue
+            for filename in sorted(os.listdir(survey_dir)):
+                if not is_raw_file(filename):
+                    continue
+                yield decode_answers_file(os.path.join(survey_dir, filename),
+                                          matchers, participant_id, survey_id)
+
+
+def decode_survey_answers(data_dir: str, config_path: str,
+                          output_file_path: str = None,
+                          participant_ids: list = None,
+                          survey_ids: list = None) -> pd.DataFrame:
+    """Decode all survey answers in a download folder using a study config
+
+    Args:
+        data_dir: Folder written by download_data, with one subfolder per
+            participant
+        config_path: Path to the study configuration JSON
+        output_file_path: Filepath to write the decoded table to as a csv. If
+            this is given, files are appended to it one at a time and nothing
+            is held in memory; None is returned.
+        participant_ids: Participants to decode. None decodes everyone.
+        survey_ids: Surveys to decode. None decodes every survey.
+
+    Returns:
+        Dataframe with DECODED_COLUMNS if output_file_path is None
+    """
+    matchers = compile_question_matchers(load_question_definitions(config_path))
+    decoded = iter_decoded_answers(data_dir, matchers, participant_ids,
+                                   survey_ids)
+    if output_file_path is None:
+        frames = list(decoded)
+        if len(frames) == 0:
+            return _empty_decoded_frame()
+        # concat of differing categoricals falls back to object
+        return pd.concat(frames, ignore_index=True).astype(DECODED_DTYPES)
+
+    with open(output_file_path, "w", newline="") as f:
+        pd.DataFrame(columns=DECODED_COLUMNS).to_csv(f, index=False)
+        num_files = 0
+        for decoded_df in decoded:
+            decoded_df.to_csv(f, index=False, header=False)
+            num_files += 1
+    logger.info("Decoded %s survey answers files to %s", num_files,
+                output_file_path)
+    return None
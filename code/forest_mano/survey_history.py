@@ -0,0 +1,289 @@
+"""Change logs from Beiwe survey edit histories
+
+Turns a *_surveys_history_data.json file (from the "Export Survey Edits
+History JSON" button) into a table with one row per change between
+consecutive survey versions: added and removed questions, modified question
+fields, and optionally versions with no changes. This is the importable
+version of survey_history_json_to_csv.ipynb and writes the same columns in
+the same order.
+
+While the JSON is parsed, every object is looked up in a table keyed by its
+canonical form, so each distinct question is stored once no matter how many
+versions contain it. Unchanged questions are then recognized by identity in
+O(1) and whole unchanged versions from one comparison; only questions that
+changed are diffed field by field. Rows are written to CSV (or Parquet, if
+pyarrow is installed) as they are produced instead of being collected first,
+and process_histories handles many studies' files in parallel.
+
+Example:
+    history_to_table("study_surveys_history_data.json", "survey_history.csv")
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import importlib.util
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_COLUMNS = ["survey_id", "version_index", "archive_start", "change_type",
+                   "question_id", "field", "old_value", "new_value"]
+
+NO_QUESTION_ID = "<no_question_id>"
+
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+
+def _to_str(value) -> str:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return "" if value is None else str(value)
+
+
+def _canonical_key(value):
+    """Hashable canonical form of a parsed JSON value whose nested objects
+    have already been interned"""
+    if isinstance(value, list):
+        return ("\0list",) + tuple(_canonical_key(item) for item in value)
+    if isinstance(value, dict):
+        return id(value)
+    if isinstance(value, (bool, float)):
+        # keep True, 1 and 1.0 apart
+        return (type(value).__name__, value)
+    return value
+
+
+def load_history(history_path: str) -> dict:
+    """Read a survey history JSON file, sharing identical objects
+
+    Every JSON object is interned by its canonical form (key order doesn't
+    matter), so a question repeated across hundreds of versions is held in
+    memory once and compares equal to itself by identity.
+    """
+    interned = dict()
+
+    def intern_object(pairs):
+        key = tuple(sorted((k, _canonical_key(v)) for k, v in pairs))
+        obj = interned.get(key)
+        if obj is None:
+            obj = interned[key] = dict(pairs)
+        return obj
+
+    with open(history_path, "r") as f:
+        return json.load(f, object_pairs_hook=intern_object)
+
+
+def fingerprint_version(survey_json: list) -> tuple:
+    """Index the questions of one survey version
+
+    Args:
+        survey_json: The survey_json list of a version
+
+    Returns:
+        (questions, version_key): question_id -> question dict, and a key
+        that is equal for two versions holding the same (interned) question
+        objects. If a question ID appears more than once, the last question
+        wins.
+    """
+    questions = dict()
+    for question in survey_json or []:
+        questions[question.get("question_id", NO_QUESTION_ID)] = question
+    version_key = frozenset((qid, id(q)) for qid, q in questions.items())
+    return questions, version_key
+
+
+def diff_survey_versions(survey_id: str, versions: list,
+                         include_no_change: bool = True):
+    """Yield change rows for one survey's versions
+
+    Rows come out sorted like the notebook's output: by version, then
+    change_type, question_id and field.
+
+    Args:
+        survey_id: ID of the survey
+        versions: Version dicts with archive_start and survey_json
+        include_no_change: Whether to yield a row for versions identical to
+            the one before
+
+    Yields:
+        Row tuples in HISTORY_COLUMNS order
+    """
+    versions = sorted(versions, key=lambda v: v.get("archive_start", ""))
+    previous = None
+    for version_index, version in enumerate(versions, start=1):
+        timestamp = version.get("archive_start", "")
+        current = fingerprint_version(version.get("survey_json", []))
+        prefix = (survey_id, version_index, timestamp)
+        if previous is None:
+            yield prefix + ("baseline", "", "", "", "")
+            previous = current
+            continue
+
+        prev_questions, prev_version = previous
+        cur_questions, cur_version = current
+        previous = current
+        if cur_version == prev_version:
+            if include_no_change:
+                yield prefix + ("no_change", "", "", "", "")
+            continue
+
+        rows = []
+        for qid, after in cur_questions.items():
+            before = prev_questions.get(qid)
+            if before is None:
+                rows.append(prefix + ("added_question", qid, "__question__", "",
+                                      _to_str(after)))
+            elif before is not after and before != after:
+                for field in sorted(set(before) | set(after)):
+                    old, new = before.get(field), after.get(field)
+                    if old != new:
+                        rows.append(prefix + ("modified_field", qid, field,
+                                              _to_str(old), _to_str(new)))
+        for qid in prev_questions.keys() - cur_questions.keys():
+            rows.append(prefix + ("removed_question", qid, "__question__",
+                                  _to_str(prev_questions[qid]), ""))
+        if not rows:
+            # Equal but not identical questions (not interned, or 1 vs
+            # 1.0) make different version keys
+            if include_no_change:
+                yield prefix + ("no_change", "", "", "", "")
+            continue
+        rows.sort(key=lambda row: (row[3], row[4], row[5]))
+        yield from rows
+
+
+def survey_history_rows(history: dict, include_no_change: bool = True):
+    """Yield change rows for every survey in a history, sorted by survey"""
+    for survey_id in sorted(history):
+        yield from diff_survey_versions(survey_id, history[survey_id],
+                                        include_no_change)
+
+
+def _write_parquet(rows, output_path: str, batch_size: int) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c, pa.int32() if c == "version_index" else pa.string())
+                        for c in HISTORY_COLUMNS])
+    count = 0
+    with pq.ParquetWriter(output_path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(pa.Table.from_pylist(
+                    [dict(zip(HISTORY_COLUMNS, r)) for r in batch], schema))
+                count += len(batch)
+                batch = []
+        if batch or count == 0:
+            writer.write_table(pa.Table.from_pylist(
+                [dict(zip(HISTORY_COLUMNS, r)) for r in batch], schema))
+            count += len(batch)
+    return count
+
+
+def history_to_table(history_path: str, output_path: str,
+                     include_no_change: bool = True,
+                     batch_size: int = 10000) -> int:
+    """Write the change log of one survey history file
+
+    Args:
+        history_path: Path to a *_surveys_history_data.json file
+        output_path: Output file. Written as Parquet if it ends in .parquet,
+            otherwise as CSV.
+        include_no_change: Whether to write rows for unchanged versions
+        batch_size: Rows per Parquet row group
+
+    Returns:
+        Number of rows written
+    """
+    history = load_history(history_path)
+    rows = survey_history_rows(history, include_no_change)
+    if output_path.endswith(".parquet"):
+        if not PARQUET_AVAILABLE:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        return _write_parquet(rows, output_path, batch_size)
+    count = 0
+    with open(output_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HISTORY_COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _history_worker(args: tuple) -> tuple:
+    history_path, output_path, include_no_change = args
+    try:
+        return history_path, history_to_table(history_path, output_path,
+                                              include_no_change), None
+    except Exception as e:  # report and keep going with the other studies
+        return history_path, 0, f"{type(e).__name__}: {e}"
+
+
+def process_histories(history_paths: list, output_dir: str,
+                      output_format: str = "csv",
+                      include_no_change: bool = True,
+                      max_workers: int = None) -> dict:
+    """Write change logs for many studies' history files in parallel
+
+    Each input <name>.json is written to <output_dir>/<name>.<output_format>.
+
+    Args:
+        history_paths: Paths to *_surveys_history_data.json files
+        output_dir: Folder to write the change logs to
+        output_format: "csv" or "parquet"
+        include_no_change: Whether to write rows for unchanged versions
+        max_workers: Number of processes. If this is 1, files are processed
+            in the current process. If this is None, the executor default is
+            used.
+
+    Returns:
+        Dict mapping each history path to its row count, or to an error
+        message if it couldn't be processed
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = []
+    for history_path in history_paths:
+        name = os.path.splitext(os.path.basename(history_path))[0]
+        tasks.append((history_path,
+                      os.path.join(output_dir, f"{name}.{output_format}"),
+                      include_no_change))
+    if max_workers == 1 or len(tasks) <= 1:
+        results = map(_history_worker, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_history_worker, tasks))
+    outcomes = dict()
+    for history_path, count, error in results:
+        if error is not None:
+            logger.warning("Unable to process %s: %s", history_path, error)
+        outcomes[history_path] = error or count
+    return outcomes
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Convert Beiwe survey history JSON files to change logs"
+    )
+    parser.add_argument("history_paths", nargs="+")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--exclude-no-change", action="store_true")
+    parser.add_argument("--max-workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    outcomes = process_histories(args.history_paths, args.output_dir,
+                                 args.format, not args.exclude_no_change,
+                                 args.max_workers)
+    for history_path, outcome in outcomes.items():
+        print(f"{history_path}: {outcome}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
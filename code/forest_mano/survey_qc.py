@@ -0,0 +1,334 @@
+"""Survey quality-control checks for downloaded Beiwe raw data
+
+Compares the submissions recorded in survey_answers files against the
+submission events recorded in survey_timings files and flags any answers or
+timings that do not have a counterpart. This is the importable version of the
+checks in SurveyQC.ipynb.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
+import logging
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from raw_storage import list_raw_files, logical_name
+
+
+logger = logging.getLogger(__name__)
+
+# pyarrow's CSV reader is multithreaded and columnar; fall back to the C
+# parser when it isn't installed.
+CSV_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+
+TIMINGS_COLUMNS = ["UTC time", "question id", "survey id", "event"]
+
+SUBMISSION_TOLERANCE = pd.Timedelta(minutes=1)
+
+ANSWER_FILE_PATTERN = re.compile(r"\+00_00\.csv$")
+
+
+def extract_submission_rows(file_path: str, survey_id: str) -> list:
+    """Get the submission times recorded in one survey timings file
+
+    A submission row is a row whose event is "submitted" or whose question id
+    is "user hit submit" (older app versions).
+
+    Args:
+        file_path: Path to a survey timings csv file, plain or compressed
+        survey_id: The survey of interest
+
+    Returns:
+        List of UTC time strings of submissions, empty if none were found
+    """
+    try:
+        timings_df = pd.read_csv(file_path, dtype=str, engine=CSV_ENGINE,
+                                 keep_default_na=False)
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, ValueError):
+        logger.warning("Unable to read survey timings file %s", file_path)
+        return []
+    timings_df.columns = timings_df.columns.str.strip()
+    for column in TIMINGS_COLUMNS:
+        if column not in timings_df.columns:
+            timings_df[column] = ""
+    event = timings_df["event"].str.strip().str.lower()
+    question_id = timings_df["question id"].str.strip().str.lower()
+    is_submission = (
+        ((event == "submitted") | (question_id == "user hit submit"))
+        & (timings_df["survey id"].str.strip() == survey_id)
+    )
+    return timings_df.loc[is_submission, "UTC time"].tolist()
+
+
+def _scan_timings_file(args: tuple) -> tuple:
+    """Worker for scan_timings_files; takes a (file_path, survey_id) tuple"""
+    file_path, survey_id = args
+    return file_path, extract_submission_rows(file_path, survey_id)
+
+
+def scan_timings_files(file_paths: list, survey_id: str,
+                       max_workers: int = None) -> pd.DataFrame:
+    """Extract submission times from many survey timings files at once
+
+    Args:
+        file_paths: Paths to survey timings csv files
+        survey_id: The survey of interest
+        max_workers: Number of processes to use. If this is 1, files are read
+            in the current process. If this is None, the executor default is
+            used.
+
+    Returns:
+        Dataframe with a Time column (datetime64, floored to the second) and a
+        FilePath column, sorted by Time
+    """
+    jobs = [(file_path, survey_id) for file_path in file_paths]
+    if max_workers == 1 or len(jobs) <= 1:
+        results = map(_scan_timings_file, jobs)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_scan_timings_file, jobs,
+                                        chunksize=16))
+    times = []
+    paths = []
+    for file_path, file_times in results:
+        times.extend(file_times)
+        paths.extend([file_path] * len(file_times))
+    timings_submissions = pd.DataFrame({
+        "Time": pd.to_datetime(pd.Series(times, dtype=str),
+                               format="ISO8601").dt.floor("s"),
+        "FilePath": pd.Series(paths, dtype=str)
+    })
+    return timings_submissions.sort_values("Time", kind="stable",
+                                           ignore_index=True)
+
+
+def iterate_answer_files(survey_answers_dir: str,
+                         survey_id: str) -> pd.DataFrame:
+    """Build the submission log for one survey from survey answers filenames
+
+    Survey answers files are named by their UTC submission time, e.g.
+    "2023-01-31 14_02_11+00_00.csv", plain or compressed (see
+    raw_storage.py). Files with anything after "+00_00" are duplicates and
+    are skipped.
+
+    Args:
+        survey_answers_dir: Path to a participant's survey_answers directory
+        survey_id: The survey of interest
+
+    Returns:
+        Dataframe with Time, FilePath and Extension columns, sorted by Time
+    """
+    survey_dir = os.path.join(survey_answers_dir, survey_id)
+    if os.path.isdir(survey_dir):
+        filenames = [os.path.basename(path) for path in list_raw_files(survey_dir)
+                     if ANSWER_FILE_PATTERN.search(logical_name(path))]
+    else:
+        filenames = []
+    stems = pd.Series([os.path.splitext(logical_name(name))[0]
+                       for name in filenames], dtype=str)
+    answers_submissions = pd.DataFrame({
+        "Time": pd.to_datetime(
+            stems.str.replace("_", ":", regex=False).str[:-6],
+            format="%Y-%m-%d %H:%M:%S"
+        ),
+        "FilePath": pd.Series([os.path.join(survey_dir, name)
+                               for name in filenames], dtype=str),
+        "Extension": pd.Series([os.path.splitext(logical_name(name))[1]
+                                for name in filenames], dtype=str)
+    })
+    return answers_submissions.sort_values("Time", kind="stable",
+                                           ignore_index=True)
+
+
+def iterate_timings_files(survey_timings_dir: str, survey_id: str,
+                          max_workers: int = 1) -> pd.DataFrame:
+    """Build the submission log for one survey from survey timings files
+
+    Args:
+        survey_timings_dir: Path to a participant's survey_timings directory
+        survey_id: The survey of interest
+        max_workers: Number of processes used to read the files
+
+    Returns:
+        Dataframe with Time and FilePath columns, sorted by Time
+    """
+    survey_dir = os.path.join(survey_timings_dir, survey_id)
+    file_paths = list_raw_files(survey_dir)
+    return scan_timings_files(file_paths, survey_id, max_workers)
+
+
+def match_submission_logs(answers_submissions: pd.DataFrame,
+                          timings_submissions: pd.DataFrame,
+                          tolerance: pd.Timedelta = SUBMISSION_TOLERANCE
+                          ) -> pd.DataFrame:
+    """Match answers submissions to timings submissions one to one
+
+    Both logs are walked in time order, as SurveyQC.ipynb does: the earliest
+    remaining answers and timings submissions are matched if they are within
+    tolerance of each other; otherwise the earlier of the two is unmatched
+    and the walk moves past it. Each submission is matched at most once, and
+    an answer that misses one timing is still tried against the next.
+
+    Args:
+        answers_submissions: Output of iterate_answer_files
+        timings_submissions: Output of iterate_timings_files
+        tolerance: Largest acceptable difference between the two times
+
+    Returns:
+        Dataframe with one row per submission and columns Source ("answers"
+        or "timings"), Time, FilePath and Matched
+    """
+    answers = answers_submissions[["Time", "FilePath"]].sort_values(
+        "Time", kind="stable", ignore_index=True)
+    timings = timings_submissions[["Time", "FilePath"]].sort_values(
+        "Time", kind="stable", ignore_index=True)
+    answer_times = answers["Time"].to_numpy(
+        dtype="datetime64[ns]").view(np.int64).tolist()
+    timing_times = timings["Time"].to_numpy(
+        dtype="datetime64[ns]").view(np.int64).tolist()
+    answer_matched = np.zeros(len(answer_times), dtype=bool)
+    timing_matched = np.zeros(len(timing_times), dtype=bool)
+    tolerance_ns = pd.Timedelta(tolerance).value
+    answer_i = 0
+    timing_i = 0
+    while answer_i < len(answer_times) and timing_i < len(timing_times):
+        difference = answer_times[answer_i] - timing_times[timing_i]
+        if abs(difference) <= tolerance_ns:
+            answer_matched[answer_i] = True
+            timing_matched[timing_i] = True
+            answer_i += 1
+            timing_i += 1
+        elif difference > 0:
+            timing_i += 1
+        else:
+            answer_i += 1
+
+    answers["Matched"] = answer_matched
+    timings["Matched"] = timing_matched
+    answers["Source"] = "answers"
+    timings["Source"] = "timings"
+    columns = ["Source", "Time", "FilePath", "Matched"]
+    return pd.concat([answers[columns], timings[columns]], ignore_index=True)
+
+
+def compare_submission_logs(answers_submissions: pd.DataFrame,
+                            timings_submissions: pd.DataFrame,
+                            tolerance: pd.Timedelta = SUBMISSION_TOLERANCE
+                            ) -> tuple:
+    """Count matched and unmatched submissions between the two logs
+
+    Args:
+        answers_submissions: Output of iterate_answer_files
+        timings_submissions: Output of iterate_timings_files
+        tolerance: Largest acceptable difference between the two times
+
+    Returns:
+        Tuple of (number of matched pairs, number of unmatched files)
+    """
+    matches = match_submission_logs(answers_submissions, timings_submissions,
+                                    tolerance)
+    for file_path in matches.loc[~matches["Matched"], "FilePath"]:
+        logger.info("Unmatched file found at %s", file_path)
+    matched = int(matches.loc[matches["Source"] == "answers",
+                              "Matched"].sum())
+    unmatched = int((~matches["Matched"]).sum())
+    return matched, unmatched
+
+
+def qc_participant_survey(user_dir: str, survey_id: str,
+                          tolerance: pd.Timedelta = SUBMISSION_TOLERANCE
+                          ) -> pd.DataFrame:
+    """Match answers and timings submissions for one participant and survey
+
+    Args:
+        user_dir: Path to a participant's raw data directory
+        survey_id: The survey of interest
+        tolerance: Largest acceptable difference between the two times
+
+    Returns:
+        Output of match_submission_logs with BeiweID and SurveyID columns
+    """
+    answers_submissions = iterate_answer_files(
+        os.path.join(user_dir, "survey_answers"), survey_id
+    )
+    timings_submissions = iterate_timings_files(
+        os.path.join(user_dir, "survey_timings"), survey_id
+    )
+    matches = match_submission_logs(answers_submissions, timings_submissions,
+                                    tolerance)
+    matches.insert(0, "SurveyID", survey_id)
+    matches.insert(0, "BeiweID", os.path.basename(user_dir))
+    return matches
+
+
+def _qc_participant_survey(args: tuple) -> pd.DataFrame:
+    """Worker for identify_unmatched_files"""
+    return qc_participant_survey(*args)
+
+
+def list_participant_surveys(base_dir: str) -> list:
+    """List every (participant directory, survey ID) pair in a download folder
+
+    Args:
+        base_dir: The directory containing the raw data
+
+    Returns:
+        List of (user_dir, survey_id) tuples
+    """
+    jobs = []
+    for user_id in sorted(os.listdir(base_dir)):
+        user_dir = os.path.join(base_dir, user_id)
+        if not os.path.isdir(user_dir):
+            continue
+        survey_ids = set()
+        for stream in ["survey_timings", "survey_answers"]:
+            stream_dir = os.path.join(user_dir, stream)
+            if os.path.isdir(stream_dir):
+                survey_ids.update(
+                    survey_id for survey_id in os.listdir(stream_dir)
+                    if os.path.isdir(os.path.join(stream_dir, survey_id))
+                )
+        jobs.extend((user_dir, survey_id) for survey_id in sorted(survey_ids))
+    return jobs
+
+
+def identify_unmatched_files(base_dir: str, max_workers: int = None,
+                             tolerance: pd.Timedelta = SUBMISSION_TOLERANCE
+                             ) -> pd.DataFrame:
+    """Run the answers/timings comparison on all participants and surveys
+
+    Each participant and survey is checked in its own worker process.
+
+    Args:
+        base_dir: The directory containing the raw data
+        max_workers: Number of processes to use. If this is 1, everything runs
+            in the current process.
+        tolerance: Largest acceptable difference between the two times
+
+    Returns:
+        Dataframe with one row per submission file with BeiweID, SurveyID,
+        Source, Time, FilePath and Matched columns
+    """
+    jobs = [(user_dir, survey_id, tolerance)
+            for user_dir, survey_id in list_participant_surveys(base_dir)]
+    if max_workers == 1 or len(jobs) <= 1:
+        results = list(map(_qc_participant_survey, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_qc_participant_survey, jobs))
+    columns = ["BeiweID", "SurveyID", "Source", "Time", "FilePath", "Matched"]
+    if len(results) == 0:
+        return pd.DataFrame(columns=columns)
+    all_matches = pd.concat(results, ignore_index=True)[columns]
+
+    for file_path in all_matches.loc[~all_matches["Matched"], "FilePath"]:
+        logger.info("Unmatched file found at %s", file_path)
+    matched = int(all_matches.loc[all_matches["Source"] == "answers",
+                                  "Matched"].sum())
+    unmatched = int((~all_matches["Matched"]).sum())
+    logger.info("Number of matched files identified: %s", matched)
+    logger.info("Number of unmatched files identified: %s", unmatched)
+    return all_matches
@@ -1,7 +1,11 @@
 import glob
+import importlib
 import os
+import sys
 import datetime
 
+FOREST_MANO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forest_mano")
+
 try:
     import mano
     import logging
@@ -10,7 +14,7 @@ except:
     print("Failed importing nano. This needs to be run in a pipenv environment to work.")
 
 
-def download_beiwe_data(study_id, data_streams, output_folder, time_end=None, time_start=None):
+def download_beiwe_data(study_id, data_streams, output_folder, time_end=None, time_start=None, plan=None):
     """
     Download Beiwe data to a local directory. If time_start is not specified, extraction will
     proceed one week from time_end. If time_end is not specified, today's date is use as default.
@@ -21,6 +25,8 @@ def download_beiwe_data(study_id, data_streams, output_folder, time_end=None, ti
         output_folder (str): Downloaded data will be stored here
         time_end (str): End date of extraction in the format YYYY-MM-DD
         time_start (str): Start date of extraction in the format YYYY-MM-DD
+        plan (DataFrame): Download plan from forest_mano/download_planning.py. If given, participants the plan
+            skips are not downloaded and the rest are downloaded in plan order.
 
     Returns:
         active_users (list): List of Beiwe user IDs for whom data directories were returned
@@ -48,7 +54,14 @@ def download_beiwe_data(study_id, data_streams, output_folder, time_end=None, ti
     print("  Extracting data from %s to %s to %s." % (time_start, time_end, output_folder))
 
     # loop over all user IDs in the system for the study and download data
-    for user_id in mano.users(Keyring, study_id):
+    user_ids = mano.users(Keyring, study_id)
+    if plan is not None:
+        SKIP = _import_forest_mano("download_planning").SKIP
+        skipped = plan.loc[plan["action"] == SKIP]
+        for reason, count in skipped["reason"].value_counts().items():
+            print("  Skipping %d users: %s." % (count, reason))
+        user_ids = plan.loc[plan["action"] != SKIP, "participant_id"]
+    for user_id in user_ids:
         print("  Downloading data for user %s." % user_id)
         zf = msync.download(Keyring, study_id, user_id, data_streams=data_streams, time_start=time_start, time_end=time_end)
         zf.extractall(output_folder)
@@ -62,10 +75,24 @@ def download_beiwe_data(study_id, data_streams, output_folder, time_end=None, ti
     return active_users
 
 
+def _import_forest_mano(name):
+    """
+    Import a module from forest_mano/ on first use, without leaving that folder on sys.path (it holds modules
+    such as scheduler and progress that would shadow installed packages).
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    sys.path.insert(0, FOREST_MANO_DIR)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(FOREST_MANO_DIR)
+
+
 def check_file_size(data_dir, dates, subjects, surveys, data_streams):
     """
     Function to loop over all specified dates, subjects, data streams and surveys.
-    Prints out the file sizes for each.
+    Prints out the file sizes for each, uncompressed if the files are stored compressed.
 
     Args:
         data_dir (str): Location of the directory called "data" as downloaded from Beiwe
@@ -79,6 +106,8 @@ def check_file_size(data_dir, dates, subjects, surveys, data_streams):
             "magnetometer", "devicemotion", "reachability", "ios_log", "image_survey"
 
     """
+    # measures plain and compressed files the way the download code stores them
+    raw_file_size = _import_forest_mano("raw_storage").raw_file_size
 
     for date in dates:
         print("Date:", date)
@@ -92,7 +121,7 @@ def check_file_size(data_dir, dates, subjects, surveys, data_streams):
                 files = glob.glob(path)
                 total_size = 0
                 for file in files:
-                    total_size += os.path.getsize(file)
+                    total_size += raw_file_size(file)
                 print("  %s total file size is %d bytes." % (data_stream, total_size))
 
             # survey files
@@ -101,7 +130,7 @@ def check_file_size(data_dir, dates, subjects, surveys, data_streams):
                 files = glob.glob(path)
                 total_size = 0
                 for file in files:
-                    total_size += os.path.getsize(file)
+                    total_size += raw_file_size(file)
                 print("  %s survey total file size is %d bytes." % (survey, total_size))
             print("")
         print("")